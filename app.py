@@ -1,19 +1,34 @@
 import os
 import asyncio
 import json
+import hashlib
 import datetime
 import traceback
+import uuid
 from flask import Flask, request, jsonify, render_template, send_file, Response, stream_with_context
 from werkzeug.utils import secure_filename
 from mcp_persona import process_csv, process_csv2, process_md
 from mcp_persona import process_large_csv
 from mcp_persona import process_large_csv2
-from mcp_feedback import run_mcp_feedback, generate_chart
+from mcp_persona import SYNTHESIS_MODES, clean_persona, prompt_overhead_tokens
+from mcp_feedback import run_mcp_feedback, run_ab_feedback, get_feedback_cache
+from chart_render import CHART_FORMATS, get_chart_renderer
+from survey_ingest import detect_encoding
+from token_budget import plan_csv, load_encoder
+from response_cache import get_response_cache
+from gemini_pool import get_client_pool
+from llm_executor import get_llm_executor
+from job_manager import get_job_manager
+from artifact_writer import write_persona_artifacts, atomic_write, dumps_compact
+from conversation_log import find_log_for_export, iter_csv_export
+from persona_store import get_persona_store
+from persona_catalog import PersonaCatalog
+from cancellation import CancelToken, OperationCancelled, run_cancellable
+from sse_stream import get_stream_registry
 import inspect
+import shutil
 
-from queue import Queue
 import threading
-import zipfile
 import csv
 import io
 import time
@@ -75,6 +90,22 @@ for folder in [app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'],
 for folder in [app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'], os.path.join(app.config['OUTPUT_FOLDER'], "personas")]:
     os.makedirs(folder, exist_ok=True)
 
+# /load-personas 的記憶體快取，合併檔變更時才重新解析
+persona_catalog = PersonaCatalog(os.path.join(app.config['OUTPUT_FOLDER'], "personas"))
+
+def wants_cache_bypass(form):
+    """表單帶有 bypass_cache=1/true 時略過回應快取，強制重新呼叫 API"""
+    return form.get('bypass_cache', '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+def wants_partial_save(form):
+    """save_partial=1/true 時，用戶端斷線而取消工作後，把已完成的部分結果存檔"""
+    return str(form.get('save_partial', '')).strip().lower() in ('1', 'true', 'yes', 'on')
+
+def get_synthesis_mode(form):
+    """大型檔案的 persona 合成模式：flat（合併各批次結果）或 mapreduce（逐層彙整），預設 flat"""
+    mode = form.get('synthesis_mode', 'flat').strip().lower()
+    return mode if mode in SYNTHESIS_MODES else 'flat'
+
 # ============ 路由設定 ============
 
 @app.route('/')
@@ -82,191 +113,426 @@ def index():
     now = int(datetime.datetime.now().timestamp())
     return render_template('index.html', now=now)
 
-@app.route('/process-csv', methods=['POST'])
-def handle_csv_process():
-    if 'csv_file' not in request.files:
-        return jsonify({'error': 'No file part'}), 400
-    file = request.files['csv_file']
-    if file.filename == '':
-        return jsonify({'error': 'No selected file'}), 400
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
-    file.save(filepath)
-    
-    # 從請求中獲取 API Key
-    api_key = request.form.get('api_key')
-    if not api_key:
-        return jsonify({"error": "缺少 API Key"}), 400
+def save_uploads(files):
+    """將上傳檔案存到 UPLOAD_FOLDER 下本次請求專屬的子資料夾，回傳路徑串列
+
+    同名檔案的請求各自寫入不同路徑，排隊中或正在串流讀取的工作不會被後來的上傳覆寫；
+    子資料夾內保留原始檔名，進度訊息與訪談 prompt 中的檔名不變，回應快取仍可命中。
+    """
+    upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], uuid.uuid4().hex)
+    os.makedirs(upload_dir, exist_ok=True)
+    paths = []
+    for i, file in enumerate(files):
+        filename = secure_filename(file.filename)
+        filepath = os.path.join(upload_dir, filename)
+        if filepath in paths:
+            # 同一個請求中有同名檔案
+            filepath = os.path.join(upload_dir, f"{i + 1}_{filename}")
+        file.save(filepath)
+        paths.append(filepath)
+    return paths
+
+def persona_response(log_path, zip_path, personas_json_path, personas):
+    """persona 生成端點共用的回應格式（路徑只保留檔名部分）"""
+    return {
+        'success': True,
+        'message': f'成功生成 {len(personas)} 個 personas',
+        'csv_log_path': os.path.basename(log_path),
+        'zip_path': os.path.basename(zip_path),
+        'personas_json_path': os.path.basename(personas_json_path),
+        'persona_count': len(personas),
+        'personas': personas  # 傳回完整的 personas 資料
+    }
+
+def report_progress(progress_callback, stage, **data):
+    if progress_callback is not None:
+        progress_callback(dict(stage=stage, **data))
+
+def plan_upload(filepath):
+    """偵測編碼並以 tokenizer 取樣估算 token 數；會讀檔與 tokenize，應在執行緒中呼叫"""
+    return plan_csv(filepath, encoding=detect_encoding(filepath), prompt_overhead=prompt_overhead_tokens())
+
+async def generate_csv_personas(filepath, api_key, use_cache=True, synthesis_mode='flat', progress_callback=None):
+    """/process-csv 的處理流程，同步端點與背景工作共用"""
+    # 以 tokenizer 取樣估算 token 數，決定一次送出或分批處理
+    plan = await asyncio.to_thread(plan_upload, filepath)
+    estimated_tokens = plan['estimated_tokens']
+    report_progress(progress_callback, 'planning', total=plan['estimated_chunks'], mode=plan['mode'])
+
+    if plan['mode'] == 'batched':
+        print(f"檢測到大型 CSV 文件，估算約 {int(estimated_tokens)} tokens，將使用批次處理（約 {plan['estimated_chunks']} 批，{synthesis_mode} 模式）")
+        output_csv_path, zip_path, all_personas_path, all_personas = await process_large_csv(
+            filepath, app.config['OUTPUT_FOLDER'], batch_size=plan['chunk_tokens'], api_key=api_key,
+            use_cache=use_cache, synthesis_mode=synthesis_mode, progress_callback=progress_callback
+        )
+    else:
+        print(f"檢測到標準大小 CSV 文件，估算約 {int(estimated_tokens)} tokens，使用常規處理")
+        output_csv_path, zip_path, all_personas_path, all_personas = await process_csv(
+            filepath, app.config['OUTPUT_FOLDER'], api_key=api_key, use_cache=use_cache,
+            progress_callback=progress_callback
+        )
 
-    try:
-        file_size = os.path.getsize(filepath)
-        estimated_tokens = file_size / 6
-        
-        large_file_threshold = 40000
-        
-        if estimated_tokens > large_file_threshold:
-            print(f"檢測到大型 CSV 文件，估算約 {int(estimated_tokens)} tokens，將使用批次處理")
-            output_csv_path, zip_path, all_personas_path, all_personas = asyncio.run(
-                process_large_csv(filepath, app.config['OUTPUT_FOLDER'], api_key=api_key)  # 添加 api_key 參數
+    # 記錄成功的回應用於除錯
+    print(f"成功處理 CSV，回傳 {len(all_personas)} 個 personas")
+    return persona_response(output_csv_path, zip_path, all_personas_path, all_personas)
+
+async def generate_csv2_personas(filepaths, api_key, use_cache=True, synthesis_mode='flat', progress_callback=None):
+    """/process-csv2 的處理流程：逐一處理多個檔案後合併輸出"""
+    # 先規劃所有檔案，讓進度可以回報整體的批次數
+    plans = [await asyncio.to_thread(plan_upload, filepath) for filepath in filepaths]
+    report_progress(progress_callback, 'planning', total=sum(plan['estimated_chunks'] for plan in plans))
+
+    all_personas = []
+    completed_before = 0
+    for i, (filepath, plan) in enumerate(zip(filepaths, plans)):
+        print(f"處理第 {i+1}/{len(filepaths)} 個檔案: {os.path.basename(filepath)}")
+        estimated_tokens = plan['estimated_tokens']
+
+        # 各檔案的批次編號從 1 開始，回報進度時加上前面檔案已完成的批次數
+        def file_progress(event, offset=completed_before):
+            if progress_callback is None:
+                return
+            if event.get('stage') == 'generating' and 'completed' in event:
+                event = dict(event, completed=offset + event['completed'])
+            progress_callback(dict(event, file=os.path.basename(filepath)))
+
+        # 根據估算結果選擇處理方法
+        if plan['mode'] == 'batched':
+            print(f"檢測到大型 CSV2 檔案，估算約 {int(estimated_tokens)} tokens，將使用批次處理（約 {plan['estimated_chunks']} 批，{synthesis_mode} 模式）")
+            _, _, _, file_personas = await process_large_csv2(
+                filepath, app.config['OUTPUT_FOLDER'], batch_size=plan['chunk_tokens'], api_key=api_key,
+                use_cache=use_cache, synthesis_mode=synthesis_mode, progress_callback=file_progress
             )
         else:
-            print(f"檢測到標準大小 CSV 文件，估算約 {int(estimated_tokens)} tokens，使用常規處理")
-            output_csv_path, zip_path, all_personas_path, all_personas = asyncio.run(
-                process_csv(filepath, app.config['OUTPUT_FOLDER'], api_key=api_key)  # 添加 api_key 參數
+            print(f"檢測到標準大小 CSV2 檔案，估算約 {int(estimated_tokens)} tokens，使用常規處理")
+            _, _, _, file_personas = await process_csv2(
+                filepath, app.config['OUTPUT_FOLDER'], api_key=api_key, use_cache=use_cache,
+                progress_callback=file_progress
             )
-        
-        # 確保路徑只保留檔名部分，不包含完整路徑
-        output_csv_basename = os.path.basename(output_csv_path)
-        zip_basename = os.path.basename(zip_path)
-        all_personas_basename = os.path.basename(all_personas_path)
-        
-        # 將相對路徑和其他資訊傳回前端
-        response_data = {
-            'success': True,
-            'message': f'成功生成 {len(all_personas)} 個 personas',
-            'csv_log_path': output_csv_basename,
-            'zip_path': zip_basename,
-            'personas_json_path': all_personas_basename,
-            'persona_count': len(all_personas),
-            'personas': all_personas  # 傳回完整的 personas 資料
+        completed_before += plan['estimated_chunks']
+
+        # 合併結果
+        if file_personas:
+            all_personas.extend(file_personas)
+
+    # 現在我們有了所有檔案的 personas，保存合併結果
+    if not all_personas:
+        raise ValueError('未能生成任何 Persona')
+
+    # 保存合併後的 personas：個別檔案已由 process_csv2 寫出，這裡只輸出本次所有檔案的合併 json 與 zip
+    all_personas_path = os.path.join(app.config['OUTPUT_FOLDER'], "personas", "csv2_personas.json")
+    zip_path = os.path.join(app.config['OUTPUT_FOLDER'], "csv2_personas.zip")
+    write_persona_artifacts(all_personas, all_personas_path, zip_path)
+
+    return persona_response("csv2_processing_log.txt", zip_path, all_personas_path, all_personas)
+
+async def generate_md_personas(md_paths, api_key, use_cache=True, synthesis_mode='flat', progress_callback=None):
+    """/process-md 的處理流程"""
+    output_md_path, zip_path, all_personas_path, all_personas = await process_md(
+        md_paths, app.config['OUTPUT_FOLDER'], api_key=api_key, use_cache=use_cache,
+        progress_callback=progress_callback, synthesis_mode=synthesis_mode
+    )
+    # 這裡還是叫 csv_log_path，但實際是 MD 的對話紀錄
+    return persona_response(output_md_path, zip_path, all_personas_path, all_personas)
+
+def parse_persona_request(kind):
+    """解析 persona 生成請求的表單並儲存上傳檔案
+
+    回傳 (coro_factory, None)，coro_factory(progress_callback) 產生處理協程；
+    表單有誤時回傳 (None, (錯誤回應, 狀態碼))。
+    """
+    field = 'md_files[]' if kind == 'md' else 'csv_file'
+    if field not in request.files:
+        return None, (jsonify({'error': '沒有檔案部分'}), 400)
+    files = request.files.getlist(field)
+    if not files or files[0].filename == '':
+        return None, (jsonify({'error': '未選擇任何檔案'}), 400)
+
+    # 從請求中獲取 API Key
+    api_key = request.form.get('api_key', '')
+    if not api_key:
+        return None, (jsonify({"error": "缺少 API Key"}), 400)
+    use_cache = not wants_cache_bypass(request.form)
+    synthesis_mode = get_synthesis_mode(request.form)
+
+    if kind == 'csv':
+        filepath = save_uploads(files[:1])[0]
+        return (lambda progress_callback=None: generate_csv_personas(
+            filepath, api_key, use_cache, synthesis_mode, progress_callback)), None
+    if kind == 'csv2':
+        filepaths = save_uploads(files)
+        return (lambda progress_callback=None: generate_csv2_personas(
+            filepaths, api_key, use_cache, synthesis_mode, progress_callback)), None
+    md_paths = save_uploads(files)
+    return (lambda progress_callback=None: generate_md_personas(
+        md_paths, api_key, use_cache, synthesis_mode, progress_callback)), None
+
+def wants_event_stream():
+    return 'text/event-stream' in request.headers.get('Accept', '')
+
+def sse_response(stream, last_event_id=0):
+    """以 SSE 回傳串流事件；X-Stream-Id 可搭配 /streams/<stream_id> 與 Last-Event-ID 續傳"""
+    return Response(
+        stream_with_context(stream.iter_sse(last_event_id)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'X-Stream-Id': stream.id,
         }
-        
-        # 記錄成功的回應用於除錯
-        print(f"成功處理 CSV，回傳 {len(all_personas)} 個 personas")
-        
-        return jsonify(response_data)
+    )
+
+def save_partial_result(kind, request_id, partial):
+    """保存被取消的工作已完成的部分結果，回傳檔名
+
+    檔名由伺服器產生（uuid4），不使用用戶端提供的 request_id，寫入前再確認路徑仍在輸出資料夾內。
+    """
+    output_folder = os.path.realpath(app.config['OUTPUT_FOLDER'])
+    filename = f"partial_{secure_filename(kind)}_{uuid.uuid4().hex}.json"
+    path = os.path.realpath(os.path.join(output_folder, filename))
+    if os.path.dirname(path) != output_folder:
+        raise ValueError(f"部分結果的路徑不在輸出資料夾內: {filename}")
+    atomic_write(path, dumps_compact(partial))
+    print(f"[{request_id}] 已保存 {len(partial)} 筆部分結果至 {filename}")
+    return filename
+
+def handle_cancelled(error, kind, request_id, save_partial):
+    print(f"[{request_id}] {kind} 工作已取消: {error}")
+    if save_partial and error.partial:
+        save_partial_result(kind, request_id, error.partial)
+
+def stream_persona_request(coro_factory, label):
+    """以 SSE 回傳 persona 生成進度
+
+    每個批次完成就送出 progress 與該批次清理後的 personas（type=personas，尚未去重/彙整），
+    全部完成後送出與非串流回應相同內容的 complete 訊息。
+    用戶端斷線且未在期限內續傳時取消處理；表單帶有 save_partial 時，把已完成批次的 personas 存成部分結果。
+    """
+    state = {'total': None}
+    cancel_token = CancelToken()
+    cancel_token.partial = []
+    save_partial = wants_partial_save(request.form)
+    request_id = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+
+    def work(publish):
+        def progress_callback(event):
+            stage = event.get('stage')
+            if event.get('total'):
+                state['total'] = event['total']
+            progress = {
+                'type': 'progress',
+                'stage': stage,
+                'completed': event.get('completed'),
+                'total': state['total'],
+            }
+            if stage == 'generating':
+                progress['message'] = f"已完成 {event.get('completed')}/{state['total'] or '?'} 個批次"
+            elif stage == 'reducing':
+                progress['message'] = f"正在彙整 persona（第 {event.get('level', '?')} 層）"
+            elif stage == 'consolidating':
+                progress['message'] = '正在整併各批次的 persona...'
+            elif stage == 'saving':
+                progress['message'] = '正在保存結果...'
+            publish(progress)
+
+            if stage == 'generating' and event.get('personas'):
+                cleaned = [c for c in (clean_persona(p) for p in event['personas']) if len(c) > 1]
+                cancel_token.partial.extend(cleaned)
+                publish({
+                    'type': 'personas',
+                    'chunk': event.get('chunk'),
+                    'file': event.get('file'),
+                    'personas': cleaned,
+                })
+
+        try:
+            result = run_cancellable(coro_factory(progress_callback), cancel_token)
+        except OperationCancelled as e:
+            handle_cancelled(e, label.lower(), request_id, save_partial)
+            return
+        publish(dict(result, type='complete'))
+
+    return sse_response(get_stream_registry().start(work, cancel_token, label))
+
+def run_persona_request(kind, label):
+    coro_factory, error = parse_persona_request(kind)
+    if error:
+        return error
+    # 判斷是否要使用串流回應
+    if wants_event_stream():
+        return stream_persona_request(coro_factory, label)
+    try:
+        return jsonify(asyncio.run(coro_factory()))
     except Exception as e:
         # 詳細記錄錯誤
-        print(f"CSV 處理錯誤: {str(e)}")
+        print(f"{label} 處理錯誤: {str(e)}")
         traceback.print_exc()
         return jsonify({'error': str(e), 'trace': traceback.format_exc()}), 500
 
+@app.route('/streams/<stream_id>', methods=['GET'])
+def resume_stream(stream_id):
+    """以 Last-Event-ID（或 last_event_id 參數）從中斷處繼續接收進行中或剛結束的串流"""
+    stream = get_stream_registry().get(stream_id)
+    if stream is None:
+        return jsonify({'error': '找不到此串流或已過期'}), 404
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID 格式錯誤'}), 400
+    return sse_response(stream, last_event_id)
+
+@app.route('/process-csv', methods=['POST'])
+def handle_csv_process():
+    return run_persona_request('csv', 'CSV')
+
 # 修改 process-csv2 路由以支持多文件上传
 @app.route('/process-csv2', methods=['POST'])
 def handle_csv2_process():
-    if 'csv_file' not in request.files:
-        return jsonify({'error': '沒有檔案部分'}), 400
-    
-    # 獲取 API Key 並設置環境變數
-    api_key = request.form.get('api_key', '')  
-    if not api_key:
-        return jsonify({'error': '未提供 Gemini API Key'}), 400
-    
-    os.environ["Gemini_api"] = api_key
-    
-    files = request.files.getlist('csv_file')
-    if not files or files[0].filename == '':
-        return jsonify({'error': '未選擇任何檔案'}), 400
-    
-    try:
-        all_personas = []
-        
-        for i, file in enumerate(files):
-            # 保存檔案
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
-            file.save(filepath)
-            
-            print(f"處理第 {i+1}/{len(files)} 個檔案: {os.path.basename(filepath)}")
-            
-            # 估算檔案大小 - 使用一致的估算方法
-            file_size = os.path.getsize(filepath)
-            estimated_tokens = file_size / 6  # 統一使用這個方法估算
-            large_file_threshold = 40000
-            
-            # 根據檔案大小選擇處理方法
-            if estimated_tokens > large_file_threshold:
-                print(f"檢測到大型 CSV2 檔案，估算約 {int(estimated_tokens)} tokens，將使用批次處理")
-                _, _, _, file_personas = asyncio.run(
-                    process_large_csv2(filepath, app.config['OUTPUT_FOLDER'])
-                )
-            else:
-                print(f"檢測到標準大小 CSV2 檔案，估算約 {int(estimated_tokens)} tokens，使用常規處理")
-                _, _, _, file_personas = asyncio.run(
-                    process_csv2(filepath, app.config['OUTPUT_FOLDER'])
-                )
-                
-            # 合併結果
-            if file_personas:
-                all_personas.extend(file_personas)
-        
-        # 現在我們有了所有檔案的 personas，保存合併結果
-        if not all_personas:
-            return jsonify({'error': '未能生成任何 Persona'}), 500
-            
-        # 保存合併後的 personas
-        out_dir = os.path.join(app.config['OUTPUT_FOLDER'], "personas", "csv2")
-        os.makedirs(out_dir, exist_ok=True)
-        
-        # 合併所有 personas 成一個 json
-        all_personas_path = os.path.join(app.config['OUTPUT_FOLDER'], "personas", "csv2_personas.json")
-        with open(all_personas_path, 'w', encoding='utf-8') as f:
-            json.dump(all_personas, f, ensure_ascii=False, indent=4)
-        print(f"合併 personas 到 {all_personas_path}")
-        
-        # 壓縮成 zip
-        zip_path = os.path.join(app.config['OUTPUT_FOLDER'], "csv2_personas.zip")
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(out_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, out_dir)
-                    zipf.write(file_path, arcname)
-        print(f"壓縮 personas 到 {zip_path}")
-        
-        # 返回結果
-        return jsonify({
-            'success': True,
-            'message': f'成功生成 {len(all_personas)} 個 personas',
-            'csv_log_path': "csv2_processing_log.txt",
-            'zip_path': os.path.basename(zip_path),
-            'personas_json_path': os.path.basename(all_personas_path),
-            'persona_count': len(all_personas),
-            'personas': all_personas
-        })
-    except Exception as e:
-        print(f"CSV2 處理錯誤: {str(e)}")
-        traceback.print_exc()
-        return jsonify({'error': str(e), 'trace': traceback.format_exc()}), 500
-    
+    return run_persona_request('csv2', 'CSV2')
+
 @app.route('/process-md', methods=['POST'])
 def handle_md_process():
-    if 'md_files[]' not in request.files:
-        return jsonify({'error': 'No files part'}), 400
-    files = request.files.getlist('md_files[]')
-    if not files or files[0].filename == '':
-        return jsonify({'error': 'No selected files'}), 400
-    
-    # 從請求中獲取 API Key
-    api_key = request.form.get('api_key')
-    if not api_key:
-        return jsonify({"error": "缺少 API Key"}), 400
-    
-    md_paths = []
-    for file in files:
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(file.filename))
-        file.save(filepath)
-        md_paths.append(filepath)
-
+    return run_persona_request('md', 'MD')
+
+# ============ 背景工作 API ============
+
+@app.route('/jobs/<kind>', methods=['POST'])
+def submit_persona_job(kind):
+    """送出 persona 生成工作，立即回傳 job_id，之後以 /jobs/<job_id> 查詢進度"""
+    if kind not in ('csv', 'csv2', 'md'):
+        return jsonify({'error': f'不支援的工作類型: {kind}'}), 404
+    coro_factory, error = parse_persona_request(kind)
+    if error:
+        return error
+    job = get_job_manager().submit(kind, coro_factory)
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': f'/jobs/{job.id}',
+        'result_url': f'/jobs/{job.id}/result',
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({'error': '找不到此工作或已過期'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = get_job_manager().get(job_id)
+    if job is None:
+        return jsonify({'error': '找不到此工作或已過期'}), 404
+    if job.status == 'succeeded':
+        return jsonify(job.result)
+    if job.status == 'failed':
+        return jsonify({'error': job.error, 'job': job.to_dict()}), 500
+    return jsonify(job.to_dict()), 202
+
+def find_personas(selected_ids, request_id=''):
+    """依 persona_id 從 persona store 查詢，回傳依選擇順序排列的 personas
+
+    store 中找不到的 ID（例如建立 store 之前產生的 persona）才掃描資料夾，並把讀到的檔案補進 store。
+    """
+    store = get_persona_store()
+    found = store.get_many(selected_ids)
+    missing = {str(pid) for pid in selected_ids} - set(found)
+    if missing:
+        print(f"[{request_id}] persona store 中找不到 {len(missing)} 個 ID，改為掃描資料夾")
+        personas_dir = os.path.join(app.config['OUTPUT_FOLDER'], "personas")
+        for folder in ["csv", "csv2", "md"]:
+            folder_path = os.path.join(personas_dir, folder)
+            if not os.path.exists(folder_path):
+                continue
+            scanned = []
+            for filename in os.listdir(folder_path):
+                if filename.endswith(".json") and not filename.endswith("_personas.json"):
+                    try:
+                        with open(os.path.join(folder_path, filename), 'r', encoding='utf-8') as f:
+                            scanned.append(json.load(f))
+                    except Exception as e:
+                        print(f"[{request_id}] 讀取 JSON 檔案出錯: {e}")
+            if scanned:
+                store.save_run(scanned, folder, run_id='scan')
+            for persona in scanned:
+                if str(persona.get('persona_id')) in missing:
+                    found[str(persona.get('persona_id'))] = persona
+    return [found[str(pid)] for pid in dict.fromkeys(selected_ids) if str(pid) in found]
+
+def feedback_result(feedbacks, avg_score, spec, chart_format=None):
+    """評估完成的回應內容；要求圖檔時在圖表執行緒排入繪製，回傳可取得圖檔的 chart_url"""
+    result = {
+        'success': True,
+        'feedback': feedbacks,
+        'avg_score': avg_score,
+        'chart_spec': spec,
+    }
+    if chart_format and spec:
+        key = get_chart_renderer().submit(spec, chart_format)
+        result['chart_url'] = f"/charts/{key}"
+    return result
+
+@app.route('/charts/<key>', methods=['GET'])
+def get_chart(key):
+    """取得伺服器端繪製的評分圖表；圖檔內容由分數決定，可長期快取"""
+    fmt = key.rsplit('.', 1)[-1]
+    if fmt not in CHART_FORMATS:
+        return jsonify({'error': f'不支援的圖表格式: {fmt}'}), 404
     try:
-        output_md_path, zip_path, all_personas_path, all_personas = asyncio.run(
-            process_md(md_paths, app.config['OUTPUT_FOLDER'], api_key=api_key)  # 添加 api_key 參數
-        )
-        # 確保路徑只保留檔名部分，不包含完整路徑
-        output_md_basename = os.path.basename(output_md_path)
-        zip_basename = os.path.basename(zip_path)
-        all_personas_basename = os.path.basename(all_personas_path)
-        
-        return jsonify({
-            'success': True,
-            'message': f'成功生成 {len(all_personas)} 個 personas',
-            'csv_log_path': output_md_basename,  # 這裡還是叫 csv_log_path，但實際是 MD 的對話紀錄
-            'zip_path': zip_basename,
-            'personas_json_path': all_personas_basename,
-            'persona_count': len(all_personas),
-            'personas': all_personas
-        })
+        data = get_chart_renderer().result(key)
     except Exception as e:
-        traceback.print_exc()
+        print(f"繪製圖表失敗: {e}")
         return jsonify({'error': str(e)}), 500
+    if data is None:
+        return jsonify({'error': '找不到此圖表或已過期'}), 404
+    return Response(data, mimetype=CHART_FORMATS[fmt],
+                    headers={'Cache-Control': 'public, max-age=86400, immutable'})
+
+def ab_feedback_response(selected_personas, marketing_copies, api_key, use_cache, request_id, save_partial=False):
+    """A/B 模式：評估 persona × 文案矩陣
+
+    串流時每完成一格送出 type=cell（含目前進度），最後送出含矩陣、各文案平均分數與排名的 complete 訊息。
+    """
+    def build_result(cells, copies):
+        return {
+            'success': True,
+            'mode': 'ab',
+            'cells': cells,
+            'copies': copies,
+            'ranking': [c['copy_index'] for c in sorted(copies, key=lambda c: c['rank'])],
+        }
+
+    if not wants_event_stream():
+        try:
+            cells, copies = run_ab_feedback(selected_personas, marketing_copies, api_key=api_key, use_cache=use_cache)
+            return jsonify(build_result(cells, copies))
+        except Exception as e:
+            print(f"[{request_id}] A/B 評估錯誤: {e}")
+            traceback.print_exc()
+            return jsonify({'error': str(e)}), 500
+
+    cancel_token = CancelToken()
+
+    def work(publish):
+        def cell_callback(cell, current, total):
+            publish({
+                'type': 'cell',
+                'cell': cell,
+                'current': current,
+                'total': total,
+                'message': f'已完成 {current}/{total} 個評估',
+            })
+
+        try:
+            cells, copies = run_ab_feedback(selected_personas, marketing_copies, cell_callback, api_key=api_key,
+                                            use_cache=use_cache, cancel_token=cancel_token)
+        except OperationCancelled as e:
+            handle_cancelled(e, 'ab_feedback', request_id, save_partial)
+            return
+        publish(dict(build_result(cells, copies), type='complete'))
+
+    return sse_response(get_stream_registry().start(work, cancel_token, f"[{request_id}] A/B 評估"))
 
 @app.route('/process-feedback', methods=['POST'])
 def handle_feedback():
@@ -276,12 +542,22 @@ def handle_feedback():
         marketing_copy = data.get('marketing_copy', '')
         api_key = data.get('api_key')
         request_id = data.get('request_id', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        use_cache = str(data.get('bypass_cache', '')).strip().lower() not in ('1', 'true', 'yes', 'on')
+        # 預設只回傳圖表資料規格，指定 chart_format（png/svg）時才另外在伺服器端繪製
+        chart_format = data.get('chart_format') or None
+        if chart_format is not None and chart_format not in CHART_FORMATS:
+            return jsonify({'error': f'不支援的圖表格式: {chart_format}'}), 400
+        # A/B 模式：marketing_copies 為多份文案，一次評估完整的 persona × 文案矩陣
+        marketing_copies = data.get('marketing_copies')
+        if marketing_copies is not None:
+            if not isinstance(marketing_copies, list):
+                return jsonify({'error': 'marketing_copies 必須是文案列表'}), 400
+            marketing_copies = [str(c).strip() for c in marketing_copies if str(c or '').strip()]
+            marketing_copy = "\n\n".join(marketing_copies)
         
         if not api_key:
             return jsonify({'error': '缺少 API Key'}), 400
         
-        os.environ["Gemini_api"] = api_key
-        
         print(f"[{request_id}] 收到評估請求: {len(selected_ids)} 個 Personas, 文案長度 {len(marketing_copy)} 字元")
         print(f"[{request_id}] 選擇的 Persona IDs: {selected_ids}")
 
@@ -290,133 +566,57 @@ def handle_feedback():
         if not marketing_copy:
             return jsonify({'error': '未輸入行銷文案'}), 400
 
-        # 搜尋所有 persona 檔案
-        personas_dir = os.path.join(app.config['OUTPUT_FOLDER'], "personas")
-        all_personas = []
-        for folder in ["csv", "csv2", "md"]:
-            folder_path = os.path.join(personas_dir, folder)
-            if os.path.exists(folder_path):
-                for filename in os.listdir(folder_path):
-                    if filename.endswith(".json") and not filename.endswith("_personas.json"):
-                        with open(os.path.join(folder_path, filename), 'r', encoding='utf-8') as f:
-                            try:
-                                persona = json.load(f)
-                                all_personas.append(persona)
-                            except Exception as e:
-                                print(f"[{request_id}] 讀取 JSON 檔案出錯: {e}")
-
-        # 記錄所有找到的 Persona ID
-        found_ids = [str(p.get('persona_id')) for p in all_personas]
-        print(f"[{request_id}] 系統中找到的所有 Persona IDs: {found_ids}")
-        
-        # 過濾出被選到的 personas
-        selected_personas = [p for p in all_personas if str(p.get('persona_id')) in selected_ids]
+        # 依 ID 從 persona store 查詢被選到的 personas
+        selected_personas = find_personas(selected_ids, request_id)
 
         if not selected_personas:
             return jsonify({'error': '找不到對應的Persona'}), 400
 
+        if marketing_copies is not None:
+            print(f"[{request_id}] A/B 模式：{len(selected_personas)} 個 Personas × {len(marketing_copies)} 份文案")
+            return ab_feedback_response(selected_personas, marketing_copies, api_key, use_cache, request_id,
+                                        wants_partial_save(data))
+
         print(f"[{request_id}] 準備呼叫評估函數，選擇了 {len(selected_personas)} 個 Personas")
         
         # 判斷是否要使用串流回應
-        if request.headers.get('Accept') == 'text/event-stream':
-            def generate():
-                try:
-                    # 使用隊列來收集進度消息
-                    progress_queue = Queue()
-                    
-                    # 創建進度回調函數
-                    def progress_callback(current, total, batch_current, batch_total):
-                        # 計算已完成的批次數
-                        completed_batches = 0
-                        if current > 0:
-                            completed_batches = (current - 1) // 2  # 每2個完成一個批次
-                            if current % 2 == 0:  # 當完成偶數個時，當前批次完成
-                                completed_batches += 1
-                        
-                        progress_data = {
-                            'type': 'progress',
-                            'current': current,
-                            'total': total,
-                            'batch_current': completed_batches,
-                            'batch_total': batch_total,
-                            'message': f'正在評估 {current}/{total} 個 Persona...',
-                            'batch_message': f'已完成批次 {completed_batches}/{batch_total}'
-                        }
-                        
-                        print(f"[進度更新] current={current}, completed_batches={completed_batches}")
-                        
-                        msg = f"data: {json.dumps(progress_data)}\n\n"
-                        progress_queue.put(msg)
-                    
-                    result_container = []
-                    error_container = []
-                    
-                    def run_feedback():
-                        try:
-                            result = run_mcp_feedback(selected_personas, marketing_copy, progress_callback)
-                            result_container.append(result)
-                        except Exception as e:
-                            error_container.append(e)
-                    
-                    # 啟動處理線程
-                    feedback_thread = threading.Thread(target=run_feedback)
-                    feedback_thread.start()
-                    
-                    # 串流輸出進度消息
-                    while feedback_thread.is_alive() or not progress_queue.empty():
-                        try:
-                            msg = progress_queue.get(timeout=0.1)
-                            yield msg
-                        except:
-                            continue
-                    
-                    # 等待線程完成
-                    feedback_thread.join()
-                    
-                    # 檢查是否有錯誤
-                    if error_container:
-                        error_data = {
-                            'type': 'error',
-                            'error': str(error_container[0])
-                        }
-                        yield f"data: {json.dumps(error_data)}\n\n"
-                        return
-                    
-                    # 處理結果
-                    if result_container:
-                        result = result_container[0]
-                        if isinstance(result, tuple) and len(result) == 3:
-                            feedbacks, avg_score, chart_img = result
-                        else:
-                            feedbacks = result
-                            avg_score = sum(item.get('score', 0) for item in feedbacks) / len(feedbacks) if feedbacks else 0
-                            chart_img = generate_chart(feedbacks, avg_score)
-                        
-                        # 發送完成消息
-                        complete_data = {
-                            'type': 'complete',
-                            'success': True,
-                            'feedback': feedbacks,
-                            'avg_score': avg_score,
-                            'chart': chart_img
-                        }
-                        yield f"data: {json.dumps(complete_data, ensure_ascii=True)}\n\n"
+        if wants_event_stream():
+            cancel_token = CancelToken()
+            save_partial = wants_partial_save(data)
+
+            def work(publish):
+                # 創建進度回調函數
+                def progress_callback(current, total, batch_current, batch_total):
+                    # 計算已完成的批次數
+                    completed_batches = 0
+                    if current > 0:
+                        completed_batches = (current - 1) // 2  # 每2個完成一個批次
+                        if current % 2 == 0:  # 當完成偶數個時，當前批次完成
+                            completed_batches += 1
                     
-                except Exception as e:
-                    error_data = {
-                        'type': 'error',
-                        'error': str(e)
-                    }
-                    yield f"data: {json.dumps(error_data)}\n\n"
-            
-            return Response(
-                stream_with_context(generate()),
-                mimetype='text/event-stream',
-                headers={
-                    'Cache-Control': 'no-cache',
-                    'X-Accel-Buffering': 'no',
-                }
-            )
+                    publish({
+                        'type': 'progress',
+                        'current': current,
+                        'total': total,
+                        'batch_current': completed_batches,
+                        'batch_total': batch_total,
+                        'message': f'正在評估 {current}/{total} 個 Persona...',
+                        'batch_message': f'已完成批次 {completed_batches}/{batch_total}'
+                    })
+                    print(f"[進度更新] current={current}, completed_batches={completed_batches}")
+
+                try:
+                    feedbacks, avg_score, spec = run_mcp_feedback(
+                        selected_personas, marketing_copy, progress_callback, api_key=api_key,
+                        use_cache=use_cache, cancel_token=cancel_token
+                    )
+                except OperationCancelled as e:
+                    handle_cancelled(e, 'feedback', request_id, save_partial)
+                    return
+                # 發送完成消息
+                publish(dict(feedback_result(feedbacks, avg_score, spec, chart_format), type='complete'))
+
+            return sse_response(get_stream_registry().start(work, cancel_token, f"[{request_id}] 評估"))
         else:
             # 非串流處理
             try:
@@ -424,32 +624,15 @@ def handle_feedback():
                 if inspect.iscoroutinefunction(run_mcp_feedback):
                     # 如果是異步函數，使用 asyncio.run
                     print("檢測到 run_mcp_feedback 是異步函數，使用 asyncio.run")
-                    result = asyncio.run(run_mcp_feedback(selected_personas, marketing_copy))
+                    result = asyncio.run(run_mcp_feedback(selected_personas, marketing_copy, api_key=api_key))
                 else:
                     # 如果是同步函數，直接調用
                     print("檢測到 run_mcp_feedback 是同步函數，直接調用")
-                    result = run_mcp_feedback(selected_personas, marketing_copy)
+                    result = run_mcp_feedback(selected_personas, marketing_copy, api_key=api_key, use_cache=use_cache)
                 
                 print(f"評估成功，結果類型: {type(result)}")
-                
-                # 解析結果
-                if isinstance(result, tuple) and len(result) == 3:
-                    feedbacks, avg_score, chart_img = result
-                else:
-                    feedbacks = result
-                    # 計算平均分數
-                    avg_score = 0
-                    if feedbacks and len(feedbacks) > 0:
-                        avg_score = sum(item.get('score', 0) for item in feedbacks) / len(feedbacks)
-                    # 生成圖表
-                    chart_img = generate_chart(feedbacks, avg_score)
-                
-                return jsonify({
-                    'success': True,
-                    'feedback': feedbacks,
-                    'avg_score': avg_score,
-                    'chart': chart_img
-                })
+                feedbacks, avg_score, spec = result
+                return jsonify(feedback_result(feedbacks, avg_score, spec, chart_format))
             
             except Exception as e:
                 print(f"評估函數執行錯誤: {e}")
@@ -461,74 +644,17 @@ def handle_feedback():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
     
-def generate_score_chart(feedback_data, avg_score):
-    """生成評分圖表，返回 base64 編碼的圖片"""
-    if not feedback_data:
-        return ""
-    
-    # 準備繪圖資料
-    labels = [f"Persona {item['persona_id']}" for item in feedback_data]
-    scores = [item['score'] for item in feedback_data]
-    
-    # 使用新的顏色方案
-    colors = []
-    for s in scores:
-        if s >= 8:
-            colors.append('#E36E6C')  # 高分使用紅色系
-        elif s >= 6:
-            colors.append('#4E374C')  # 中高分使用深色系
-        elif s >= 4:
-            colors.append('#F7C375')  # 中低分使用橙色系
-        else:
-            colors.append('#E9DCCB')  # 低分使用淺色系
-    
-    # 創建長條圖
-    fig = go.Figure(go.Bar(
-        x=labels,
-        y=scores,
-        marker_color=colors,
-        text=scores,
-        textposition='auto',
-    ))
-    
-    # 添加平均線
-    fig.add_shape(
-        type="line",
-        x0=-0.5,
-        x1=len(labels) - 0.5,
-        y0=avg_score,
-        y1=avg_score,
-        line=dict(color="#4E374C", width=2, dash="dash"),
-    )
-    
-    # 添加註解
-    fig.add_annotation(
-        x=len(labels) - 1,
-        y=avg_score,
-        text=f"平均: {avg_score:.1f}",
-        showarrow=True,
-        arrowhead=1,
-        bgcolor="#E9DCCB",
-        bordercolor="#4E374C",
-        borderwidth=1,
-    )
-    
-    # 配置圖表
-    fig.update_layout(
-        title="各 Persona 購買意願評分",
-        yaxis_title="評分 (1-10)",
-        yaxis_range=[0, 10],
-        template="plotly_white",
-    )
-    
-    # 轉為 base64 字串
-    img_bytes = fig.to_image(format="png", width=800, height=400)
-    return base64.b64encode(img_bytes).decode('utf-8')
-
 @app.route('/download/<path:filename>', methods=['GET'])
 def download_file(filename):
     try:
         file_path = os.path.join(app.config['OUTPUT_FOLDER'], filename)
+        # 對話紀錄以壓縮 JSONL 保存，下載 CSV 時才即時匯出
+        log_path = find_log_for_export(app.config['OUTPUT_FOLDER'], filename)
+        if log_path and not os.path.exists(file_path):
+            response = Response(stream_with_context(iter_csv_export(log_path)), mimetype='text/csv')
+            response.headers['Content-Disposition'] = f'attachment; filename="{os.path.basename(filename)}"'
+            response.headers['X-File-Expires'] = str(app.config['FILE_RETENTION_HOURS']) + ' hours'
+            return response
         if os.path.exists(file_path):
             # 添加檔案即將過期的警告到回應標頭
             response = send_file(file_path, as_attachment=True)
@@ -542,59 +668,32 @@ def download_file(filename):
 
 @app.route('/load-personas', methods=['GET'])
 def load_saved_personas():
+    """列出已生成的 personas
+
+    支援 limit / cursor 分頁與 source、q 過濾；未帶 limit 時回傳全部（與舊版相同）。
+    回應帶有 ETag，persona 檔案未變更時瀏覽器重新載入會得到 304。
+    """
     try:
-        # 嘗試取得 API Key（如果有）
-        api_key = request.args.get('api_key', '')
-        if api_key:
-            os.environ["Gemini_api"] = api_key
-        
-        base_dir = os.path.join(app.config['OUTPUT_FOLDER'], "personas")
-        personas = []
-        all_personas = []  # 用於記錄所有載入的 personas
-        filtered_personas = []  # 用於記錄過濾後的 personas
-        
-        # 列出所有可能的類型
-        persona_types = ["csv", "csv2", "md"]
-        
-        for source in persona_types:
-            json_path = os.path.join(base_dir, f"{source}_personas.json")
-            print(f"嘗試載入: {json_path}")
-            
-            if os.path.exists(json_path):
-                try:
-                    with open(json_path, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        print(f"原始從 {json_path} 載入 {len(data)} 個 personas")
-                        all_personas.extend(data)
-                        
-                        # 過濾掉沒有 description 的
-                        valid_data = [p for p in data if p.get('description')]
-                        filtered_personas.extend(valid_data)
-                        print(f"過濾後從 {json_path} 載入 {len(valid_data)} 個有效 personas")
-                        personas.extend(valid_data)
-                except Exception as e:
-                    print(f"載入 {json_path} 時出錯: {e}")
-            else:
-                print(f"檔案 {json_path} 不存在")
-
-        # 檢查是否有重複的 ID
-        ids = [p.get('persona_id') for p in personas]
-        unique_ids = set(ids)
-        if len(ids) != len(unique_ids):
-            print(f"警告：有 {len(ids) - len(unique_ids)} 個重複的 persona ID")
-            duplicate_ids = [id for id in ids if ids.count(id) > 1]
-            print(f"重複的 ID: {duplicate_ids}")
-            
-            # 移除重複的 personas，保留最後一個
-            unique_personas = {}
-            for p in personas:
-                unique_personas[p.get('persona_id')] = p
-            personas = list(unique_personas.values())
-
-        personas.sort(key=lambda p: str(p.get('persona_id', '')))
-        print(f"總共載入 {len(all_personas)} 個原始 personas，過濾後 {len(filtered_personas)} 個，去重後 {len(personas)} 個")
-        
-        return jsonify({'personas': personas})
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit <= 0:
+            return jsonify({'error': 'limit 必須大於 0'}), 400
+        cursor = request.args.get('cursor') or None
+        source = request.args.get('source') or None
+        query = request.args.get('q') or None
+
+        version, personas, next_cursor, total = persona_catalog.page(
+            cursor=cursor, limit=limit, source=source, query=query
+        )
+
+        # ETag 由檔案版本與查詢條件組成
+        etag = hashlib.sha1(repr((version, cursor, limit, source, query)).encode('utf-8')).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify({'personas': personas, 'next_cursor': next_cursor, 'total': total})
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
 
     except Exception as e:
         print(f"載入Persona失敗: {e}")
@@ -657,6 +756,9 @@ def get_status():
     })
 
 
+# 清理時略過的 SQLite 檔案（含交易日誌）
+SQLITE_SUFFIXES = ('.db', '.db-journal', '.db-wal', '.db-shm')
+
 # 檔案清理函數
 def cleanup_old_files():
     """定期清理舊檔案"""
@@ -670,6 +772,9 @@ def cleanup_old_files():
                 if os.path.exists(folder):
                     for filename in os.listdir(folder):
                         filepath = os.path.join(folder, filename)
+                        # SQLite 資料庫（限流狀態、persona store）由其他連線持續使用，不能依修改時間刪除
+                        if filename.endswith(SQLITE_SUFFIXES):
+                            continue
                         if os.path.isfile(filepath):
                             file_age = current_time - os.path.getmtime(filepath)
                             if file_age > retention_seconds:
@@ -679,11 +784,12 @@ def cleanup_old_files():
                                 except Exception as e:
                                     print(f"刪除檔案失敗 {filepath}: {e}")
             
-            # 清理 personas 子資料夾
-            personas_dir = os.path.join(app.config['OUTPUT_FOLDER'], "personas")
-            if os.path.exists(personas_dir):
-                for subfolder in os.listdir(personas_dir):
-                    subfolder_path = os.path.join(personas_dir, subfolder)
+            # 清理 personas 子資料夾與每個上傳請求的子資料夾
+            for parent in [os.path.join(app.config['OUTPUT_FOLDER'], "personas"), app.config['UPLOAD_FOLDER']]:
+                if not os.path.exists(parent):
+                    continue
+                for subfolder in os.listdir(parent):
+                    subfolder_path = os.path.join(parent, subfolder)
                     if os.path.isdir(subfolder_path):
                         # 檢查資料夾修改時間
                         folder_age = current_time - os.path.getmtime(subfolder_path)
@@ -704,6 +810,9 @@ def cleanup_old_files():
 cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
 cleanup_thread.start()
 
+# 啟動時載入 tokenizer，請求中計算 token 數時不必等待載入
+load_encoder()
+
 # 添加系統狀態端點
 @app.route('/system-status', methods=['GET'])
 def system_status():
@@ -719,6 +828,14 @@ def system_status():
         'file_retention_hours': app.config['FILE_RETENTION_HOURS'],
         'upload_files_count': upload_files,
         'output_files_count': output_files,
+        'response_cache': get_response_cache().stats(),
+        'feedback_cache': get_feedback_cache().stats(),
+        'chart_renderer': get_chart_renderer().stats(),
+        'gemini_clients': get_client_pool().stats(),
+        'llm_executor': get_llm_executor().stats(),
+        'jobs': get_job_manager().stats(),
+        'streams': get_stream_registry().stats(),
+        'persona_store': get_persona_store().stats(),
         'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     })
 
@@ -0,0 +1,56 @@
+# artifact_writer.py
+import io
+import os
+import json
+import zipfile
+import tempfile
+
+
+def dumps_compact(obj):
+    """輸出精簡 JSON（UTF-8 bytes，不縮排）"""
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def atomic_write(path, data):
+    """先寫入同目錄的暫存檔再 rename，讀取者只會看到舊檔或完整的新檔"""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def persona_filename(persona):
+    return f"PERSONA-{persona['persona_id']}.json"
+
+
+def write_persona_artifacts(personas, aggregate_path, zip_path, persona_dir=None):
+    """一次輸出本次產生的 persona 成品
+
+    每個 persona 只序列化一次，同一份內容寫入個別檔案（persona_dir 不為 None 時）與記憶體中的 zip；
+    zip 只包含本次的 personas，不會打包資料夾中先前留下的檔案。所有檔案都以 atomic_write 寫入。
+    """
+    buffer = io.BytesIO()
+    seen = {}
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for persona in personas:
+            name = persona_filename(persona)
+            data = dumps_compact(persona)
+            if persona_dir is not None:
+                atomic_write(os.path.join(persona_dir, name), data)
+            # 合併多個來源時 persona_id 可能重複，zip 內的檔名加上序號避免覆蓋
+            seen[name] = seen.get(name, 0) + 1
+            if seen[name] > 1:
+                name = f"{name[:-len('.json')]}-{seen[name]}.json"
+            zipf.writestr(name, data)
+    atomic_write(aggregate_path, dumps_compact(personas))
+    atomic_write(zip_path, buffer.getvalue())
+    print(f"保存 {len(personas)} 個 personas 到 {persona_dir or aggregate_path}，壓縮到 {zip_path}")
@@ -0,0 +1,90 @@
+# bench_ingest_memory.py
+"""比較舊的整檔讀取與串流分批讀取在 50MB 問卷上的記憶體峰值
+
+使用方式：
+    python benchmarks/bench_ingest_memory.py [目標大小MB]
+
+每種模式都在獨立的子行程中執行，分別回報 tracemalloc 峰值與行程的最大 RSS。
+"""
+import os
+import sys
+import csv
+import random
+import resource
+import tempfile
+import tracemalloc
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BATCH_SIZE = 15000
+ANSWERS = [
+    "希望能學到實用的資料分析技巧，並應用在工作上",
+    "時間不夠，常常下班後很累沒有辦法專心上課",
+    "偏好有實作練習的線上課程，可以自己安排進度",
+    "想轉職成為軟體工程師，需要系統性的學習路徑",
+    "Looking for hands-on projects and mentor feedback",
+]
+
+
+def make_survey(path, target_mb):
+    """產生指定大小的合成問卷 CSV"""
+    rng = random.Random(42)
+    target = target_mb * 1024 * 1024
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["受訪者", "年齡", "職業", "學習動機", "遇到的困難", "偏好的學習方式", "其他意見"])
+        i = 0
+        while f.tell() < target:
+            i += 1
+            writer.writerow([
+                f"R{i:07d}", rng.randint(18, 65), rng.choice(["學生", "工程師", "設計師", "行銷", "教師"]),
+                rng.choice(ANSWERS), rng.choice(ANSWERS), rng.choice(ANSWERS),
+                "".join(rng.choice(ANSWERS) for _ in range(rng.randint(0, 2))),
+            ])
+
+
+def run_legacy(path):
+    """舊流程：整檔 read_csv → to_string → 依字元切片"""
+    import pandas as pd
+    df = pd.read_csv(path, encoding='utf-8')
+    full_text = df.to_string(index=False)
+    chunks = [full_text[i:i + BATCH_SIZE] for i in range(0, len(full_text), BATCH_SIZE)]
+    return len(chunks)
+
+
+def run_streaming(path):
+    """新流程：分段讀取並逐批產生，批次用完即丟"""
+    from survey_ingest import iter_csv_chunks
+    count = 0
+    for _ in iter_csv_chunks(path, BATCH_SIZE, encoding='utf-8'):
+        count += 1
+    return count
+
+
+def measure(mode, path):
+    tracemalloc.start()
+    chunks = {"legacy": run_legacy, "streaming": run_streaming}[mode](path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux 上單位為 KB
+    print(f"{mode:<10} 批次數 {chunks:>6}  tracemalloc 峰值 {peak / 1024 / 1024:8.1f} MB  最大 RSS {max_rss:8.1f} MB")
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        measure(sys.argv[2], sys.argv[3])
+        return
+
+    target_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "survey.csv")
+        make_survey(path, target_mb)
+        print(f"合成問卷大小：{os.path.getsize(path) / 1024 / 1024:.1f} MB")
+        for mode in ("legacy", "streaming"):
+            subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", mode, path], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# cancellation.py
+import asyncio
+import threading
+
+
+class OperationCancelled(Exception):
+    """工作已被取消（例如 SSE 用戶端已斷線），partial 為取消前已完成的部分結果"""
+
+    def __init__(self, message="工作已取消", partial=None):
+        super().__init__(message)
+        self.partial = partial
+
+
+class CancelToken:
+    """跨執行緒的取消旗標
+
+    cancel() 可以從任何執行緒呼叫（例如 SSE 回應結束時），註冊的 callback 會立即執行；
+    工作端可以把取消前已完成的結果放在 partial，供呼叫端選擇是否保存。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self.reason = None
+        self.partial = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason=None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+        print(f"取消工作: {reason or '未提供原因'}")
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"執行取消 callback 時出錯: {e}")
+
+    def add_callback(self, callback):
+        """註冊取消時要執行的 callback，已取消則立即執行；回傳取消註冊的函式"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove_callback(callback)
+        callback()
+        return lambda: None
+
+    def _remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def run_cancellable(coro, cancel_token=None):
+    """以 asyncio.run 執行 coro；cancel_token 被取消時取消整個 task
+
+    等待中的 LLM 呼叫（尚未開始的會從執行緒池佇列移除）、限流等待與 sleep 都會立即結束，
+    最後拋出帶有 cancel_token.partial 的 OperationCancelled。
+    """
+    if cancel_token is None:
+        return asyncio.run(coro)
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+
+        def cancel_task():
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                pass  # 事件迴圈已結束
+
+        remove = cancel_token.add_callback(cancel_task)
+        try:
+            return await coro
+        finally:
+            remove()
+
+    try:
+        return asyncio.run(main())
+    except asyncio.CancelledError:
+        if not cancel_token.cancelled:
+            raise
+        raise OperationCancelled(cancel_token.reason or "工作已取消", partial=cancel_token.partial)
@@ -0,0 +1,193 @@
+# chart_render.py
+import io
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", 64))   # 保留的已繪製圖表數
+CHART_RENDER_TIMEOUT = int(os.getenv("CHART_RENDER_TIMEOUT", 30))
+CHART_FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+CHART_TITLE = "各 Persona 購買意願評分"
+CHART_Y_TITLE = "評分 (1-10)"
+CHART_AVG_LABEL = "平均"
+AVG_LINE_COLOR = '#4E374C'
+# 系統上的中文字型依序嘗試，之後接內附的字型子集（只含 ASCII 與上面固定標題用到的字）
+CJK_FONTS = ['Noto Sans CJK TC', 'Noto Sans TC', 'Microsoft JhengHei', 'PingFang TC', 'Arial Unicode MS']
+CHART_FONT_PATH = os.getenv("CHART_FONT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            "fonts", "NotoSansCJKsc-ChartSubset.otf"))
+# 連內附字型都無法載入時改用英文標題，避免中文顯示成方塊
+ASCII_LABELS = {'title': "Purchase intent by persona", 'y_title': "Score (1-10)", 'avg': "Avg"}
+
+
+def score_color(score):
+    if score >= 8:
+        return '#E36E6C'  # 高分使用紅色系
+    if score >= 6:
+        return '#4E374C'  # 中高分使用深色系
+    if score >= 4:
+        return '#F7C375'  # 中低分使用橙色系
+    return '#E9DCCB'      # 低分使用淺色系
+
+
+def chart_spec(feedback_data, avg_score):
+    """評分圖表的資料規格，由前端以 Plotly 繪製；沒有資料時回傳 None"""
+    if not feedback_data:
+        return None
+    # 排序 feedback_data 以確保顯示順序一致
+    feedback_data = sorted(feedback_data, key=lambda x: str(x['persona_id']))
+    scores = [item['score'] for item in feedback_data]
+    return {
+        'title': CHART_TITLE,
+        'y_title': CHART_Y_TITLE,
+        'y_range': [0, 10],
+        'labels': [f"Persona {item['persona_id']}" for item in feedback_data],
+        'scores': scores,
+        'colors': [score_color(s) for s in scores],
+        'avg_score': avg_score,
+    }
+
+
+def chart_key(spec, fmt):
+    """以標籤、分數向量與平均分數的雜湊加上副檔名作為快取鍵，例如 3f2a...c9.png"""
+    payload = json.dumps([spec['labels'], spec['scores'], spec['avg_score']], ensure_ascii=False)
+    return f"{hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]}.{fmt}"
+
+
+_cjk_fonts = None
+
+
+def _setup_fonts():
+    """註冊內附字型並把可用的中文字型排在 font.sans-serif 最前面，回傳可用的中文字型清單
+
+    只在繪圖執行緒中呼叫，結果保留到行程結束。
+    """
+    global _cjk_fonts
+    if _cjk_fonts is not None:
+        return _cjk_fonts
+    import matplotlib
+    from matplotlib import font_manager
+
+    fonts = []
+    for name in CJK_FONTS:
+        try:
+            font_manager.findfont(name, fallback_to_default=False)
+        except ValueError:
+            continue
+        fonts.append(name)
+    try:
+        font_manager.fontManager.addfont(CHART_FONT_PATH)
+        fonts.append(font_manager.FontProperties(fname=CHART_FONT_PATH).get_name())
+    except Exception as e:
+        print(f"無法載入內附的中文字型 {CHART_FONT_PATH}: {e}")
+    if fonts:
+        print(f"圖表使用中文字型: {', '.join(fonts)}")
+    else:
+        print("警告: 找不到可用的中文字型，圖表改用英文標題")
+
+    matplotlib.rcParams['font.sans-serif'] = fonts + [
+        f for f in matplotlib.rcParams['font.sans-serif'] if f not in fonts
+    ]
+    matplotlib.rcParams['axes.unicode_minus'] = False
+    _cjk_fonts = fonts
+    return fonts
+
+
+def _render(spec, fmt):
+    """以 matplotlib（Agg）繪製長條圖與平均線，回傳圖檔 bytes"""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+
+    if _setup_fonts():
+        title, y_title, avg_label = spec['title'], spec['y_title'], CHART_AVG_LABEL
+    else:
+        title, y_title, avg_label = ASCII_LABELS['title'], ASCII_LABELS['y_title'], ASCII_LABELS['avg']
+
+    labels = spec['labels']
+    scores = spec['scores']
+    avg_score = spec['avg_score']
+    fig = Figure(figsize=(8, 5), dpi=100)
+    ax = fig.add_subplot(1, 1, 1)
+    bars = ax.bar(range(len(labels)), scores, color=spec['colors'])
+    ax.bar_label(bars, labels=[str(s) for s in scores])
+    ax.axhline(avg_score, color=AVG_LINE_COLOR, linewidth=2, linestyle='--')
+    ax.annotate(f"{avg_label}: {avg_score:.1f}", xy=(len(labels) - 1, avg_score), xytext=(0, 12),
+                textcoords='offset points', ha='center',
+                bbox=dict(boxstyle='round', fc='#E9DCCB', ec=AVG_LINE_COLOR))
+    ax.set_title(title)
+    ax.set_ylabel(y_title)
+    ax.set_ylim(*spec['y_range'])
+    ax.set_xticks(range(len(labels)))
+    ax.set_xticklabels(labels, rotation=45, ha='right')
+    fig.tight_layout()
+
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+class ChartRenderer:
+    """在專用執行緒上繪製評分圖表，結果依分數向量的雜湊快取
+
+    matplotlib 不是執行緒安全的，因此只用一個工作執行緒依序繪製；
+    快取保存 Future，同一張圖在繪製中再次請求時會共用同一個結果。
+    """
+
+    def __init__(self, max_entries=CHART_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='chart-render')
+        self._futures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, spec, fmt='png'):
+        """排入繪製（已快取則略過），回傳快取鍵"""
+        if fmt not in CHART_FORMATS:
+            raise ValueError(f"不支援的圖表格式: {fmt}")
+        key = chart_key(spec, fmt)
+        with self._lock:
+            if key in self._futures:
+                self._futures.move_to_end(key)
+            else:
+                self._futures[key] = self._executor.submit(_render, spec, fmt)
+                while len(self._futures) > self.max_entries:
+                    self._futures.popitem(last=False)
+        return key
+
+    def result(self, key, timeout=CHART_RENDER_TIMEOUT):
+        """等待繪製完成，回傳圖檔 bytes；找不到（已被淘汰或從未排入）時回傳 None"""
+        with self._lock:
+            future = self._futures.get(key)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except Exception:
+            # 繪製失敗不保留在快取中，下次請求重新繪製
+            with self._lock:
+                if self._futures.get(key) is future and future.done():
+                    del self._futures[key]
+            raise
+
+    def render(self, spec, fmt='png', timeout=CHART_RENDER_TIMEOUT):
+        return self.result(self.submit(spec, fmt), timeout)
+
+    def stats(self):
+        with self._lock:
+            return {'cached': len(self._futures), 'max_entries': self.max_entries}
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_chart_renderer():
+    """取得行程內共用的圖表繪製器"""
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = ChartRenderer()
+        return _renderer
@@ -0,0 +1,126 @@
+# conversation_log.py
+import io
+import os
+import csv
+import gzip
+import json
+import time
+import uuid
+import hashlib
+import threading
+
+LOG_SUFFIX = "_conve_log.jsonl.gz"
+EXPORT_SUFFIX = "_conve_log.csv"
+# prompt 範本中代表輸入資料（批次或整份問卷內容）的位置，匯出時以 body 紀錄的內容替換
+BODY_PLACEHOLDER = "\x00body\x00"
+
+
+def log_path(output_folder, prefix, run_id):
+    return os.path.join(output_folder, f"all_{prefix}_{run_id}{LOG_SUFFIX}")
+
+
+def export_name(prefix, run_id):
+    """對外提供下載的 CSV 檔名（實際內容在下載時才由壓縮紀錄匯出）"""
+    return f"all_{prefix}_{run_id}{EXPORT_SUFFIX}"
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8', errors='replace')).hexdigest()
+
+
+class ConversationLog:
+    """只追加的 gzip JSONL 對話紀錄
+
+    每個批次完成時追加一段 gzip member，不需要等全部完成也不建立 DataFrame。
+    每次處理流程使用各自的 run_id 作為檔名，同時進行的流程不會互相覆蓋或交錯寫入。
+    prompt 與輸入資料分開以內容雜湊（sha256）儲存：輸入資料（body）與去除輸入後的範本
+    各只出現一次，對話紀錄只記錄雜湊值，因此紀錄大小不會因 prompt 內含整份資料而倍增。
+    """
+
+    def __init__(self, path, export_name=None):
+        self.path = path
+        self.export_name = export_name or os.path.basename(path)
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def start(cls, output_folder, prefix):
+        """開始一次新的處理流程，紀錄檔名帶有本次的 run_id"""
+        run_id = uuid.uuid4().hex[:12]
+        os.makedirs(output_folder, exist_ok=True)
+        return cls(log_path(output_folder, prefix, run_id), export_name(prefix, run_id))
+
+    def _store(self, records, kind, text):
+        """內容第一次出現時加入 kind 紀錄，回傳其雜湊值"""
+        digest = _sha256(text)
+        if (kind, digest) not in self._seen:
+            self._seen.add((kind, digest))
+            records.append({'type': kind, 'sha256': digest, 'text': text})
+        return digest
+
+    def append(self, messages, body=None, **meta):
+        """追加一組對話（_generate_personas 回傳的 messages），meta 例如 chunk、stage
+
+        body 是組成 prompt 的輸入資料；prompt 含有 body 時只記錄範本與 body 的雜湊。
+        """
+        records = []
+        with self._lock:
+            for message in messages:
+                record = {'type': 'message', 'role': message.get('role'), 'ts': time.time()}
+                record.update(meta)
+                content = message.get('content') or ""
+                if message.get('role') == 'user':
+                    if body and body in content:
+                        record['body_sha256'] = self._store(records, 'body', body)
+                        content = content.replace(body, BODY_PLACEHOLDER, 1)
+                    record['prompt_sha256'] = self._store(records, 'prompt', content)
+                else:
+                    record['content'] = content
+                records.append(record)
+            if not records:
+                return
+            # 整段壓縮後以單次寫入追加一個完整的 gzip member
+            data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+            member = gzip.compress(data.encode('utf-8'))
+            with open(self.path, 'ab') as f:
+                f.write(member)
+
+
+def iter_records(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def find_log_for_export(output_folder, filename):
+    """下載的檔名是 all_*_conve_log.csv 時，回傳對應的壓縮紀錄路徑，否則回傳 None"""
+    if not filename.endswith(EXPORT_SUFFIX) or os.path.dirname(filename):
+        return None
+    path = os.path.join(output_folder, filename[:-len(EXPORT_SUFFIX)] + LOG_SUFFIX)
+    return path if os.path.exists(path) else None
+
+
+def iter_csv_export(path):
+    """將壓縮紀錄匯出為與舊版相同欄位（content, role）的 CSV，逐列產生文字供串流下載"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('﻿')  # 與 utf-8-sig 相同，讓 Excel 正確判斷編碼
+    writer.writerow(['content', 'role'])
+    stored = {'prompt': {}, 'body': {}}
+    for record in iter_records(path):
+        if record.get('type') in stored:
+            stored[record['type']][record['sha256']] = record['text']
+            continue
+        if 'prompt_sha256' in record:
+            content = stored['prompt'].get(record['prompt_sha256'], "")
+            if 'body_sha256' in record:
+                content = content.replace(BODY_PLACEHOLDER, stored['body'].get(record['body_sha256'], ""), 1)
+        else:
+            content = record.get('content', "")
+        writer.writerow([content, record.get('role')])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()
@@ -0,0 +1,132 @@
+# gemini_pool.py
+import os
+import time
+import threading
+from contextlib import contextmanager
+import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.generativeai.types import generation_types
+from google.api_core import client_options as client_options_lib
+
+CLIENT_IDLE_TTL = int(os.getenv("GEMINI_CLIENT_IDLE_TTL", 600))  # 閒置多久後釋放連線（秒）
+
+
+# 目前安裝的 SDK 版本是否支援 JSON 模式（response_mime_type / response_schema）
+_GENERATION_CONFIG_FIELDS = set(glm.GenerationConfig.meta.fields)
+SUPPORTS_JSON_MODE = 'response_mime_type' in _GENERATION_CONFIG_FIELDS
+SUPPORTS_RESPONSE_SCHEMA = 'response_schema' in _GENERATION_CONFIG_FIELDS
+
+
+def json_mode_options(schema=None):
+    """要求模型直接輸出符合 schema 的 JSON 時傳給 generate_content 的參數
+
+    SDK 不支援 JSON 模式時回傳空 dict，此時仍依賴 prompt 中的格式說明與 json_extract 解析。
+    """
+    if not SUPPORTS_JSON_MODE:
+        return {}
+    config = {'response_mime_type': 'application/json'}
+    if schema is not None and SUPPORTS_RESPONSE_SCHEMA:
+        config['response_schema'] = schema
+    return {'generation_config': config}
+
+
+class _PoolEntry:
+    def __init__(self, api_key):
+        # 每把 API Key 使用自己的 client 與 gRPC 連線，不經過 genai.configure 的全域狀態
+        self.client = glm.GenerativeServiceClient(
+            client_options=client_options_lib.ClientOptions(api_key=api_key)
+        )
+        self.models = {}
+        self.active = 0
+        self.last_used = time.monotonic()
+
+    def model(self, model_name):
+        model = self.models.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(model_name)
+            # GenerativeModel 在 _client 為 None 時才會取用全域預設 client，
+            # 預先指定即可讓模型固定使用這把 key 的連線
+            model._client = self.client
+            self.models[model_name] = model
+        return model
+
+    def close(self):
+        try:
+            self.client.transport.close()
+        except Exception as e:
+            print(f"關閉 Gemini 連線時出錯: {e}")
+
+
+class GeminiClientPool:
+    """以 API Key 為單位保存可重複使用的 Gemini client 與模型物件
+
+    借出期間（model() context manager 內）不會被回收；
+    閒置超過 idle_ttl 的項目會在下一次存取時關閉連線並移除。
+    """
+
+    def __init__(self, idle_ttl=CLIENT_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    def _evict_idle(self, now):
+        expired = [
+            key for key, entry in self._entries.items()
+            if entry.active == 0 and now - entry.last_used > self.idle_ttl
+        ]
+        for key in expired:
+            self._entries.pop(key).close()
+            self.evicted += 1
+
+    @contextmanager
+    def model(self, api_key, model_name):
+        """借出指定 API Key 與模型名稱的 GenerativeModel"""
+        if not api_key:
+            raise ValueError("缺少 Google API Key")
+        with self._lock:
+            now = time.monotonic()
+            self._evict_idle(now)
+            entry = self._entries.get(api_key)
+            if entry is None:
+                entry = _PoolEntry(api_key)
+                self._entries[api_key] = entry
+                self.created += 1
+            entry.active += 1
+            entry.last_used = now
+            model = entry.model(model_name)
+        try:
+            yield model
+        finally:
+            with self._lock:
+                entry.active -= 1
+                entry.last_used = time.monotonic()
+
+    def generate_content(self, api_key, model_name, contents, timeout=None, **kwargs):
+        """以指定 key 的連線呼叫 generate_content
+
+        timeout 會作為 gRPC deadline 傳給底層 client，逾時時請求本身即被中止
+        （拋出 DeadlineExceeded），不會在背景繼續佔用連線。
+        """
+        with self.model(api_key, model_name) as model:
+            request = model._prepare_request(contents=contents, **kwargs)
+            response = model._client.generate_content(request, timeout=timeout)
+        return generation_types.GenerateContentResponse.from_response(response)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'clients': len(self._entries),
+                'active_calls': sum(entry.active for entry in self._entries.values()),
+                'created': self.created,
+                'evicted': self.evicted,
+            }
+
+
+_pool = GeminiClientPool()
+
+
+def get_client_pool():
+    """取得行程內共用的 client pool"""
+    return _pool
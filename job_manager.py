@@ -0,0 +1,148 @@
+# job_manager.py
+import os
+import time
+import uuid
+import asyncio
+import threading
+import traceback
+
+JOB_MAX_CONCURRENT = int(os.getenv("JOB_MAX_CONCURRENT", 2))   # 同時執行的工作數上限
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", 3 * 3600))
+
+
+class Job:
+    """單一背景工作的狀態"""
+
+    def __init__(self, kind, meta=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.meta = meta or {}
+        self.status = 'queued'       # queued / running / succeeded / failed
+        self.stage = 'queued'
+        self.progress = {'completed_chunks': 0, 'total_chunks': None, 'persona_count': 0}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    def to_dict(self, include_result=False):
+        data = {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': dict(self.progress),
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+        if self.result is not None:
+            # 狀態查詢只回傳輸出路徑等摘要，完整 personas 由 result 端點提供
+            if include_result:
+                data['result'] = self.result
+            else:
+                data['outputs'] = {k: v for k, v in self.result.items() if k != 'personas'}
+        return data
+
+
+class JobManager:
+    """在常駐的事件迴圈上執行 persona 生成協程
+
+    Web 請求只負責送出工作並取得 job_id，實際的 LLM 呼叫在背景執行緒的事件迴圈中進行，
+    同時執行的工作數由 JOB_MAX_CONCURRENT 限制。所有工作共用同一個事件迴圈，協程中的讀檔、
+    tokenize、寫檔等同步工作都以 asyncio.to_thread 執行，避免一個工作卡住其他工作。工作狀態保存在行程記憶體中
+    （部署為單一 gunicorn worker），完成超過 JOB_RETENTION_SECONDS 的工作會被清除。
+    """
+
+    def __init__(self, max_concurrent=JOB_MAX_CONCURRENT):
+        self.max_concurrent = max_concurrent
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._semaphore = None
+        self._started = threading.Event()
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._run_loop, name="job-loop", daemon=True).start()
+        self._started.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._started.set()
+        self._loop.run_forever()
+
+    def _update(self, job, **fields):
+        with self._lock:
+            for key, value in fields.items():
+                setattr(job, key, value)
+            job.updated_at = time.time()
+
+    def _on_progress(self, job, event):
+        """將 mcp_persona 的進度事件記錄到工作狀態"""
+        with self._lock:
+            job.stage = event.get('stage', job.stage)
+            if event.get('total'):
+                job.progress['total_chunks'] = event['total']
+            # 只有問卷批次計入進度；mapreduce 彙整階段的事件只更新 stage
+            if job.stage == 'generating':
+                if 'completed' in event:
+                    job.progress['completed_chunks'] = event['completed']
+                if event.get('personas'):
+                    job.progress['persona_count'] += len(event['personas'])
+            job.updated_at = time.time()
+
+    async def _execute(self, job, coro_factory):
+        async with self._semaphore:
+            self._update(job, status='running', stage='starting')
+            try:
+                result = await coro_factory(lambda event: self._on_progress(job, event))
+                self._update(job, status='succeeded', stage='done', result=result)
+            except Exception as e:
+                traceback.print_exc()
+                self._update(job, status='failed', stage='failed', error=str(e))
+
+    def submit(self, kind, coro_factory, meta=None):
+        """送出工作並立即回傳 Job
+
+        coro_factory(progress_callback) 需回傳一個協程，其結果（dict）即為工作結果。
+        """
+        self._ensure_loop()
+        self._prune()
+        job = Job(kind, meta)
+        with self._lock:
+            self._jobs[job.id] = job
+        asyncio.run_coroutine_threadsafe(self._execute(job, coro_factory), self._loop)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.status in ('succeeded', 'failed') and job.updated_at < cutoff
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return counts
+
+
+_manager = JobManager()
+
+
+def get_job_manager():
+    """取得行程內共用的工作管理器"""
+    return _manager
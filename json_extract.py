@@ -0,0 +1,121 @@
+# json_extract.py
+import re
+import json
+
+_CLOSERS = {'{': '}', '[': ']'}
+_TRAILING_COMMA_RE = re.compile(r",(\s*[}\]])")
+_OPENER_RE = re.compile(r"[{\[]")
+MAX_REPAIR_ATTEMPTS = 64   # 截斷的 JSON 最多嘗試幾個切點
+
+
+def _loads(text):
+    """json.loads，失敗時再試一次移除結尾多餘逗號的版本"""
+    try:
+        return json.loads(text)
+    except ValueError:
+        fixed = _TRAILING_COMMA_RE.sub(r"\1", text)
+        if fixed == text:
+            raise
+        return json.loads(fixed)
+
+
+def _repair_partial(text, cut_points, stack, in_string):
+    """補齊被截斷的 JSON：先直接補上引號與括號，不行再依序退回到較早的完整元素"""
+    candidates = [(text + ('"' if in_string else ''), stack)]
+    candidates.extend(reversed(cut_points[-MAX_REPAIR_ATTEMPTS:]))
+    for end, open_brackets in candidates:
+        body = text[:end] if isinstance(end, int) else end
+        closing = "".join(_CLOSERS[b] for b in reversed(open_brackets))
+        try:
+            return _loads(body.rstrip().rstrip(',') + closing)
+        except ValueError:
+            continue
+    return None
+
+
+def _scan_value(text, start):
+    """從 text[start] 的 { 或 [ 開始掃描一個頂層 JSON 值，回傳 (value, end)
+
+    括號不成對或無法解析時回傳 None，由呼叫端從下一個字元重新尋找；
+    文字在值結束前就截斷時，補齊括號並捨棄不完整的元素。
+    """
+    stack = [text[start]]
+    cut_points = []
+    in_string = False
+    escape = False
+    for i in range(start + 1, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(ch)
+        elif ch in '}]':
+            if _CLOSERS[stack[-1]] != ch:
+                return None
+            stack.pop()
+            if not stack:
+                try:
+                    return _loads(text[start:i + 1]), i + 1
+                except ValueError:
+                    return None
+            cut_points.append((i + 1 - start, tuple(stack)))
+        elif ch == ',':
+            cut_points.append((i - start, tuple(stack)))
+
+    partial = _repair_partial(text[start:], cut_points, stack, in_string)
+    return None if partial is None else (partial, len(text))
+
+
+def extract_json_values(text):
+    """掃描文字，回傳其中所有頂層的 JSON 物件或陣列
+
+    可以處理前後夾雜說明文字、```json 區塊、多個區塊並列與結尾多餘逗號；
+    說明文字中不成對的 [ 或 { 無法解析時，從它的下一個字元重新尋找。
+    回應被截斷時，最後一個值會補齊括號並捨棄不完整的元素，盡量保留已完整的部分。
+    """
+    if not text:
+        return []
+    stripped = text.strip()
+    if stripped[:1] in ('{', '['):
+        # JSON 模式的回應通常整段就是合法 JSON
+        try:
+            return [json.loads(stripped)]
+        except ValueError:
+            pass
+
+    values = []
+    pos = 0
+    while True:
+        match = _OPENER_RE.search(text, pos)
+        if match is None:
+            return values
+        found = _scan_value(text, match.start())
+        if found is None:
+            pos = match.start() + 1
+            continue
+        value, pos = found
+        values.append(value)
+
+
+def extract_objects(text):
+    """取出回應中所有 JSON 物件，陣列會展開；{"personas": [...]} 這類包裝也會展開"""
+    objects = []
+    for value in extract_json_values(text):
+        if isinstance(value, dict):
+            wrapped = [v for v in value.values() if isinstance(v, list)]
+            if len(value) == 1 and wrapped:
+                value = wrapped[0]
+            else:
+                objects.append(value)
+                continue
+        if isinstance(value, list):
+            objects.extend(v for v in value if isinstance(v, dict))
+    return objects
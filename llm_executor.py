@@ -0,0 +1,125 @@
+# llm_executor.py
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from google.api_core.exceptions import DeadlineExceeded
+from gemini_pool import get_client_pool
+
+LLM_MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", 8))        # LLM 專用執行緒數
+LLM_CALL_TIMEOUT = float(os.getenv("LLM_CALL_TIMEOUT", 60))   # 預設每次呼叫的期限（秒）
+
+
+class LLMTimeoutError(asyncio.TimeoutError):
+    """LLM 呼叫超過期限（包含在佇列中等待的時間）"""
+
+
+class LLMExecutor:
+    """專用於 LLM 呼叫的執行緒池
+
+    與事件迴圈的預設 executor 分開，避免 LLM 呼叫佔滿其他工作的執行緒。
+    每次呼叫在送出時就決定期限：在佇列中等到期限就直接放棄，
+    開始執行後剩餘的時間作為 gRPC deadline，逾時時底層請求會被中止，不會留下殭屍呼叫。
+    """
+
+    def __init__(self, max_workers=LLM_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    def _run(self, submitted_at, deadline, api_key, model_name, prompt, kwargs):
+        started_at = time.monotonic()
+        queue_wait = started_at - submitted_at
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.total_queue_wait += queue_wait
+            self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+        try:
+            remaining = deadline - started_at
+            if remaining <= 0:
+                raise LLMTimeoutError(f"LLM 呼叫在佇列中等待 {queue_wait:.1f} 秒，已超過期限")
+            try:
+                response = get_client_pool().generate_content(
+                    api_key, model_name, prompt, timeout=remaining, **kwargs
+                )
+            except DeadlineExceeded as e:
+                raise LLMTimeoutError(f"LLM 呼叫超過期限: {e}") from e
+            with self._lock:
+                self.completed += 1
+            return response.text
+        except LLMTimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    def submit(self, api_key, model_name, prompt, timeout=None, **kwargs):
+        """送出一次 generate_content 呼叫，回傳 concurrent.futures.Future（結果為回應文字）"""
+        now = time.monotonic()
+        deadline = now + (timeout or LLM_CALL_TIMEOUT)
+        with self._lock:
+            self.queued += 1
+        future = self._pool.submit(self._run, now, deadline, api_key, model_name, prompt, kwargs)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        # 呼叫端取消（例如用戶端斷線）時，尚未開始的呼叫直接從佇列移除，不會送出
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+                self.cancelled += 1
+
+    def generate(self, api_key, model_name, prompt, timeout=None, **kwargs):
+        """同步呼叫，供一般執行緒使用"""
+        return self.submit(api_key, model_name, prompt, timeout=timeout, **kwargs).result()
+
+    async def generate_async(self, api_key, model_name, prompt, timeout=None, **kwargs):
+        """非同步呼叫，供事件迴圈中的協程使用；協程被取消時，尚未開始的呼叫會一併取消"""
+        future = self.submit(api_key, model_name, prompt, timeout=timeout, **kwargs)
+        return await asyncio.wrap_future(future)
+
+    def stats(self):
+        with self._lock:
+            started = self.completed + self.failed + self.timeouts
+            return {
+                'max_workers': self.max_workers,
+                'active': self.active,
+                'queued': self.queued,
+                'occupancy': self.active / self.max_workers,
+                'completed': self.completed,
+                'failed': self.failed,
+                'timeouts': self.timeouts,
+                'cancelled': self.cancelled,
+                'avg_queue_wait': self.total_queue_wait / started if started else 0.0,
+                'max_queue_wait': self.max_queue_wait,
+            }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_llm_executor():
+    """取得行程內共用的 LLM executor"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = LLMExecutor()
+        return _executor
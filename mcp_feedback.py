@@ -1,110 +1,379 @@
 # mcp_feedback.py
 import os
-import re
 import json
 import asyncio
 import base64
 import traceback
-from io import BytesIO
-import google.generativeai as genai
 from openai import OpenAIError
 from google.api_core.exceptions import GoogleAPICallError, RetryError
 from google.api_core.exceptions import ResourceExhausted
-import plotly.graph_objects as go
-import time
+import hashlib
+import threading
+from llm_executor import get_llm_executor
+from rate_limiter import get_limiter, AdaptiveLimiter, is_rate_limit_error, parse_retry_delay
+from token_budget import count_tokens
+from response_cache import ResponseCache, make_key
+from gemini_pool import json_mode_options
+from json_extract import extract_objects
+from chart_render import chart_spec, get_chart_renderer
+from cancellation import run_cancellable
 
 GEMINI_MODEL = "gemini-2.0-flash"
 GEMINI_API_KEY = os.getenv("Gemini_api")  # 注意這裡是正確讀.env
 
-# 主程式：對多個 persona 執行回饋，並回傳 (feedback_list, avg_score, base64_chart_png)
-def run_mcp_feedback(selected_personas, marketing_copy, progress_callback=None):
-    """主程式：對多個 persona 執行回饋，並回傳 (feedback_data, avg_score, base64_chart_png)"""
-    api_key = os.getenv("Gemini_api")
+FEEDBACK_MAX_CONCURRENT = int(os.getenv("FEEDBACK_MAX_CONCURRENT", 4))  # 同時進行的評估請求上限
+FEEDBACK_MAX_RETRIES = 5
+PROGRESS_BATCH_SIZE = 2   # 進度回報沿用每 2 個 persona 一個批次的分段
+# 多 persona 合併評估：每個 prompt 的 token 預算與最多容納的 persona 數，FEEDBACK_BATCHED=0 時逐一評估
+FEEDBACK_BATCHED = os.getenv("FEEDBACK_BATCHED", "1") not in ("0", "false", "no")
+FEEDBACK_BATCH_TOKEN_BUDGET = int(os.getenv("FEEDBACK_BATCH_TOKEN_BUDGET", 6000))
+FEEDBACK_MAX_BATCH_SIZE = int(os.getenv("FEEDBACK_MAX_BATCH_SIZE", 8))
+# 評估結果快取，以 (模型, persona 內容, 行銷文案) 為鍵
+FEEDBACK_CACHE_DIR = os.getenv("FEEDBACK_CACHE_DIR", os.path.join("outputs", "cache", "feedback"))
+FEEDBACK_CACHE_MAX_BYTES = int(os.getenv("FEEDBACK_CACHE_MAX_BYTES", 50 * 1024 * 1024))  # 50MB
+FEEDBACK_CACHE_TTL = int(os.getenv("FEEDBACK_CACHE_TTL", 7 * 24 * 3600))                  # 7 天
+# generate_prompt 實際使用的 persona 欄位，只有這些欄位改變才需要重新評估
+PROMPT_PERSONA_FIELDS = ('description', 'motivation', 'challenges', 'learning_goals', 'preferred_learning_methods')
+
+_feedback_cache = None
+_feedback_cache_lock = threading.Lock()
+
+def get_feedback_cache():
+    """取得行程內共用的評估結果快取"""
+    global _feedback_cache
+    with _feedback_cache_lock:
+        if _feedback_cache is None:
+            _feedback_cache = ResponseCache(FEEDBACK_CACHE_DIR, FEEDBACK_CACHE_MAX_BYTES, FEEDBACK_CACHE_TTL)
+        return _feedback_cache
+
+def _normalize(value):
+    return " ".join(str(value).split()) if value else ""
+
+def feedback_cache_key(persona, marketing_copy):
+    """以模型、persona 欄位內容雜湊與文案雜湊組成快取鍵；persona_id 不影響結果"""
+    persona_text = json.dumps([_normalize(persona.get(field)) for field in PROMPT_PERSONA_FIELDS], ensure_ascii=False)
+    persona_hash = hashlib.sha256(persona_text.encode('utf-8')).hexdigest()
+    copy_hash = hashlib.sha256(_normalize(marketing_copy).encode('utf-8')).hexdigest()
+    return make_key(GEMINI_MODEL, f"feedback\0{persona_hash}\0{copy_hash}")
+
+# 主程式：對多個 persona 執行回饋，並回傳 (feedback_list, avg_score, chart_spec)
+def run_mcp_feedback(selected_personas, marketing_copy, progress_callback=None, api_key=None, batched=None,
+                     use_cache=True, cancel_token=None):
+    """主程式：對多個 persona 執行回饋，並回傳 (feedback_data, avg_score, chart_spec)
+
+    各 persona 以有限的並行數同時評估，只有實際遇到 429 時才依 retry_delay 暫停與降低並行數。
+    batched 為 True（預設依 FEEDBACK_BATCHED）時，依 token 預算把多個 persona 放進同一個 prompt。
+    相同 persona 內容與文案的結果會從快取取得並立即回報進度；use_cache=False 時強制重新評估。
+    progress_callback(current, total, batch_current, batch_total) 在每個 persona 完成時呼叫。
+    chart_spec 是圖表的資料規格（由前端繪製），需要圖檔時再以 chart_render 另外繪製。
+    cancel_token 被取消時立即停止所有等待中的呼叫，拋出 OperationCancelled（partial 為已完成的評估）。
+    """
+    api_key = api_key or os.getenv("Gemini_api")
     if not api_key:
         raise ValueError("缺少 Google API Key")
-    
-    feedback_data = []
-    scores = []
-    
-    # 將 personas 分成更小的批次，每批最多 2 個
-    batch_size = 2
-    persona_batches = [
-        selected_personas[i:i+batch_size] 
-        for i in range(0, len(selected_personas), batch_size)
-    ]
-    
-    total_personas = len(selected_personas)
-    processed_count = 0
-    
-    for batch_index, batch in enumerate(persona_batches):
-        print(f"處理批次 {batch_index+1}/{len(persona_batches)}, {len(batch)} 個 Personas")
-        
-        # 處理每個批次中的 personas
-        batch_results = []
-        for persona in batch:
-            try:
-                processed_count += 1
-                
-                # 如果有進度回調函數，呼叫它
-                if progress_callback:
-                    # 只在批次完成時更新
-                    progress_callback(
-                        processed_count, 
-                        total_personas, 
-                        batch_index + 1,  # 當前批次
-                        len(persona_batches)
-                    )
-                
-                prompt = generate_prompt(persona, marketing_copy)
-                response_text = sync_call_gemini_model(prompt)
-                parsed = parse_feedback_response(response_text, persona_id=persona.get('persona_id', 'Unknown'))
-                batch_results.append(parsed)
-                print(f"  成功評估 Persona {persona.get('persona_id')}, 得分: {parsed.get('score', 0)}")
-                
-                # 每個請求之間等待 3 秒，避免單一批次內的速率限制
-                time.sleep(3)
-            except Exception as e:
-                print(f"  評估 Persona {persona.get('persona_id')} 失敗: {e}")
-                # 添加失敗記錄
-                batch_results.append({
-                    'persona_id': persona.get('persona_id', 'Unknown'),
-                    'score': 0,
-                    'reasons_to_buy': ['評估失敗'],
-                    'reasons_not_to_buy': ['API 速率限制'],
-                    'detail_feedback': f'評估失敗: {str(e)}'
-                })
-        
-        # 在批次完成後再次回調，確保進度更新
-        if progress_callback:
-            progress_callback(
-                processed_count, 
-                total_personas, 
-                batch_index + 1,  # 已完成的批次數
-                len(persona_batches)
-            )
-        
-        # 將批次結果合併到總結果
-        feedback_data.extend(batch_results)
-        scores.extend([item.get('score', 0) for item in batch_results if item.get('score', 0) > 0])
-        
-        # 批次之間等待較長時間以避免 API 限制
-        if batch_index < len(persona_batches) - 1:
-            wait_time = 20  # 增加到 20 秒
-            print(f"等待 {wait_time} 秒後處理下一批次...")
-            time.sleep(wait_time)
-        
+    if batched is None:
+        batched = FEEDBACK_BATCHED
+
+    feedback_data = run_cancellable(
+        _evaluate_personas(selected_personas, marketing_copy, progress_callback, api_key, batched, use_cache,
+                           cancel_token),
+        cancel_token
+    )
+    scores = [item.get('score', 0) for item in feedback_data if item.get('score', 0) > 0]
+
     # 確保至少有一個有效分數
     if not scores:
         scores = [0]
         
     avg_score = sum(scores) / len(scores) if scores else 0.0
-    chart_png = generate_chart(feedback_data, avg_score)
-    return feedback_data, avg_score, chart_png
+    return feedback_data, avg_score, chart_spec(feedback_data, avg_score)
+
+def run_ab_feedback(selected_personas, marketing_copies, cell_callback=None, api_key=None, use_cache=True,
+                    cancel_token=None):
+    """A/B 模式：評估 persona × 文案的完整矩陣，回傳 (cells, copy_summaries)
+
+    每位 persona 以同一個 prompt 評估多份文案（依 token 預算分組），persona 描述在 prompt 開頭只送一次；
+    回應中缺少的格子再單獨評估，已快取的格子立即回報。
+    cell_callback(cell, completed, total) 在每個格子完成時呼叫，cell 帶有 persona_id 與 copy_index。
+    cells 依文案、persona 的順序排列；copy_summaries 為各文案的平均分數與排名（rank 1 為最高分）。
+    cancel_token 被取消時拋出 OperationCancelled（partial 為已完成的格子）。
+    """
+    api_key = api_key or os.getenv("Gemini_api")
+    if not api_key:
+        raise ValueError("缺少 Google API Key")
+
+    cells = run_cancellable(
+        _evaluate_matrix(selected_personas, marketing_copies, cell_callback, api_key, use_cache, cancel_token),
+        cancel_token
+    )
+    return cells, summarize_copies(cells, marketing_copies)
+
+def summarize_copies(cells, marketing_copies):
+    """計算各文案的平均分數（忽略評估失敗的 0 分）並依平均分數排名"""
+    summaries = []
+    for copy_index, marketing_copy in enumerate(marketing_copies):
+        scores = [c.get('score', 0) for c in cells if c['copy_index'] == copy_index and c.get('score', 0) > 0]
+        summaries.append({
+            'copy_index': copy_index,
+            'marketing_copy': marketing_copy,
+            'avg_score': sum(scores) / len(scores) if scores else 0.0,
+            'evaluated': len(scores),
+        })
+    for rank, summary in enumerate(sorted(summaries, key=lambda s: -s['avg_score']), 1):
+        summary['rank'] = rank
+    return summaries
+
+def _failed_feedback(persona_id, error):
+    return {
+        'persona_id': persona_id,
+        'score': 0,
+        'reasons_to_buy': ['評估失敗'],
+        'reasons_not_to_buy': ['API 速率限制' if is_rate_limit_error(error) else 'API 呼叫失敗'],
+        'detail_feedback': f'評估失敗: {str(error)}'
+    }
+
+def _pack(items, measure, budget):
+    """依 token 預算把項目分組，每組最多 FEEDBACK_MAX_BATCH_SIZE 個"""
+    groups = []
+    current = []
+    size = 0
+    for item in items:
+        item_tokens = measure(item)
+        if current and (size + item_tokens > budget or len(current) >= FEEDBACK_MAX_BATCH_SIZE):
+            groups.append(current)
+            current = []
+            size = 0
+        current.append(item)
+        size += item_tokens
+    if current:
+        groups.append(current)
+    return groups
+
+def _group_personas(personas, marketing_copy):
+    """依 token 預算把 persona 分組，文案只計算一次"""
+    return _pack(personas, lambda persona: count_tokens(_persona_block(persona)),
+                 FEEDBACK_BATCH_TOKEN_BUDGET - count_tokens(marketing_copy))
+
+def _cache_entry(parsed):
+    """快取內容不含 persona_id，相同內容的 persona 可共用；帶有 unparsed 標記的結果不應寫入"""
+    return {'model': GEMINI_MODEL, 'feedback': {k: v for k, v in parsed.items() if k != 'persona_id'}}
+
+async def _evaluate_personas(personas, marketing_copy, progress_callback, api_key, batched=False, use_cache=True,
+                             cancel_token=None):
+    """並行評估所有 persona，結果依傳入順序排列；被取消時把已完成的結果放在 cancel_token.partial"""
+    limiter = AdaptiveLimiter(FEEDBACK_MAX_CONCURRENT)
+    total = len(personas)
+    batch_total = (total + PROGRESS_BATCH_SIZE - 1) // PROGRESS_BATCH_SIZE
+    completed = 0
+    results = {}
+
+    def report(persona, parsed):
+        nonlocal completed
+        results[id(persona)] = parsed
+        completed += 1
+        if progress_callback:
+            progress_callback(completed, total, (completed + PROGRESS_BATCH_SIZE - 1) // PROGRESS_BATCH_SIZE,
+                              batch_total)
+
+    cache = get_feedback_cache()
+    cache_keys = [feedback_cache_key(persona, marketing_copy) for persona in personas]
+    key_by_persona = {id(persona): key for persona, key in zip(personas, cache_keys)}
+
+    def store(persona, parsed):
+        if parsed.get('unparsed'):
+            return  # 無法解析的預設分數不快取，下次重新評估
+        cache.set(key_by_persona[id(persona)], _cache_entry(parsed))
+
+    async def evaluate(persona):
+        persona_id = persona.get('persona_id', 'Unknown')
+        try:
+            parsed = await _evaluate_persona(persona, marketing_copy, api_key, limiter)
+            print(f"  成功評估 Persona {persona_id}, 得分: {parsed.get('score', 0)}")
+            store(persona, parsed)
+        except Exception as e:
+            print(f"  評估 Persona {persona_id} 失敗: {e}")
+            # 添加失敗記錄
+            parsed = _failed_feedback(persona_id, e)
+        report(persona, parsed)
+
+    async def evaluate_group(group):
+        if len(group) == 1:
+            await evaluate(group[0])
+            return
+        try:
+            batch_results = await _evaluate_batch(group, marketing_copy, api_key, limiter)
+        except Exception as e:
+            print(f"  合併評估 {len(group)} 個 Persona 失敗，改為逐一評估: {e}")
+            batch_results = {}
+
+        async def resolve(index, persona):
+            parsed = batch_results.get(index)
+            if parsed is None:
+                # 合併回應中缺少此 persona，改為單獨評估
+                await evaluate(persona)
+                return
+            print(f"  成功評估 Persona {parsed['persona_id']}, 得分: {parsed.get('score', 0)}")
+            store(persona, parsed)
+            report(persona, parsed)
+
+        await asyncio.gather(*(resolve(index, persona) for index, persona in enumerate(group)))
+
+    # 先查快取，命中的結果立即回報進度，只有未命中的 persona 需要呼叫 API
+    pending = []
+    for persona, key in zip(personas, cache_keys):
+        cached = cache.get(key) if use_cache else None
+        if cached is not None:
+            report(persona, dict(cached['feedback'], persona_id=persona.get('persona_id', 'Unknown')))
+        else:
+            pending.append(persona)
+    if len(pending) < total:
+        print(f"評估快取命中 {total - len(pending)} 個 Personas")
+
+    groups = _group_personas(pending, marketing_copy) if batched else [[persona] for persona in pending]
+    print(f"開始評估 {len(pending)} 個 Personas，共 {len(groups)} 個請求，並行上限 {FEEDBACK_MAX_CONCURRENT}")
+    try:
+        await asyncio.gather(*(evaluate_group(group) for group in groups))
+    except asyncio.CancelledError:
+        # 已完成的評估都已寫入快取，重新執行時會直接命中
+        if cancel_token is not None:
+            cancel_token.partial = [results[id(p)] for p in personas if id(p) in results]
+        print(f"評估已取消，已完成 {len(results)}/{total} 個 Personas")
+        raise
+    if limiter.rate_limited:
+        print(f"評估期間遇到 {limiter.rate_limited} 次速率限制")
+    return [results[id(persona)] for persona in personas]
+
+async def _evaluate_matrix(personas, marketing_copies, cell_callback, api_key, use_cache=True, cancel_token=None):
+    """並行評估 persona × 文案矩陣的每一格；被取消時把已完成的格子放在 cancel_token.partial"""
+    limiter = AdaptiveLimiter(FEEDBACK_MAX_CONCURRENT)
+    cache = get_feedback_cache()
+    total = len(personas) * len(marketing_copies)
+    results = {}
+
+    def finish(p_index, c_index, parsed, store=True):
+        persona = personas[p_index]
+        if store and not parsed.get('unparsed'):
+            cache.set(feedback_cache_key(persona, marketing_copies[c_index]), _cache_entry(parsed))
+        cell = dict(parsed, persona_id=persona.get('persona_id', 'Unknown'), copy_index=c_index)
+        results[(p_index, c_index)] = cell
+        if cell_callback:
+            cell_callback(cell, len(results), total)
+
+    async def evaluate_cell(p_index, c_index):
+        persona_id = personas[p_index].get('persona_id', 'Unknown')
+        try:
+            parsed = await _evaluate_persona(personas[p_index], marketing_copies[c_index], api_key, limiter)
+        except Exception as e:
+            print(f"  評估 Persona {persona_id} / 文案 {c_index + 1} 失敗: {e}")
+            finish(p_index, c_index, _failed_feedback(persona_id, e), store=False)
+            return
+        finish(p_index, c_index, parsed)
+
+    async def evaluate_row(p_index, copy_indices):
+        if len(copy_indices) == 1:
+            await evaluate_cell(p_index, copy_indices[0])
+            return
+        try:
+            row = await _evaluate_copies(personas[p_index], [(i, marketing_copies[i]) for i in copy_indices],
+                                         api_key, limiter)
+        except Exception as e:
+            print(f"  合併評估 {len(copy_indices)} 份文案失敗，改為逐一評估: {e}")
+            row = {}
+        missing = []
+        for c_index in copy_indices:
+            if c_index in row:
+                finish(p_index, c_index, row[c_index])
+            else:
+                # 合併回應中缺少此文案，改為單獨評估
+                missing.append(c_index)
+        await asyncio.gather(*(evaluate_cell(p_index, c_index) for c_index in missing))
+
+    rows = []
+    for p_index, persona in enumerate(personas):
+        pending = []
+        for c_index, marketing_copy in enumerate(marketing_copies):
+            cached = cache.get(feedback_cache_key(persona, marketing_copy)) if use_cache else None
+            if cached is not None:
+                finish(p_index, c_index, cached['feedback'], store=False)
+            else:
+                pending.append(c_index)
+        budget = FEEDBACK_BATCH_TOKEN_BUDGET - count_tokens(_persona_block(persona))
+        for group in _pack(pending, lambda i: count_tokens(marketing_copies[i]), budget):
+            rows.append(evaluate_row(p_index, group))
+    if results:
+        print(f"A/B 評估快取命中 {len(results)}/{total} 格")
+    print(f"開始 A/B 評估 {len(personas)} 個 Personas × {len(marketing_copies)} 份文案，共 {len(rows)} 個請求")
+    try:
+        await asyncio.gather(*rows)
+    except asyncio.CancelledError:
+        if cancel_token is not None:
+            cancel_token.partial = [results[k] for k in sorted(results, key=lambda k: (k[1], k[0]))]
+        print(f"A/B 評估已取消，已完成 {len(results)}/{total} 格")
+        raise
+    if limiter.rate_limited:
+        print(f"評估期間遇到 {limiter.rate_limited} 次速率限制")
+    return [results[(p, c)] for c in range(len(marketing_copies)) for p in range(len(personas))]
+
+async def _evaluate_persona(persona, marketing_copy, api_key, limiter):
+    """評估單一 persona"""
+    prompt = generate_prompt(persona, marketing_copy)
+    response_text = await _call_model(prompt, api_key, limiter, FEEDBACK_RESPONSE_SCHEMA)
+    return parse_feedback_response(response_text, persona_id=persona.get('persona_id', 'Unknown'))
+
+async def _evaluate_batch(personas, marketing_copy, api_key, limiter):
+    """以單一 prompt 評估多個 persona，回傳 {personas 中的索引: 結果}；回應中缺少的 persona 不會出現在結果中"""
+    prompt = generate_batch_prompt(personas, marketing_copy)
+    response_text = await _call_model(prompt, api_key, limiter, FEEDBACK_BATCH_RESPONSE_SCHEMA)
+    return parse_batch_feedback_response(response_text, [p.get('persona_id', 'Unknown') for p in personas])
+
+async def _evaluate_copies(persona, copies, api_key, limiter):
+    """以單一 prompt 評估同一位 persona 對多份文案的回饋，copies 為 [(copy_index, 文案)]，回傳 {copy_index: 結果}"""
+    prompt = generate_ab_prompt(persona, copies)
+    response_text = await _call_model(prompt, api_key, limiter, FEEDBACK_AB_RESPONSE_SCHEMA)
+    return parse_ab_feedback_response(response_text, persona.get('persona_id', 'Unknown'),
+                                      [copy_index for copy_index, _ in copies])
+
+async def _call_model(prompt, api_key, limiter, schema):
+    """呼叫模型；速率限制錯誤交給共用限流器與 limiter 暫停，其他錯誤以指數退避重試"""
+    key_limiter = get_limiter(api_key)  # 與 persona 生成共用同一把 key 的配額
+    for attempt in range(1, FEEDBACK_MAX_RETRIES + 1):
+        async with limiter.slot():
+            await key_limiter.acquire(count_tokens(prompt))
+            try:
+                response_text = await get_llm_executor().generate_async(
+                    api_key, GEMINI_MODEL, prompt, **json_mode_options(schema)
+                )
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    limiter.on_rate_limited(await key_limiter.on_rate_limited_async(parse_retry_delay(str(e))))
+                if attempt == FEEDBACK_MAX_RETRIES:
+                    raise
+                print(f"Gemini API 呼叫失敗 (嘗試 {attempt}/{FEEDBACK_MAX_RETRIES}): {e}")
+                if is_rate_limit_error(e):
+                    continue
+                wait = min(30, 2 ** attempt)
+            else:
+                await key_limiter.on_success_async()
+                limiter.on_success()
+                return response_text
+        # 非速率限制的錯誤在釋放名額後再等待，不佔用並行數
+        await asyncio.sleep(wait)
 
 def load_persona(path):
     with open(path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
+# JSON 模式下要求模型輸出的回饋結構
+FEEDBACK_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "score": {"type": "NUMBER"},
+        "reasons_to_buy": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "reasons_not_to_buy": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["score", "reasons_to_buy", "reasons_not_to_buy"],
+}
+
 def generate_prompt(persona, marketing_copy):
     return f"""
 你現在是一位 Persona：
@@ -138,49 +407,129 @@ def generate_prompt(persona, marketing_copy):
 }}
 """
 
-# 改為同步函數，供 call_gemini_model 使用
-def sync_call_gemini_model(prompt, max_retries=5):
-    """同步呼叫 Gemini API，帶有重試機制"""
-    api_key = os.getenv("Gemini_api")
-    if not api_key:
-        raise ValueError("缺少 Google API Key")
-    
-    retries = 0
-    while retries < max_retries:
-        try:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(GEMINI_MODEL)
-            response = model.generate_content(prompt)
-            return response.text
-        except Exception as e:
-            retry_seconds = get_retry_delay(str(e))
-            retries += 1
-            if retries < max_retries:
-                print(f"Gemini API 呼叫失敗 (嘗試 {retries}/{max_retries}): {e}")
-                print(f"等待 {retry_seconds} 秒後重試...")
-                time.sleep(retry_seconds)
-            else:
-                print(f"Gemini API 呼叫失敗，已達最大重試次數: {e}")
-                raise  # 重新拋出異常，讓調用者知道失敗了
-    return None  # 這行實際上不會被執行到，因為最後一次失敗會拋出異常
-
-def get_retry_delay(error_msg):
-    """從錯誤消息中提取建議的重試延遲，並加 1 秒作為額外緩衝"""
-    # 嘗試尋找 'retry_delay { seconds: XX }' 模式
-    match = re.search(r'retry_delay\s*{\s*seconds:\s*(\d+)\s*}', error_msg)
-    if match:
-        # 從匹配中提取數字，並加 1 秒作為緩衝
-        return int(match.group(1)) + 1  # 將建議的等待時間加 1 秒
-    else:
-        # 默認等待時間
-        return 17  # 如果找不到建議等待時間，使用 15 秒作為安全值
+FEEDBACK_BATCH_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": dict(FEEDBACK_RESPONSE_SCHEMA["properties"], persona_ref={"type": "STRING"}),
+        "required": ["persona_ref"] + FEEDBACK_RESPONSE_SCHEMA["required"],
+    },
+}
+
+def _persona_block(persona, label=None):
+    return f"""=== Persona {label or persona.get('persona_id', 'Unknown')} ===
+描述：{persona.get('description', '無')}
+學習動機：{persona.get('motivation', '無')}
+面臨挑戰：{persona.get('challenges', '無')}
+學習目標：{persona.get('learning_goals', '無')}
+偏好的學習方式：{persona.get('preferred_learning_methods', '無')}
+"""
+
+def batch_alias(index):
+    """合併評估時 persona 在 prompt 中的代號（P1..Pn），不使用 persona_id，同一組內即使 ID 重複也能區分"""
+    return f"P{index + 1}"
+
+def generate_batch_prompt(personas, marketing_copy):
+    """多個 persona 共用一份行銷文案的評估 prompt，要求以代號 persona_ref 為鍵的 JSON 陣列回答"""
+    persona_blocks = "\n".join(_persona_block(p, batch_alias(i)) for i, p in enumerate(personas))
+    return f"""
+以下是一份行銷文案：
+=== 行銷文案 ===
+{marketing_copy}
+
+請分別扮演下列每一位 Persona，以他的立場針對上述文案提供回饋：
+{persona_blocks}
+每位 Persona 都要回答：購買意願評分（1-10）、購買理由、不購買理由。
+
+結果請用純 JSON 陣列輸出，每位 Persona 一個物件，persona_ref 必須與上面的代號完全相同，例如：
+```json
+[
+  {{
+    "persona_ref": "P1",
+    "score": ?,
+    "reasons_to_buy": ["...", "..."],
+    "reasons_not_to_buy": ["..."]
+  }}
+]
+"""
+
+def parse_batch_feedback_response(response_text, persona_ids):
+    """解析合併評估的回應，依代號 persona_ref 拆回 {persona_ids 中的索引: 結果}
+
+    結果格式與 parse_feedback_response 相同；代號也接受小寫或只有數字（例如 p2、2）。
+    """
+    expected = {batch_alias(i): i for i in range(len(persona_ids))}
+    results = {}
+    for item in extract_objects(response_text):
+        key = str(item.get('persona_ref', '')).strip().upper()
+        if key.isdigit():
+            key = f"P{key}"
+        if key not in expected or expected[key] in results or 'score' not in item:
+            continue
+        results[expected[key]] = {
+            "persona_id": persona_ids[expected[key]],
+            "score": item.get("score", 5),
+            "reasons_to_buy": item.get("reasons_to_buy", []),
+            "reasons_not_to_buy": item.get("reasons_not_to_buy", []),
+            "detail_feedback": json.dumps(item, ensure_ascii=False)
+        }
+    return results
+
+FEEDBACK_AB_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": dict(FEEDBACK_RESPONSE_SCHEMA["properties"], copy_id={"type": "STRING"}),
+        "required": ["copy_id"] + FEEDBACK_RESPONSE_SCHEMA["required"],
+    },
+}
+
+def generate_ab_prompt(persona, copies):
+    """同一位 persona 評估多份文案的 prompt，persona 描述放在開頭，文案編號為 copy_index + 1"""
+    copy_blocks = "\n".join(f"=== 文案 {copy_index + 1} ===\n{marketing_copy}\n" for copy_index, marketing_copy in copies)
+    return f"""
+你現在是一位 Persona：
+{_persona_block(persona)}
+請分別針對以下 {len(copies)} 份行銷文案提供回饋，每份文案獨立評分：
+{copy_blocks}
+每份文案都要回答：購買意願評分（1-10）、購買理由、不購買理由。
+
+結果請用純 JSON 陣列輸出，每份文案一個物件，copy_id 必須與上面的文案編號完全相同，例如：
+```json
+[
+  {{
+    "copy_id": "1",
+    "score": ?,
+    "reasons_to_buy": ["...", "..."],
+    "reasons_not_to_buy": ["..."]
+  }}
+]
+"""
+
+def parse_ab_feedback_response(response_text, persona_id, copy_indices):
+    """解析 A/B 評估的回應，依 copy_id 拆回 {copy_index: 結果}"""
+    expected = {str(copy_index + 1): copy_index for copy_index in copy_indices}
+    results = {}
+    for item in extract_objects(response_text):
+        key = str(item.get('copy_id', '')).strip()
+        if key not in expected or expected[key] in results or 'score' not in item:
+            continue
+        results[expected[key]] = {
+            "persona_id": persona_id,
+            "score": item.get("score", 5),
+            "reasons_to_buy": item.get("reasons_to_buy", []),
+            "reasons_not_to_buy": item.get("reasons_not_to_buy", []),
+            "detail_feedback": json.dumps(item, ensure_ascii=False)
+        }
+    return results
 
 def parse_feedback_response(response_text, persona_id):
     """解析 Gemini 回應的 JSON"""
     try:
-        match = re.search(r"\{.*\}", response_text, re.DOTALL)
-        if match:
-            feedback_json = json.loads(match.group(0))
+        # 單次掃描取出 JSON 物件，優先使用帶有 score 的那個；截斷的回應也能取回已完整的欄位
+        objects = extract_objects(response_text)
+        feedback_json = next((obj for obj in objects if 'score' in obj), objects[0] if objects else None)
+        if feedback_json is not None:
             return {
                 "persona_id": persona_id,
                 "score": feedback_json.get("score", 5),
@@ -195,93 +544,25 @@ def parse_feedback_response(response_text, persona_id):
             if "呼叫失敗" in response_text or not response_text.strip():
                 raise ValueError("API 呼叫失敗，無法取得評估結果")
                 
-            # 如果回應存在但格式不符，生成一個基本的分數
+            # 如果回應存在但格式不符，生成一個基本的分數；標記 unparsed 避免寫入快取
             return {
                 "persona_id": persona_id,
                 "score": 5,  # 預設分數
                 "reasons_to_buy": ["無法解析回應"],
                 "reasons_not_to_buy": ["API 回應格式不符"],
-                "detail_feedback": response_text.strip()
+                "detail_feedback": response_text.strip(),
+                "unparsed": True
             }
     except Exception as e:
         print(f"解析失敗: {e}")
         raise  # 重新拋出異常，讓調用者能夠處理
 
-# 修改 generate_chart 函數
 def generate_chart(feedback_data, avg_score):
-    """生成評分圖表，返回 base64 編碼的圖片"""
-    if not feedback_data:
+    """生成評分圖表，返回 base64 編碼的 PNG；在圖表執行緒上繪製並依分數向量快取"""
+    spec = chart_spec(feedback_data, avg_score)
+    if spec is None:
         return ""
-    
-    # 排序 feedback_data 以確保顯示順序一致
-    feedback_data = sorted(feedback_data, key=lambda x: str(x['persona_id']))
-    
-    # 準備繪圖資料
-    labels = [f"Persona {item['persona_id']}" for item in feedback_data]
-    scores = [item['score'] for item in feedback_data]
-    
-    # 使用新的顏色方案
-    colors = []
-    for s in scores:
-        if s >= 8:
-            colors.append('#E36E6C')  # 高分使用紅色系 (原本是綠色)
-        elif s >= 6:
-            colors.append('#4E374C')  # 中高分使用深色系 (原本是藍色)
-        elif s >= 4:
-            colors.append('#F7C375')  # 中低分使用橙色系 (原本是橙色)
-        else:
-            colors.append('#E9DCCB')  # 低分使用淺色系 (原本是紅色)
-    
-    # 創建長條圖
-    fig = go.Figure(go.Bar(
-        x=labels,
-        y=scores,
-        marker_color=colors,
-        text=scores,
-        textposition='auto',
-    ))
-    
-    # 添加平均線 - 使用深色系顏色
-    fig.add_shape(
-        type="line",
-        x0=-0.5,
-        x1=len(labels) - 0.5,
-        y0=avg_score,
-        y1=avg_score,
-        line=dict(color='#4E374C', width=2, dash="dash"),  # 改用深色系
-    )
-    
-    # 添加註解
-    fig.add_annotation(
-        x=len(labels) - 1,
-        y=avg_score,
-        text=f"平均: {avg_score:.1f}",
-        showarrow=True,
-        arrowhead=1,
-        bgcolor="#E9DCCB",  # 使用淺色系作為註解背景
-        bordercolor="#4E374C",  # 使用深色系作為邊框
-        borderwidth=1,
-    )
-    
-    # 配置圖表 - 確保所有數值都能顯示
-    fig.update_layout(
-        title="各 Persona 購買意願評分",
-        yaxis_title="評分 (1-10)",
-        yaxis_range=[0, 10],
-        template="plotly_white",
-        width=1000,  # 設置寬度以確保所有標籤可見
-        height=800,  # 增加高度
-        margin=dict(l=50, r=50, t=50, b=150),  # 增加底部邊距以顯示標籤
-        paper_bgcolor='#FFFFFF',  # 背景色保持白色
-        plot_bgcolor='#FFFFFF',  # 繪圖區背景色保持白色
-    )
-    
-    # 調整 x 軸標籤方向，避免重疊
-    fig.update_xaxes(tickangle=45)
-    
-    # 轉為 base64 字串
-    img_bytes = fig.to_image(format="png", width=800, height=500)
-    return base64.b64encode(img_bytes).decode('utf-8')
+    return base64.b64encode(get_chart_renderer().render(spec, 'png')).decode('utf-8')
 
 # ---------------
 # 可以 export 的函式
@@ -1,10 +1,8 @@
 import os
 import json
-import re
 import asyncio
 import pandas as pd
 import chardet
-import zipfile
 import io
 import base64
 import plotly.graph_objects as go
@@ -12,7 +10,20 @@ import time
 from openai import RateLimitError  # 確保導入這個
 import opencc
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-import google.generativeai as genai
+from rate_limiter import get_limiter, is_rate_limit_error, parse_retry_delay
+from llm_executor import get_llm_executor
+from gemini_pool import json_mode_options
+from json_extract import extract_objects
+from artifact_writer import write_persona_artifacts
+from conversation_log import ConversationLog
+from persona_store import get_persona_store
+from response_cache import get_response_cache, make_key
+from persona_merge import merge_personas
+from survey_serializer import serialize_frame
+from survey_ingest import iter_csv_chunks
+from transcript_ingest import read_transcripts, iter_transcript_chunks, TRANSCRIPT_SEPARATOR
+from token_budget import (count_tokens, count_tokens_uncached, CHUNK_TOKEN_BUDGET,
+                          SINGLE_SHOT_TOKEN_LIMIT, MAX_PROMPT_TOKENS, MIN_CHUNK_TOKENS)
 
 GEMINI_MODEL = "gemini-2.0-flash"
 MAX_RETRIES = 5  # 最大重試次數
@@ -29,47 +40,64 @@ def clean_persona(persona):
         ]
     return cleaned
 
-# 修改所有處理函數以傳遞 API Key
-async def process_csv(csv_path, output_folder, api_key=None):
+def _notify(progress_callback, stage, **data):
+    """回報處理進度；回調出錯不影響處理流程"""
+    if progress_callback is None:
+        return
+    try:
+        progress_callback(dict(stage=stage, **data))
+    except Exception as e:
+        print(f"進度回調錯誤: {e}")
+
+def _read_csv(csv_path):
+    """讀取整份問卷並序列化，回傳 (full_text, estimated_tokens)；會讀檔與計算 token，應在執行緒中呼叫"""
     with open(csv_path, 'rb') as f:
         encoding = chardet.detect(f.read(10000))['encoding']
     df = pd.read_csv(csv_path, encoding=encoding)
-    full_text = df.to_string(index=False)
+    full_text = serialize_frame(df)
+    return full_text, count_tokens(full_text)
 
-    estimated_tokens = len(full_text) / 2
-    if estimated_tokens > 100000:
+# 修改所有處理函數以傳遞 API Key
+async def process_csv(csv_path, output_folder, api_key=None, use_cache=True, progress_callback=None):
+    full_text, estimated_tokens = await asyncio.to_thread(_read_csv, csv_path)
+    if estimated_tokens > MAX_PROMPT_TOKENS:
         raise ValueError("問卷資料太大，超過模型可以處理的範圍，請減少資料量。")
 
     print(f"CSV資料總長度：{len(full_text)} 字元，估算約 {int(estimated_tokens)} tokens")
 
     prompt = generate_prompt(full_text, is_csv=True)
-    personas, messages = await _generate_personas(prompt, api_key)
-    return _save_personas(personas, output_folder, "csv", messages)
+    personas, messages = await _generate_personas(prompt, api_key, use_cache=use_cache)
+    _notify(progress_callback, 'generating', chunk=1, completed=1, total=1, personas=personas)
+    _notify(progress_callback, 'saving')
+    return await asyncio.to_thread(_save_personas, personas, output_folder, "csv", messages, body=full_text)
 
-async def process_csv2(csv_path, output_folder, api_key=None):
-    """處理第二種類型的 CSV，使用不同的前綴來區分 persona ID"""
+def _read_csv2(csv_path):
+    """讀取第二種 CSV：偵測編碼，解碼失敗時改用 utf-8，回傳 (full_text, estimated_tokens)；應在執行緒中呼叫"""
+    # 嘗試使用不同的編碼方式讀取檔案
+    encoding = None
     try:
-        # 嘗試使用不同的編碼方式讀取檔案
-        encoding = None
-        try:
-            with open(csv_path, 'rb') as f:
-                encoding_result = chardet.detect(f.read(10000))
-                encoding = encoding_result['encoding']
-                print(f"檢測到文件編碼：{encoding}，置信度：{encoding_result['confidence']}")
-        except Exception as e:
-            print(f"檢測編碼時出錯：{e}，將使用 utf-8")
-            encoding = 'utf-8'
-        
-        try:
-            df = pd.read_csv(csv_path, encoding=encoding)
-        except UnicodeDecodeError:
-            print(f"使用 {encoding} 解碼失敗，嘗試 utf-8 編碼")
-            df = pd.read_csv(csv_path, encoding='utf-8', errors='replace')
-        
-        full_text = df.to_string(index=False)
+        with open(csv_path, 'rb') as f:
+            encoding_result = chardet.detect(f.read(10000))
+            encoding = encoding_result['encoding']
+            print(f"檢測到文件編碼：{encoding}，置信度：{encoding_result['confidence']}")
+    except Exception as e:
+        print(f"檢測編碼時出錯：{e}，將使用 utf-8")
+        encoding = 'utf-8'
+    
+    try:
+        df = pd.read_csv(csv_path, encoding=encoding)
+    except UnicodeDecodeError:
+        print(f"使用 {encoding} 解碼失敗，嘗試 utf-8 編碼")
+        df = pd.read_csv(csv_path, encoding='utf-8', errors='replace')
+    
+    full_text = serialize_frame(df)
+    return full_text, count_tokens(full_text)
 
-        estimated_tokens = len(full_text) / 2
-        if estimated_tokens > 100000:
+async def process_csv2(csv_path, output_folder, api_key=None, use_cache=True, progress_callback=None):
+    """處理第二種類型的 CSV，使用不同的前綴來區分 persona ID"""
+    try:
+        full_text, estimated_tokens = await asyncio.to_thread(_read_csv2, csv_path)
+        if estimated_tokens > MAX_PROMPT_TOKENS:
             raise ValueError("問卷資料太大，超過模型可以處理的範圍，請減少資料量。")
 
         print(f"CSV2資料總長度：{len(full_text)} 字元，估算約 {int(estimated_tokens)} tokens")
@@ -82,14 +110,20 @@ async def process_csv2(csv_path, output_folder, api_key=None):
         
         while True:
             try:
-                personas, messages = await _generate_personas(prompt, api_key)
-                return _save_personas(personas, output_folder, "csv2", messages)
+                personas, messages = await _generate_personas(prompt, api_key, use_cache=use_cache)
+                _notify(progress_callback, 'generating', chunk=1, completed=1, total=1, personas=personas)
+                _notify(progress_callback, 'saving')
+                return await asyncio.to_thread(_save_personas, personas, output_folder, "csv2", messages, body=full_text)
             except Exception as e:
                 retry_count += 1
                 if retry_count >= max_retries:
                     print(f"已達最大重試次數 ({max_retries})，放棄處理")
                     raise
                 
+                if is_rate_limit_error(e):
+                    # 暫停時間已記錄在共用限流器
+                    print(f"遇到速率限制，等待限流器放行後重試 ({retry_count}/{max_retries})...")
+                    continue
                 wait_time = min(30, 5 * retry_count)  # 逐漸增加等待時間，但最多等 30 秒
                 print(f"處理時發生錯誤：{str(e)}。將在 {wait_time} 秒後重試 ({retry_count}/{max_retries})...")
                 await asyncio.sleep(wait_time)
@@ -99,141 +133,195 @@ async def process_csv2(csv_path, output_folder, api_key=None):
         # 返回空結果以避免前端完全崩潰
         return "", "", "", []
 
-async def process_md(md_paths, output_folder, api_key=None):
-    contents = []
-    for path in md_paths:
-        try:
-            with open(path, 'r', encoding='utf-8') as f:
-                contents.append(f.read())
-        except UnicodeDecodeError:
-            with open(path, 'rb') as f:
-                raw = f.read()
-                encoding = chardet.detect(raw)['encoding']
-                contents.append(raw.decode(encoding, errors='replace'))
+async def process_md(md_paths, output_folder, api_key=None, use_cache=True, progress_callback=None,
+                     batch_size=None, synthesis_mode='flat'):
+    """處理訪談 MD 檔：總量不大時一次送出，超過 LARGE_FILE_THRESHOLD 時依訪談與小節分批並行處理"""
+    batch_size = batch_size or max(MIN_CHUNK_TOKENS, BATCH_SIZE - prompt_overhead_tokens(is_csv=False))
+    transcripts = await read_transcripts(md_paths)
+    estimated_tokens = await asyncio.to_thread(lambda: sum(count_tokens_uncached(text) for _, text in transcripts))
+    total_chars = sum(len(text) for _, text in transcripts)
+
+    print(f"MD資料總長度：{total_chars} 字元，估算約 {int(estimated_tokens)} tokens")
+
+    if estimated_tokens <= LARGE_FILE_THRESHOLD:
+        full_text = TRANSCRIPT_SEPARATOR.join(text for _, text in transcripts)
+        prompt = generate_prompt(full_text, is_csv=False)
+        personas, messages = await _generate_personas(prompt, api_key, use_cache=use_cache)
+        _notify(progress_callback, 'generating', chunk=1, completed=1, total=1, personas=personas)
+        _notify(progress_callback, 'saving')
+        return await asyncio.to_thread(_save_personas, personas, output_folder, "md", messages, body=full_text)
+
+    chunks = await asyncio.to_thread(
+        lambda: list(iter_transcript_chunks(transcripts, batch_size, measure=count_tokens_uncached))
+    )
+    print(f"訪談資料較大，分為 {len(chunks)} 批處理（{synthesis_mode} 模式）")
+    _notify(progress_callback, 'planning', total=len(chunks))
 
-    full_text = "\n\n=== 分隔線 ===\n\n".join(contents)
+    retry_options = dict(
+        max_chunk_retries=2,
+        retry_wait=lambda n: min(60, 15 * n)
+    )
+    # 對話紀錄隨批次完成逐段寫入
+    conversation_log = ConversationLog.start(output_folder, "md")
+    all_personas, all_messages = await _dispatch_chunks(
+        chunks, api_key, use_cache=use_cache, progress_callback=progress_callback,
+        conversation_log=conversation_log, is_csv=False, **retry_options
+    )
+    if not all_personas:
+        raise ValueError("所有批次處理都失敗，未能生成任何 persona")
 
-    estimated_tokens = len(full_text) / 2
+    print(f"全部批次處理完成，共收集到 {len(all_personas)} 個 personas")
+    all_personas, all_messages = await _consolidate_personas(
+        all_personas, all_messages, synthesis_mode, api_key, token_budget=batch_size,
+        use_cache=use_cache, progress_callback=progress_callback,
+        conversation_log=conversation_log, **retry_options
+    )
+    _notify(progress_callback, 'saving')
+    return await asyncio.to_thread(_save_personas, all_personas, output_folder, "md", all_messages, conversation_log)
 
-    print(f"MD資料總長度：{len(full_text)} 字元，估算約 {int(estimated_tokens)} tokens")
+# persona 欄位說明與輸出格式，生成與彙整 prompt 共用
+PERSONA_OUTPUT_SPEC = (
+    "每個 persona 包含以下欄位：\n"
+    "- persona_id（1開始編號）\n"
+    "- description（受眾整體概括描述）\n"
+    "- motivation（學習動機）\n"
+    "- challenges（面臨挑戰與痛點）\n"
+    "- learning_goals（學習目標）\n"
+    "- preferred_learning_methods（偏好學習方式）\n"
+    "- suggested_learning_resources（推薦學習資源，包含 feature_name, description, justification）\n\n"
+    "請用 JSON 格式輸出，範例如下：\n"
+    "```json\n"
+    "{\n"
+    '  "persona_id": "1",\n'
+    '  "description": "...",\n'
+    '  "motivation": "...",\n'
+    '  "challenges": "...",\n'
+    '  "learning_goals": "...",\n'
+    '  "preferred_learning_methods": "...",\n'
+    '  "suggested_learning_resources": [\n'
+    "    {\n"
+    '      "feature_name": "...",\n'
+    '      "description": "...",\n'
+    '      "justification": "..." \n'
+    "    }\n"
+    "  ]\n"
+    "}\n"
+    "```\n"
+    "請確保只輸出上述 JSON，不要有其他文字說明。"
+)
 
-    prompt = generate_prompt(full_text, is_csv=False)
-    personas, messages = await _generate_personas(prompt, api_key)
-    return _save_personas(personas, output_folder, "md", messages)
+# JSON 模式下要求模型輸出的結構，欄位與 PERSONA_OUTPUT_SPEC 一致
+_TEXT = {"type": "STRING"}
+PERSONA_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "persona_id": _TEXT,
+            "description": _TEXT,
+            "motivation": _TEXT,
+            "challenges": _TEXT,
+            "learning_goals": _TEXT,
+            "preferred_learning_methods": _TEXT,
+            "suggested_learning_resources": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {"feature_name": _TEXT, "description": _TEXT, "justification": _TEXT},
+                },
+            },
+        },
+        "required": ["persona_id", "description", "motivation", "challenges"],
+    },
+}
 
 def generate_prompt(full_text, is_csv=True):
     """根據是問卷還是訪談，自動生成 prompt"""
     source_type = "問卷" if is_csv else "訪談"
+    # 問卷資料以精簡 CSV 傳入，第一列為欄位名稱
+    data_format = "（CSV 格式，第一列為欄位名稱）" if is_csv else ""
     return (
-        f"這是{source_type}資料：\n{full_text}\n\n"
-        "請根據以上資料，統整分析，生成完整的課程受眾 persona 概觀，每個 persona 包含以下欄位：\n"
-        "- persona_id（1開始編號）\n"
-        "- description（受眾整體概括描述）\n"
-        "- motivation（學習動機）\n"
-        "- challenges（面臨挑戰與痛點）\n"
-        "- learning_goals（學習目標）\n"
-        "- preferred_learning_methods（偏好學習方式）\n"
-        "- suggested_learning_resources（推薦學習資源，包含 feature_name, description, justification）\n\n"
-        "請用 JSON 格式輸出，範例如下：\n"
-        "```json\n"
-        "{\n"
-        '  "persona_id": "1",\n'
-        '  "description": "...",\n'
-        '  "motivation": "...",\n'
-        '  "challenges": "...",\n'
-        '  "learning_goals": "...",\n'
-        '  "preferred_learning_methods": "...",\n'
-        '  "suggested_learning_resources": [\n'
-        "    {\n"
-        '      "feature_name": "...",\n'
-        '      "description": "...",\n'
-        '      "justification": "..." \n'
-        "    }\n"
-        "  ]\n"
-        "}\n"
-        "```\n"
-        "請確保只輸出上述 JSON，不要有其他文字說明。"
+        f"這是{source_type}資料{data_format}：\n{full_text}\n\n"
+        "請根據以上資料，統整分析，生成完整的課程受眾 persona 概觀，"
+        + PERSONA_OUTPUT_SPEC
+    )
+
+def prompt_overhead_tokens(is_csv=True):
+    """生成 prompt 中資料以外（範本與輸出格式說明）的 token 數，分批時從每批預算中扣除"""
+    return count_tokens(generate_prompt("", is_csv=is_csv))
+
+def generate_reduce_prompt(personas_text):
+    """map-reduce 模式的彙整 prompt：把多份中間 persona 摘要合併成一組 persona"""
+    return (
+        "以下是從同一份資料的不同部分分別整理出的 persona 摘要，每行一個 JSON 物件：\n"
+        f"{personas_text}\n\n"
+        "請合併重複或相似的 persona，保留各群體的差異，統整成能代表整份資料的課程受眾 persona 概觀，"
+        + PERSONA_OUTPUT_SPEC
     )
 
 # 在文件頂部添加配置參數
-BATCH_SIZE = 15000          # 每批大約字符數
-BATCH_WAIT_TIME = 5         # 批次間等待時間（秒）
-LARGE_FILE_THRESHOLD = 40000  # 大文件閾值（tokens）
+BATCH_SIZE = CHUNK_TOKEN_BUDGET  # 每批資料的 token 預算
+LARGE_FILE_THRESHOLD = SINGLE_SHOT_TOKEN_LIMIT  # 大文件閾值（tokens）
+MAX_CONCURRENT_CHUNKS = int(os.getenv("MAX_CONCURRENT_CHUNKS", 4))  # 同時進行中的批次上限
+MAX_REDUCE_LEVELS = 4         # map-reduce 模式最多的彙整層數
+SYNTHESIS_MODES = ('flat', 'mapreduce')
 
 @retry(
     stop=stop_after_attempt(MAX_RETRIES),
     wait=wait_exponential(multiplier=1, min=MIN_WAIT, max=MAX_WAIT),
     retry=retry_if_exception_type((RateLimitError, RuntimeError, asyncio.TimeoutError))
 )
-async def _generate_personas(prompt, api_key=None):
-    """直接使用 Gemini API 生成 personas，不使用 autogen-agentchat"""
+async def _generate_personas(prompt, api_key=None, use_cache=True):
+    """直接使用 Gemini API 生成 personas，不使用 autogen-agentchat
+
+    相同模型與 prompt 的結果會存入磁碟快取，命中時直接回傳，不呼叫 API；
+    use_cache=False 時略過讀取快取（成功的結果仍會寫回快取）。
+    """
+    cache = get_response_cache()
+    cache_key = make_key(GEMINI_MODEL, prompt)
+    if use_cache:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            print(f"回應快取命中 {cache_key[:12]}，略過 API 呼叫")
+            messages = [{"content": prompt, "role": "user"}, {"content": cached['response_text'], "role": "assistant"}]
+            return cached['personas'], messages
+    
     try:
-        # 使用傳入的 API Key 或從環境變數獲取
-        if api_key:
-            genai.configure(api_key=api_key)
-        else:
-            api_key_env = os.getenv("Gemini_api")
-            if api_key_env:
-                genai.configure(api_key=api_key_env)
-            else:
-                raise ValueError("缺少 Google API Key")
+        # 使用傳入的 API Key 或從環境變數獲取；不呼叫 genai.configure，避免不同請求互相覆蓋全域 key
+        api_key = api_key or os.getenv("Gemini_api")
+        if not api_key:
+            raise ValueError("缺少 Google API Key")
+        
+        # 同一把 API Key 的所有呼叫共用限流器，每次嘗試（含重試）都要取得配額
+        key_limiter = get_limiter(api_key)
+        await key_limiter.acquire(count_tokens(prompt))
         
         # 設置較長的超時時間
         timeout = 60  # 60 秒超時
         
-        model = genai.GenerativeModel(GEMINI_MODEL)
-        
-        # 使用超時控制
-        async def run_with_timeout():
-            # 由於 genai 庫沒有異步支持，我們在執行緒池中執行同步 API 呼叫
-            loop = asyncio.get_event_loop()
-            
-            def sync_call():
-                try:
-                    response = model.generate_content(prompt)
-                    return response.text
-                except Exception as e:
-                    print(f"Gemini API 呼叫錯誤: {e}")
-                    raise
-            
-            response_text = await loop.run_in_executor(None, sync_call)
-            return response_text
-        
-        # 設置超時
+        # 在 LLM 專用執行緒池中執行同步 API 呼叫；期限會傳到底層 gRPC 請求，逾時即中止
         try:
-            response_text = await asyncio.wait_for(run_with_timeout(), timeout=timeout)
+            response_text = await get_llm_executor().generate_async(
+                api_key, GEMINI_MODEL, prompt, timeout=timeout, **json_mode_options(PERSONA_RESPONSE_SCHEMA)
+            )
         except asyncio.TimeoutError:
             print(f"API 呼叫超時 ({timeout} 秒)")
             raise
+        except Exception as e:
+            if is_rate_limit_error(e):
+                # 由共用限流器降速並暫停，同一把 key 的其他請求（包含其他 worker）都會等待
+                await key_limiter.on_rate_limited_async(parse_retry_delay(str(e)))
+            raise
+        await key_limiter.on_success_async()
         
-        # 解析回應中的 JSON 格式 persona 數據
-        personas = []
+        # 解析回應中的 JSON 格式 persona 數據；JSON 模式回傳純 JSON，否則從 ```json 區塊或夾雜的文字中取出，
+        # 回應被截斷時保留已完整的 persona，不必為了格式問題再呼叫一次 API
         messages = [{"content": prompt, "role": "user"}, {"content": response_text, "role": "assistant"}]
-        
-        # 尋找 JSON 區塊
-        blocks = re.findall(r"```json\n(.*?)\n```", response_text, re.DOTALL)
-        for block in blocks:
-            try:
-                obj = json.loads(block)
-                if isinstance(obj, dict):
-                    personas.append(obj)
-                elif isinstance(obj, list):
-                    personas.extend(obj)
-            except json.JSONDecodeError as json_err:
-                print(f"JSON 解析錯誤: {json_err}")
-                # 嘗試修正 JSON 並再次解析
-                try:
-                    fixed_block = block.replace("'", '"').replace("\\", "\\\\")
-                    obj = json.loads(fixed_block)
-                    if isinstance(obj, dict):
-                        personas.append(obj)
-                    elif isinstance(obj, list):
-                        personas.extend(obj)
-                except Exception as fix_err:
-                    print(f"修正 JSON 失敗: {fix_err}，略過此區塊")
+        personas = extract_objects(response_text)
         
         # 檢查是否找到有效的 personas
         if personas:
+            cache.set(cache_key, {'model': GEMINI_MODEL, 'response_text': response_text, 'personas': personas})
             return personas, messages
         else:
             print("API 返回無效: 未找到有效的 persona 資料")
@@ -243,7 +331,7 @@ async def _generate_personas(prompt, api_key=None):
         error_str = str(e)
         
         # 檢查是否為速率限制錯誤 (429 或 503)
-        if "429" in error_str or "RateLimitError" in error_str or "overloaded" in error_str:
+        if is_rate_limit_error(e) or "overloaded" in error_str:
             print(f"遇到 API 速率限制或過載錯誤: {error_str}")
             # 重試裝飾器會處理重試
             raise
@@ -252,166 +340,260 @@ async def _generate_personas(prompt, api_key=None):
             print(f"發生其他錯誤: {error_str}")
             raise
         
-async def process_large_csv(csv_path, output_folder, batch_size=BATCH_SIZE, api_key=None):
-    """處理大型 CSV 文件，分批發送到 API"""
-    with open(csv_path, 'rb') as f:
-        encoding = chardet.detect(f.read(10000))['encoding']
-    
-    df = pd.read_csv(csv_path, encoding=encoding)
-    full_text = df.to_string(index=False)
-    
-    # 計算 token 數量
-    estimated_tokens = len(full_text) / 2
-    print(f"大型CSV資料總長度：{len(full_text)} 字元，估算約 {int(estimated_tokens)} tokens")
-    print(f"將進行分批處理，每批約 {batch_size/2} tokens")
-    
-    # 分割文本為多個較小的部分
-    chunks = []
-    for i in range(0, len(full_text), batch_size):
-        chunks.append(full_text[i:i + batch_size])
-    
-    print(f"共分割為 {len(chunks)} 個批次")
-    
-    all_personas = []
-    all_messages = []
-    
-    for i, chunk in enumerate(chunks):
-        print(f"處理第 {i+1}/{len(chunks)} 批次，大小約 {len(chunk) / 2} tokens")
-        
+async def _run_chunks(chunks, build_prompt, api_key=None, max_chunk_retries=2,
+                      retry_wait=lambda n: 15 * n, use_cache=True, progress_callback=None,
+                      stage='generating', conversation_log=None):
+    """並行處理多個批次，回傳依批次順序排列的 (personas, messages) 串列
+
+    chunks 可以是串列或產生器：MAX_CONCURRENT_CHUNKS 個 worker 共用同一個迭代器，
+    每次只取出下一個批次，因此記憶體中最多只有 MAX_CONCURRENT_CHUNKS 個批次的文字。
+    取出批次（可能需要讀檔與 tokenize）與寫入對話紀錄都在執行緒中進行，不阻塞事件迴圈。
+    實際的呼叫速率交給 _generate_personas 內的共用限流器控制。
+    每個批次完成時以 progress_callback 回報該批次的 personas；有 conversation_log 時
+    對話在批次完成當下就寫入紀錄，回傳結果中不再保留完整的 prompt。
+    串流讀取在中途失敗（例如無法解碼）時停止取出後續批次，保留已完成的批次；
+    一個批次都沒完成時才拋出讀取時的錯誤。
+    """
+    chunk_iter = enumerate(chunks)
+    chunk_iter_lock = asyncio.Lock()  # 產生器不能同時在多個執行緒中執行
+    results = {}
+    ingest_error = None
+
+    def next_chunk():
+        nonlocal ingest_error
+        if ingest_error is not None:
+            return None
+        try:
+            item = next(chunk_iter, None)
+        except Exception as e:
+            ingest_error = e
+            print(f"讀取批次資料失敗，停止取出後續批次: {e}")
+            return None
+        if item is None:
+            return None
+        i, chunk = item
+        return i, chunk, count_tokens(chunk)
+
+    async def run_chunk(i, chunk, chunk_tokens):
         # 為每個批次生成專屬提示
-        chunk_prompt = generate_prompt(chunk, is_csv=True)
-        
+        chunk_prompt = build_prompt(chunk)
+        print(f"處理第 {i+1} 批次，大小約 {chunk_tokens} tokens")
         retry_count = 0
-        max_chunk_retries = 2  # 每個批次最多重試次數
-        
         while retry_count <= max_chunk_retries:
             try:
-                # 處理此批次
-                chunk_personas, chunk_messages = await _generate_personas(chunk_prompt, api_key)
-                
-                # 添加批次信息到每個 persona
-                for p in chunk_personas:
-                    p['batch_info'] = f"Batch {i+1}/{len(chunks)}"
-                
-                # 收集結果
-                all_personas.extend(chunk_personas)
-                all_messages.extend(chunk_messages)
-                
-                # 批次之間等待短暫時間，避免過度頻繁的 API 調用
+                chunk_personas, chunk_messages = await _generate_personas(chunk_prompt, api_key, use_cache=use_cache)
                 print(f"批次 {i+1} 完成，生成了 {len(chunk_personas)} 個 personas")
-                if i < len(chunks) - 1:  # 如果不是最後一個批次
-                    wait_time = 5  # 等待 5 秒
-                    print(f"等待 {wait_time} 秒後處理下一批次...")
-                    await asyncio.sleep(wait_time)
-                
-                # 成功處理，跳出重試循環
-                break
-                
+                return chunk_personas, chunk_messages
             except Exception as e:
                 retry_count += 1
                 print(f"批次 {i+1} 處理出錯: {e}")
                 
                 if retry_count <= max_chunk_retries:
-                    wait_time = min(60, 15 * retry_count)  # 逐漸增加等待時間
+                    if is_rate_limit_error(e):
+                        # 暫停時間已記錄在共用限流器，下一次取得配額時才會放行，不需要另外等待
+                        print(f"重試批次 {i+1} ({retry_count}/{max_chunk_retries})，等待限流器放行...")
+                        continue
+                    wait_time = retry_wait(retry_count)
                     print(f"將在 {wait_time} 秒後重試批次 {i+1} ({retry_count}/{max_chunk_retries})...")
                     await asyncio.sleep(wait_time)
                 else:
-                    print(f"批次 {i+1} 已達最大重試次數，繼續處理下一批次")
-                    # 記錄錯誤但繼續處理下一個批次
+                    # 記錄錯誤但不影響其他批次
+                    print(f"批次 {i+1} 已達最大重試次數，略過此批次")
+        return [], []
+
+    async def worker():
+        while True:
+            async with chunk_iter_lock:
+                item = await asyncio.to_thread(next_chunk)
+            if item is None:
+                return
+            i, chunk, chunk_tokens = item
+            chunk_personas, chunk_messages = await run_chunk(i, chunk, chunk_tokens)
+            if conversation_log is not None and chunk_messages:
+                await asyncio.to_thread(conversation_log.append, chunk_messages, body=chunk, stage=stage, chunk=i + 1)
+                chunk_messages = []
+            results[i] = (chunk_personas, chunk_messages)
+            _notify(progress_callback, stage, chunk=i + 1, completed=len(results), personas=results[i][0])
+
+    await asyncio.gather(*(worker() for _ in range(MAX_CONCURRENT_CHUNKS)))
+    if ingest_error is not None and not results:
+        raise ingest_error
+    print(f"共處理 {len(results)} 個批次")
+    return [results[i] for i in sorted(results)]
+
+async def _dispatch_chunks(chunks, api_key=None, max_chunk_retries=2, retry_wait=lambda n: 15 * n,
+                          use_cache=True, progress_callback=None, conversation_log=None, is_csv=True):
+    """並行處理多個問卷（或訪談）批次，結果依原本的批次順序重新組合並標上 batch_info"""
+    results = await _run_chunks(
+        chunks, lambda chunk: generate_prompt(chunk, is_csv=is_csv), api_key,
+        max_chunk_retries=max_chunk_retries, retry_wait=retry_wait, use_cache=use_cache,
+        progress_callback=progress_callback, conversation_log=conversation_log
+    )
+
+    total = len(results)
+    all_personas = []
+    all_messages = []
+    for i, (chunk_personas, chunk_messages) in enumerate(results):
+        # 添加批次信息到每個 persona
+        for p in chunk_personas:
+            p['batch_info'] = f"Batch {i+1}/{total}"
+        all_personas.extend(chunk_personas)
+        all_messages.extend(chunk_messages)
+    return all_personas, all_messages
+
+def _group_by_tokens(items, token_budget):
+    """將已序列化的 persona 依 token 預算分組，每組至少一個"""
+    groups = []
+    current = []
+    size = 0
+    for item in items:
+        item_tokens = count_tokens_uncached(item) + 1
+        if current and size + item_tokens > token_budget:
+            groups.append(current)
+            current = []
+            size = 0
+        current.append(item)
+        size += item_tokens
+    if current:
+        groups.append(current)
+    return groups
+
+async def _reduce_personas(personas, api_key=None, token_budget=BATCH_SIZE, use_cache=True, progress_callback=None,
+                           conversation_log=None, **retry_options):
+    """map-reduce 的 reduce 階段：逐層彙整中間 persona，直到能放進單一 prompt
+
+    每一層把 persona 依 token 預算分組並行彙整，組數每層遞減，深度約為對數級；
+    彙整結果的 batch_info 為該組所有來源批次。任何一層失敗或層數過多時，
+    改用向量相似度合併作為備援。
+    """
+    messages = []
+    for level in range(1, MAX_REDUCE_LEVELS + 1):
+        items = []
+        for p in personas:
+            summary = {k: v for k, v in p.items() if k not in ('batch_info', 'merged_count')}
+            items.append(json.dumps(summary, ensure_ascii=False, separators=(',', ':')))
+        groups = _group_by_tokens(items, token_budget)
+        group_sources = []
+        start = 0
+        for group in groups:
+            sources = []
+            for p in personas[start:start + len(group)]:
+                batch_info = p.get('batch_info')
+                for info in (batch_info if isinstance(batch_info, list) else [batch_info]):
+                    if info and info not in sources:
+                        sources.append(info)
+            group_sources.append(sources)
+            start += len(group)
+
+        print(f"彙整第 {level} 層：{len(personas)} 個 persona 分為 {len(groups)} 組")
+        _notify(progress_callback, 'reducing', level=level, groups=len(groups))
+        results = await _run_chunks(
+            ["\n".join(group) for group in groups], generate_reduce_prompt, api_key,
+            use_cache=use_cache, progress_callback=progress_callback, stage='reducing',
+            conversation_log=conversation_log, **retry_options
+        )
+
+        reduced = []
+        for (group_personas, group_messages), sources in zip(results, group_sources):
+            if not group_personas:
+                print(f"彙整第 {level} 層有組別失敗，改用相似度合併")
+                return merge_personas(personas), messages
+            for p in group_personas:
+                p['batch_info'] = sources
+            reduced.extend(group_personas)
+            messages.extend(group_messages)
+        personas = reduced
+
+        if len(groups) == 1:
+            return [dict(p, persona_id=str(i + 1)) for i, p in enumerate(personas)], messages
+
+    print(f"已達最大彙整層數 {MAX_REDUCE_LEVELS}，改用相似度合併剩餘 persona")
+    return merge_personas(personas), messages
+
+async def _consolidate_personas(personas, messages, synthesis_mode, api_key=None, token_budget=BATCH_SIZE,
+                                use_cache=True, progress_callback=None, conversation_log=None, **retry_options):
+    """依合成模式整併各批次的 persona：flat 以相似度合併，mapreduce 以 LLM 逐層彙整"""
+    _notify(progress_callback, 'consolidating', mode=synthesis_mode, persona_count=len(personas))
+    if synthesis_mode == 'mapreduce':
+        personas, reduce_messages = await _reduce_personas(
+            personas, api_key, token_budget=token_budget, use_cache=use_cache,
+            progress_callback=progress_callback, conversation_log=conversation_log, **retry_options
+        )
+        return personas, messages + reduce_messages
+    # 各批次各自從 1 編號且內容高度重疊，合併相似的 persona
+    return merge_personas(personas), messages
+
+async def process_large_csv(csv_path, output_folder, batch_size=BATCH_SIZE, api_key=None, use_cache=True,
+                            synthesis_mode='flat', progress_callback=None):
+    """處理大型 CSV 文件，分批發送到 API
+
+    synthesis_mode='flat' 時直接合併各批次結果；'mapreduce' 時再以 LLM 逐層彙整成整份資料的 persona。
+    """
+    # 串流讀取檔案，依列邊界產生帶有標題列的批次，不會一次載入整個檔案；
+    # 編碼只依檔案開頭偵測，後段無法解碼的字元直接替換，避免已送出的批次因檔尾一個錯字而白費
+    print(f"大型CSV將進行串流分批處理，每批約 {batch_size} tokens")
+    # 建立迭代器時就會偵測編碼並讀入第一段資料，在執行緒中進行以免阻塞共用的事件迴圈
+    chunks = await asyncio.to_thread(iter_csv_chunks, csv_path, batch_size, encoding_errors='replace',
+                                     measure=count_tokens_uncached)
+    
+    retry_options = dict(
+        max_chunk_retries=2,
+        retry_wait=lambda n: min(60, 15 * n)  # 逐漸增加等待時間
+    )
+    # 對話紀錄隨批次完成逐段寫入
+    conversation_log = ConversationLog.start(output_folder, "csv")
+    all_personas, all_messages = await _dispatch_chunks(
+        chunks, api_key, use_cache=use_cache, progress_callback=progress_callback,
+        conversation_log=conversation_log, **retry_options
+    )
     
     # 如果至少有一些 personas 成功生成，則保存它們
     if all_personas:
         print(f"全部批次處理完成，共收集到 {len(all_personas)} 個 personas")
-        return _save_personas(all_personas, output_folder, "csv", all_messages)
+        all_personas, all_messages = await _consolidate_personas(
+            all_personas, all_messages, synthesis_mode, api_key, token_budget=batch_size,
+            use_cache=use_cache, progress_callback=progress_callback,
+            conversation_log=conversation_log, **retry_options
+        )
+        _notify(progress_callback, 'saving')
+        return await asyncio.to_thread(_save_personas, all_personas, output_folder, "csv", all_messages, conversation_log)
     else:
         raise ValueError("所有批次處理都失敗，未能生成任何 persona")
 
-async def process_large_csv2(csv_path, output_folder, batch_size=15000, api_key=None):
-    """處理大型 CSV2 文件，使用改進的錯誤處理策略"""
+async def process_large_csv2(csv_path, output_folder, batch_size=BATCH_SIZE, api_key=None, use_cache=True,
+                             synthesis_mode='flat', progress_callback=None):
+    """處理大型 CSV2 文件，使用改進的錯誤處理策略
+
+    synthesis_mode 與 process_large_csv 相同：'flat' 或 'mapreduce'。
+    """
     try:
-        # 嘗試使用不同的編碼方式讀取檔案
-        encoding = None
-        try:
-            with open(csv_path, 'rb') as f:
-                encoding_result = chardet.detect(f.read(10000))
-                encoding = encoding_result['encoding']
-                print(f"檢測到文件編碼：{encoding}，置信度：{encoding_result['confidence']}")
-        except Exception as e:
-            print(f"檢測編碼時出錯：{e}，將使用 utf-8")
-            encoding = 'utf-8'
-        
-        try:
-            df = pd.read_csv(csv_path, encoding=encoding)
-        except UnicodeDecodeError:
-            print(f"使用 {encoding} 解碼失敗，嘗試 utf-8 編碼")
-            df = pd.read_csv(csv_path, encoding='utf-8', errors='replace')
-        
-        full_text = df.to_string(index=False)
-        
-        # 計算 token 數量
-        estimated_tokens = len(full_text) / 2
-        print(f"大型CSV2資料總長度：{len(full_text)} 字元，估算約 {int(estimated_tokens)} tokens")
-        print(f"將進行分批處理，每批約 {batch_size/2} tokens")
+        # 串流讀取時無法在中途改用其他編碼，因此遇到無法解碼的字元直接替換
+        print(f"大型CSV2將進行串流分批處理，每批約 {batch_size} tokens")
+        chunks = await asyncio.to_thread(iter_csv_chunks, csv_path, batch_size, encoding_errors='replace',
+                                         measure=count_tokens_uncached)
         
-        # 分割文本為多個較小的部分
-        chunks = []
-        for i in range(0, len(full_text), batch_size):
-            chunks.append(full_text[i:i + batch_size])
-        
-        print(f"共分割為 {len(chunks)} 個批次")
-        
-        all_personas = []
-        all_messages = []
-        
-        for i, chunk in enumerate(chunks):
-            print(f"處理第 {i+1}/{len(chunks)} 批次，大小約 {len(chunk) / 2} tokens")
-            
-            # 為每個批次生成專屬提示
-            chunk_prompt = generate_prompt(chunk, is_csv=True)
-            
-            # 增加每個批次的重試次數和更長的等待時間
-            retry_count = 0
-            max_chunk_retries = 3
-            
-            while retry_count <= max_chunk_retries:
-                try:
-                    # 處理此批次
-                    chunk_personas, chunk_messages = await _generate_personas(chunk_prompt, api_key)
-                    
-                    # 添加批次信息到每個 persona
-                    for p in chunk_personas:
-                        p['batch_info'] = f"Batch {i+1}/{len(chunks)}"
-                    
-                    # 收集結果
-                    all_personas.extend(chunk_personas)
-                    all_messages.extend(chunk_messages)
-                    
-                    # 批次之間等待較長時間，避免 API 限制
-                    print(f"批次 {i+1} 完成，生成了 {len(chunk_personas)} 個 personas")
-                    if i < len(chunks) - 1:  # 如果不是最後一個批次
-                        wait_time = 20  # 增加到 20 秒
-                        print(f"等待 {wait_time} 秒後處理下一批次...")
-                        await asyncio.sleep(wait_time)
-                    
-                    # 成功處理，跳出重試循環
-                    break
-                        
-                except Exception as e:
-                    retry_count += 1
-                    print(f"批次 {i+1} 處理出錯: {e}")
-                    
-                    if retry_count <= max_chunk_retries:
-                        # 使用指數退避策略
-                        wait_time = min(120, 20 * (2 ** (retry_count - 1)))
-                        print(f"將在 {wait_time} 秒後重試批次 {i+1} ({retry_count}/{max_chunk_retries})...")
-                        await asyncio.sleep(wait_time)
-                    else:
-                        print(f"批次 {i+1} 已達最大重試次數，繼續處理下一批次")
+        # 增加每個批次的重試次數，並使用指數退避策略
+        retry_options = dict(
+            max_chunk_retries=3,
+            retry_wait=lambda n: min(120, 20 * (2 ** (n - 1)))
+        )
+        # 對話紀錄隨批次完成逐段寫入
+        conversation_log = ConversationLog.start(output_folder, "csv2")
+        all_personas, all_messages = await _dispatch_chunks(
+            chunks, api_key, use_cache=use_cache, progress_callback=progress_callback,
+            conversation_log=conversation_log, **retry_options
+        )
         
         # 如果至少有一些 personas 成功生成，則保存它們
         if all_personas:
             print(f"全部批次處理完成，共收集到 {len(all_personas)} 個 personas")
-            return _save_personas(all_personas, output_folder, "csv2", all_messages)
+            all_personas, all_messages = await _consolidate_personas(
+                all_personas, all_messages, synthesis_mode, api_key, token_budget=batch_size,
+                use_cache=use_cache, progress_callback=progress_callback,
+                conversation_log=conversation_log, **retry_options
+            )
+            _notify(progress_callback, 'saving')
+            return await asyncio.to_thread(_save_personas, all_personas, output_folder, "csv2", all_messages, conversation_log)
         else:
             # 在所有批次都失敗的情況下，返回空數據而不是拋出異常
             print("所有批次處理都失敗，返回空數據")
@@ -422,53 +604,48 @@ async def process_large_csv2(csv_path, output_folder, batch_size=15000, api_key=
         # 返回空結果以避免前端完全崩潰
         return "", "", "", []
     
-def _save_personas(personas, output_folder, prefix, messages):
-    """保存處理後的 personas 到檔案系統並返回路徑"""
+def _save_personas(personas, output_folder, prefix, messages, conversation_log=None, body=None):
+    """保存處理後的 personas 到檔案系統並返回路徑
+
+    對話紀錄寫入壓縮的 JSONL（conversation_log），回傳的紀錄路徑是下載時才匯出的 CSV 檔名；
+    body 是單次生成時的輸入資料，紀錄中只保存一次。
+    """
     # 確保輸出目錄存在
     out_dir = os.path.join(output_folder, "personas", prefix)
     os.makedirs(out_dir, exist_ok=True)
 
-    # 清理 persona 資料
-    cleaned_personas = [clean_persona(p) for p in personas if len(clean_persona(p)) > 1]
+    # 清理 persona 資料（每個 persona 只清理一次）
+    cleaned_personas = [c for c in (clean_persona(p) for p in personas) if len(c) > 1]
     
     # 如果沒有有效 persona，返回空結果
     if not cleaned_personas:
         print(f"警告: 沒有找到有效的 personas")
         return "", "", "", []
 
-    # 為每個 persona 設定正確 ID 並保存到獨立檔案
+    # 為每個 persona 設定正確 ID
     for p in cleaned_personas:
         pid = p.get("persona_id", "unknown")
         # 確保 ID 有正確的前綴
         if not str(pid).startswith(f"{prefix}_"):
             p["persona_id"] = f"{prefix}_{pid}"
-            
-        # 保存個別 persona 檔案
-        persona_file = os.path.join(out_dir, f"PERSONA-{p['persona_id']}.json")
-        with open(persona_file, 'w', encoding='utf-8') as f:
-            json.dump(p, f, ensure_ascii=False, indent=4)
-        print(f"保存 persona 到 {persona_file}")
 
-    # 合併所有 personas 成一個 json
+    # 個別 persona 檔案、合併的 json 與 zip 一次寫出，zip 只包含本次的 personas
     all_personas_path = os.path.join(output_folder, "personas", f"{prefix}_personas.json")
-    with open(all_personas_path, 'w', encoding='utf-8') as f:
-        json.dump(cleaned_personas, f, ensure_ascii=False, indent=4)
-    print(f"合併 personas 到 {all_personas_path}")
-
-    # 壓縮成 zip
     zip_path = os.path.join(output_folder, f"{prefix}_personas.zip")
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(out_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, out_dir)
-                zipf.write(file_path, arcname)
-    print(f"壓縮 personas 到 {zip_path}")
-
-    # 保存對話紀錄
-    output_csv_path = os.path.join(output_folder, f"all_{prefix}_conve_log.csv")
-    pd.DataFrame(messages).to_csv(output_csv_path, index=False, encoding='utf-8-sig')
-    print(f"保存對話紀錄到 {output_csv_path}")
+    write_persona_artifacts(cleaned_personas, all_personas_path, zip_path, persona_dir=out_dir)
+
+    # 寫入 persona store，評估時依 ID 直接查詢，不必掃描資料夾
+    try:
+        get_persona_store().save_run(cleaned_personas, prefix)
+    except Exception as e:
+        print(f"寫入 persona store 失敗: {e}")
+
+    # 保存對話紀錄；分批處理時已在各批次完成時寫入，這裡只補上尚未寫入的部分
+    if conversation_log is None:
+        conversation_log = ConversationLog.start(output_folder, prefix)
+    conversation_log.append(messages, body=body)
+    output_csv_path = os.path.join(output_folder, conversation_log.export_name)
+    print(f"保存對話紀錄到 {conversation_log.path}")
 
     print(f"全部處理完成，共產生 {len(cleaned_personas)} 個 personas")
     return output_csv_path, zip_path, all_personas_path, cleaned_personas
@@ -0,0 +1,94 @@
+# persona_catalog.py
+import os
+import json
+import bisect
+import hashlib
+import threading
+
+PERSONA_SOURCES = ("csv", "csv2", "md")
+
+
+class PersonaCatalog:
+    """/load-personas 使用的記憶體快取
+
+    讀取 outputs/personas/{source}_personas.json 合併檔，只有檔案的 mtime 或大小改變時才重新解析；
+    結果依 persona_id 排序並去重（同 ID 保留最後載入的），version 可作為 ETag 使用。
+    """
+
+    def __init__(self, base_dir, sources=PERSONA_SOURCES):
+        self.base_dir = base_dir
+        self.sources = sources
+        self._lock = threading.Lock()
+        self._signature = None
+        self._version = None
+        self._entries = []   # [(persona_id, source, persona)]，依 persona_id 排序
+        self._ids = []
+
+    def _current_signature(self):
+        signature = []
+        for source in self.sources:
+            path = os.path.join(self.base_dir, f"{source}_personas.json")
+            try:
+                stat = os.stat(path)
+                signature.append((source, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append((source, None, None))
+        return tuple(signature)
+
+    def _load(self):
+        unique = {}
+        raw_count = 0
+        for source in self.sources:
+            path = os.path.join(self.base_dir, f"{source}_personas.json")
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except Exception as e:
+                print(f"載入 {path} 時出錯: {e}")
+                continue
+            raw_count += len(data)
+            for persona in data:
+                # 過濾掉沒有 description 的
+                if not persona.get('description'):
+                    continue
+                persona_id = str(persona.get('persona_id', ''))
+                unique.pop(persona_id, None)  # 重複的 ID 保留最後一個
+                unique[persona_id] = (persona_id, source, persona)
+        entries = sorted(unique.values(), key=lambda entry: entry[0])
+        print(f"重新載入 personas：原始 {raw_count} 個，過濾去重後 {len(entries)} 個")
+        return entries
+
+    def snapshot(self):
+        """回傳 (version, entries, ids)，檔案未變更時直接使用快取"""
+        signature = self._current_signature()
+        with self._lock:
+            if signature != self._signature:
+                self._entries = self._load()
+                self._ids = [entry[0] for entry in self._entries]
+                self._signature = signature
+                self._version = hashlib.sha1(repr(signature).encode('utf-8')).hexdigest()[:16]
+            return self._version, self._entries, self._ids
+
+    def page(self, cursor=None, limit=None, source=None, query=None):
+        """取得一頁 personas
+
+        cursor 為上一頁最後一個 persona_id，limit 為每頁數量（None 表示全部），
+        source 依來源類型過濾，query 以關鍵字比對 description。
+        回傳 (version, personas, next_cursor, total)。
+        """
+        version, entries, ids = self.snapshot()
+        if source or query:
+            entries = [
+                entry for entry in entries
+                if (not source or entry[1] == source)
+                and (not query or query in str(entry[2].get('description', '')))
+            ]
+            ids = [entry[0] for entry in entries]
+        total = len(entries)
+        start = bisect.bisect_right(ids, cursor) if cursor else 0
+        end = total if limit is None else min(total, start + limit)
+        personas = [entry[2] for entry in entries[start:end]]
+        next_cursor = ids[end - 1] if start < end < total else None
+        return version, personas, next_cursor, total
@@ -0,0 +1,140 @@
+# persona_merge.py
+import os
+import re
+import math
+from collections import Counter
+import numpy as np
+
+# 相似度高於此門檻的 persona 視為重複，可用環境變數覆寫
+MERGE_SIMILARITY_THRESHOLD = float(os.getenv("MERGE_SIMILARITY_THRESHOLD", 0.55))
+
+# 用來比對相似度的欄位
+TEXT_FIELDS = ['description', 'motivation', 'challenges', 'learning_goals', 'preferred_learning_methods']
+
+_CJK_RE = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+")
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+
+
+def _field_text(value):
+    if isinstance(value, list):
+        return " ".join(_field_text(v) for v in value)
+    if isinstance(value, dict):
+        return " ".join(_field_text(v) for v in value.values())
+    return str(value) if value else ""
+
+
+def _terms(text):
+    """中文取字元 bigram，英數取小寫單字"""
+    terms = []
+    for run in _CJK_RE.findall(text):
+        if len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    terms.extend(word.lower() for word in _WORD_RE.findall(text))
+    return terms
+
+
+def _tfidf_matrix(documents):
+    """以 NumPy 建立 L2 正規化的 TF-IDF 矩陣（列為文件）"""
+    counts = [Counter(_terms(doc)) for doc in documents]
+    vocab = {}
+    for counter in counts:
+        for term in counter:
+            vocab.setdefault(term, len(vocab))
+
+    matrix = np.zeros((len(documents), max(len(vocab), 1)), dtype=np.float32)
+    for row, counter in enumerate(counts):
+        for term, count in counter.items():
+            matrix[row, vocab[term]] = 1.0 + math.log(count)
+
+    doc_freq = np.count_nonzero(matrix, axis=0)
+    idf = np.log((1.0 + len(documents)) / (1.0 + doc_freq)) + 1.0
+    matrix *= idf.astype(np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _clusters(similarity, threshold):
+    """以 union-find 將相似度超過門檻的 persona 分群"""
+    parent = list(range(len(similarity)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows, cols = np.nonzero(np.triu(similarity >= threshold, k=1))
+    for i, j in zip(rows.tolist(), cols.tolist()):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[root_j] = root_i
+
+    groups = {}
+    for i in range(len(similarity)):
+        groups.setdefault(find(i), []).append(i)
+    # 依群組中第一個 persona 的原始順序排列
+    return sorted(groups.values(), key=lambda members: members[0])
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return list(value) if isinstance(value, list) else [value]
+
+
+def _merge_cluster(personas, members, similarity):
+    """以群組內與其他成員平均相似度最高的 persona 為代表，合併來源與學習資源"""
+    if len(members) == 1:
+        canonical = dict(personas[members[0]])
+    else:
+        sub = similarity[np.ix_(members, members)]
+        canonical = dict(personas[members[int(np.argmax(sub.sum(axis=1)))]])
+
+    batch_info = []
+    resources = []
+    seen_resources = set()
+    for index in members:
+        for info in _as_list(personas[index].get('batch_info')):
+            if info not in batch_info:
+                batch_info.append(info)
+        for resource in personas[index].get('suggested_learning_resources') or []:
+            name = resource.get('feature_name') if isinstance(resource, dict) else str(resource)
+            if name in seen_resources:
+                continue
+            seen_resources.add(name)
+            resources.append(resource)
+
+    if batch_info:
+        canonical['batch_info'] = batch_info
+    if resources:
+        canonical['suggested_learning_resources'] = resources
+    canonical['merged_count'] = len(members)
+    return canonical
+
+
+def merge_personas(personas, threshold=None):
+    """將批次產生的 persona 中相似者合併為一個代表 persona
+
+    回傳新的 persona 串列，persona_id 依合併後的順序重新從 1 編號，
+    batch_info 改為列出所有來源批次，merged_count 記錄合併的數量。
+    """
+    if threshold is None:
+        threshold = MERGE_SIMILARITY_THRESHOLD
+    if len(personas) < 2:
+        return [dict(p, persona_id=str(i + 1)) for i, p in enumerate(personas)]
+
+    documents = [" ".join(_field_text(p.get(field)) for field in TEXT_FIELDS) for p in personas]
+    matrix = _tfidf_matrix(documents)
+    similarity = matrix @ matrix.T
+
+    merged = []
+    for members in _clusters(similarity, threshold):
+        canonical = _merge_cluster(personas, members, similarity)
+        canonical['persona_id'] = str(len(merged) + 1)
+        merged.append(canonical)
+
+    print(f"Persona 去重：{len(personas)} 個合併為 {len(merged)} 個（相似度門檻 {threshold}）")
+    return merged
@@ -0,0 +1,117 @@
+# persona_store.py
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+# 與限流狀態同樣放在 outputs/state，清理程序不會刪除，查詢不必退回掃描資料夾
+PERSONA_DB_PATH = os.getenv("PERSONA_DB_PATH", os.path.join("outputs", "state", "personas.db"))
+_SQLITE_MAX_VARIABLES = 500   # 每次 IN 查詢的參數數量上限
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS personas (
+    persona_id TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    run_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_personas_source ON personas(source);
+CREATE INDEX IF NOT EXISTS idx_personas_run ON personas(run_id);
+"""
+
+
+class PersonaStore:
+    """以 SQLite 保存 persona，persona_id 為主鍵，並以來源類型與生成批次建立索引
+
+    每次操作開新連線，可在多個執行緒間共用。資料庫放在清理程序不處理的 outputs/state，
+    persona 檔案過期被刪除後仍可依 ID 查詢。
+    """
+
+    def __init__(self, path=PERSONA_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def save_run(self, personas, source, run_id=None):
+        """寫入一次生成的 personas（同 ID 覆寫），回傳 run_id"""
+        run_id = run_id or uuid.uuid4().hex
+        now = time.time()
+        rows = [
+            (str(p.get('persona_id')), source, run_id, now, json.dumps(p, ensure_ascii=False))
+            for p in personas if p.get('persona_id') is not None
+        ]
+        with self._lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO personas (persona_id, source, run_id, created_at, data) "
+                        "VALUES (?, ?, ?, ?, ?)", rows
+                    )
+            finally:
+                conn.close()
+        return run_id
+
+    def get_many(self, persona_ids):
+        """依主鍵查詢，回傳 {persona_id: persona}，找不到的 ID 不會出現在結果中"""
+        ids = list(dict.fromkeys(str(pid) for pid in persona_ids))
+        found = {}
+        conn = self._connect()
+        try:
+            for i in range(0, len(ids), _SQLITE_MAX_VARIABLES):
+                batch = ids[i:i + _SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                for persona_id, data in conn.execute(
+                    f"SELECT persona_id, data FROM personas WHERE persona_id IN ({placeholders})", batch
+                ):
+                    found[persona_id] = json.loads(data)
+        finally:
+            conn.close()
+        return found
+
+    def list_personas(self, source=None, run_id=None):
+        """依來源類型或生成批次列出 personas"""
+        query = "SELECT data FROM personas"
+        clauses = []
+        params = []
+        if source:
+            clauses.append("source = ?")
+            params.append(source)
+        if run_id:
+            clauses.append("run_id = ?")
+            params.append(run_id)
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        conn = self._connect()
+        try:
+            return [json.loads(data) for (data,) in conn.execute(query + " ORDER BY persona_id", params)]
+        finally:
+            conn.close()
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            return dict(conn.execute("SELECT source, COUNT(*) FROM personas GROUP BY source").fetchall())
+        finally:
+            conn.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_persona_store():
+    """取得行程內共用的 persona store"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = PersonaStore()
+        return _store
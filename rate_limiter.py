@@ -0,0 +1,312 @@
+# rate_limiter.py
+import os
+import re
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from google.api_core.exceptions import ResourceExhausted
+
+# Gemini 免費方案的預設配額（每分鐘請求數 / 每分鐘 tokens），可用環境變數覆寫
+DEFAULT_RPM = int(os.getenv("GEMINI_RPM", 15))
+DEFAULT_TPM = int(os.getenv("GEMINI_TPM", 1000000))
+# AIMD：遇到 429 時速率乘上 RATE_DECREASE_FACTOR，之後每次成功增加 RATE_INCREASE 個 RPM，直到 DEFAULT_RPM
+MIN_RPM = float(os.getenv("GEMINI_MIN_RPM", 1))
+RATE_INCREASE = float(os.getenv("RATE_INCREASE", 0.5))
+RATE_DECREASE_FACTOR = float(os.getenv("RATE_DECREASE_FACTOR", 0.5))
+# 限流狀態的保存方式：sqlite 讓同一台主機上的多個 gunicorn worker 共用配額，memory 只在行程內共用
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "sqlite")
+# 放在 outputs/state 子資料夾：清理程序只刪除 outputs 最上層的過期檔案，不會刪到共用的限流狀態
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", os.path.join("outputs", "state", "rate_limits.db"))
+
+
+def is_rate_limit_error(error):
+    """是否為速率限制錯誤：ResourceExhausted、RateLimitError，或狀態碼為 429 / RESOURCE_EXHAUSTED
+
+    只依例外型別與狀態碼判斷，不比對錯誤訊息，避免訊息中剛好出現 429（例如 4290 tokens）時誤判。
+    """
+    if isinstance(error, ResourceExhausted) or type(error).__name__ == 'RateLimitError':
+        return True
+    code = getattr(error, 'code', None)
+    if callable(code):  # grpc.RpcError 的 code() 回傳 grpc.StatusCode
+        try:
+            code = code()
+        except Exception:
+            code = None
+    if getattr(code, 'name', None) == 'RESOURCE_EXHAUSTED':
+        return True
+    return 429 in (code, getattr(error, 'status_code', None))
+
+
+def parse_retry_delay(error_msg):
+    """從錯誤消息中提取伺服器建議的 retry_delay（加 1 秒緩衝），沒有提示時回傳 None"""
+    match = re.search(r'retry_delay\s*{\s*seconds:\s*(\d+)\s*}', error_msg)
+    if match:
+        return int(match.group(1)) + 1
+    return None
+
+
+class TokenBucketLimiter:
+    """以「每分鐘請求數」與「每分鐘 tokens」為單位的 AIMD token bucket 限流器
+
+    兩個桶各自補充，呼叫 acquire() 時必須兩個桶都足夠才放行。請求桶的補充速率（rate）會自動調整：
+    on_rate_limited() 把速率乘上 RATE_DECREASE_FACTOR、清空請求桶並暫停到 retry_delay 之後，
+    on_success() 每次把速率加回 RATE_INCREASE，最多回到 rpm。
+    狀態以 threading.Lock 保護，可以在多個事件迴圈 / 執行緒之間共用；
+    子類別覆寫 _transaction() 即可改為跨行程保存。
+    """
+
+    def __init__(self, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, min_rpm=MIN_RPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.min_rpm = min(min_rpm, rpm)
+        self._state = self._initial_state(time.time())
+        self._lock = threading.Lock()
+
+    def _initial_state(self, now):
+        return {
+            'requests': float(self.rpm),
+            'tokens': float(self.tpm),
+            'updated': now,
+            'rate': float(self.rpm),
+            'resume_at': 0.0,
+        }
+
+    @contextmanager
+    def _transaction(self):
+        """取得可修改的狀態 dict，離開時保存"""
+        with self._lock:
+            yield self._state
+
+    def _refill(self, state, now):
+        elapsed = now - state['updated']
+        if elapsed > 0:
+            state['requests'] = min(state['rate'], state['requests'] + elapsed * state['rate'] / 60.0)
+            state['tokens'] = min(self.tpm, state['tokens'] + elapsed * self.tpm / 60.0)
+            state['updated'] = now
+
+    def try_acquire(self, tokens=0):
+        """嘗試取得配額，成功回傳 0，否則回傳建議的等待秒數"""
+        # 單一請求超過整桶容量時，以整桶計算，避免永遠等不到
+        tokens = min(tokens, self.tpm)
+        with self._transaction() as state:
+            now = time.time()
+            if state['resume_at'] > now:
+                return state['resume_at'] - now
+            self._refill(state, now)
+            if state['requests'] >= 1 and state['tokens'] >= tokens:
+                state['requests'] -= 1
+                state['tokens'] -= tokens
+                return 0
+            wait_requests = max(0.0, (1 - state['requests']) * 60.0 / state['rate'])
+            wait_tokens = max(0.0, (tokens - state['tokens']) * 60.0 / self.tpm)
+            return max(wait_requests, wait_tokens, 0.05)
+
+    async def acquire(self, tokens=0):
+        """非同步等待直到取得一個請求與指定數量的 tokens
+
+        try_acquire 可能需要等待檔案鎖（SQLite），因此在執行緒中執行，不阻塞事件迴圈。
+        """
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, tokens)
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        """加法增加：每次成功把速率加回 RATE_INCREASE，最多到 rpm"""
+        with self._transaction() as state:
+            if state['rate'] < self.rpm:
+                self._refill(state, time.time())
+                state['rate'] = min(float(self.rpm), state['rate'] + RATE_INCREASE)
+
+    def on_rate_limited(self, retry_delay=None):
+        """乘法減少：收到 429 / ResourceExhausted 時降低速率並暫停
+
+        retry_delay 為伺服器建議的等待秒數；沒有提示時等待降速後補充一個請求所需的時間。
+        回傳實際暫停的秒數。
+        """
+        with self._transaction() as state:
+            now = time.time()
+            self._refill(state, now)
+            state['rate'] = max(self.min_rpm, state['rate'] * RATE_DECREASE_FACTOR)
+            state['requests'] = 0.0
+            if retry_delay is None:
+                retry_delay = 60.0 / state['rate']
+            state['resume_at'] = max(state['resume_at'], now + retry_delay)
+            rate = state['rate']
+        print(f"API Key 遇到速率限制，暫停 {retry_delay:.0f} 秒，每分鐘請求數降為 {rate:.1f}")
+        return retry_delay
+
+    async def on_success_async(self):
+        """在執行緒中執行 on_success，供協程使用"""
+        await asyncio.to_thread(self.on_success)
+
+    async def on_rate_limited_async(self, retry_delay=None):
+        """在執行緒中執行 on_rate_limited，供協程使用，回傳實際暫停的秒數"""
+        return await asyncio.to_thread(self.on_rate_limited, retry_delay)
+
+    def stats(self):
+        with self._transaction() as state:
+            now = time.time()
+            self._refill(state, now)
+            return {
+                'rate_rpm': round(state['rate'], 2),
+                'available_requests': round(state['requests'], 2),
+                'paused_seconds': round(max(0.0, state['resume_at'] - now), 1),
+            }
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    requests REAL NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    rate REAL NOT NULL,
+    resume_at REAL NOT NULL
+);
+"""
+_STATE_FIELDS = ('requests', 'tokens', 'updated', 'rate', 'resume_at')
+
+
+class SQLiteTokenBucketLimiter(TokenBucketLimiter):
+    """狀態保存在 SQLite 的 TokenBucketLimiter，同一台主機上的多個行程共用同一份配額
+
+    每次操作以 BEGIN IMMEDIATE 取得寫入鎖，讀出、更新、寫回同一筆資料列；
+    資料列以 API Key 的雜湊為鍵，不保存原始 key。每個執行緒保留自己的連線重複使用，
+    資料庫檔案被刪除或替換（inode 改變）時重新開啟，避免繼續寫入已刪除的檔案而與其他行程分家。
+    等待寫入鎖可能需要數秒，協程應使用 acquire() 等非同步方法。
+    """
+
+    def __init__(self, key, path=RATE_LIMIT_DB_PATH, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM, min_rpm=MIN_RPM):
+        super().__init__(rpm=rpm, tpm=tpm, min_rpm=min_rpm)
+        self.key = key
+        self.path = path
+        self._local = threading.local()
+        self._connection()
+
+    def _inode(self):
+        try:
+            return os.stat(self.path).st_ino
+        except OSError:
+            return None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._inode() != self._local.inode:
+            conn.close()
+            conn = None
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+            self._local.inode = self._inode()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    f"SELECT {', '.join(_STATE_FIELDS)} FROM rate_limits WHERE key = ?", (self.key,)
+                ).fetchone()
+                state = dict(zip(_STATE_FIELDS, row)) if row else self._initial_state(time.time())
+                state['rate'] = min(state['rate'], float(self.rpm))  # rpm 設定調低時立即生效
+                yield state
+                conn.execute(
+                    f"INSERT OR REPLACE INTO rate_limits (key, {', '.join(_STATE_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?)",
+                    (self.key,) + tuple(state[field] for field in _STATE_FIELDS)
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+
+class AdaptiveLimiter:
+    """遇到 429 時才降速的並行上限（供單一事件迴圈中的協程使用）
+
+    平常允許 max_concurrent 個請求同時進行；收到速率限制錯誤時，
+    所有請求暫停到伺服器建議的 retry_delay 之後，並把並行上限減半。
+    之後每連續成功「目前上限」次就把上限加一，逐步回到 max_concurrent。
+    """
+
+    def __init__(self, max_concurrent, min_concurrent=1):
+        self.max_concurrent = max_concurrent
+        self.min_concurrent = min_concurrent
+        self.limit = max_concurrent
+        self.active = 0
+        self.resume_at = 0.0
+        self.rate_limited = 0
+        self._successes = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                wait = self.resume_at - time.monotonic()
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.active < self.limit:
+                    self.active += 1
+                    return
+                await self._cond.wait()
+
+    async def release(self):
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        """取得一個執行名額，離開時釋放"""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            await self.release()
+
+    def on_success(self):
+        self._successes += 1
+        if self.limit < self.max_concurrent and self._successes >= self.limit:
+            self.limit += 1
+            self._successes = 0
+
+    def on_rate_limited(self, retry_delay):
+        """收到 429 / ResourceExhausted：暫停 retry_delay 秒並把並行上限減半"""
+        self.rate_limited += 1
+        self._successes = 0
+        self.resume_at = max(self.resume_at, time.monotonic() + retry_delay)
+        self.limit = max(self.min_concurrent, self.limit // 2)
+        print(f"遇到速率限制，暫停 {retry_delay} 秒，並行上限降為 {self.limit}")
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(api_key, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM):
+    """取得指定 API Key 共用的限流器，同一把 key 的所有請求（persona 生成與評估）共享同一份配額
+
+    RATE_LIMIT_BACKEND=sqlite（預設）時狀態保存在 RATE_LIMIT_DB_PATH，多個 worker 行程也共用配額。
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(api_key)
+        if limiter is None:
+            if RATE_LIMIT_BACKEND == "sqlite":
+                key = hashlib.sha256((api_key or "").encode('utf-8')).hexdigest()[:16]
+                limiter = SQLiteTokenBucketLimiter(key, rpm=rpm, tpm=tpm)
+            else:
+                limiter = TokenBucketLimiter(rpm=rpm, tpm=tpm)
+            _limiters[api_key] = limiter
+        return limiter
@@ -0,0 +1,153 @@
+# response_cache.py
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 快取設定，可用環境變數覆寫
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", os.path.join("outputs", "cache", "personas"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 200 * 1024 * 1024))  # 200MB
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 7 * 24 * 3600))                  # 7 天
+
+
+def make_key(model, prompt):
+    """以 (模型名稱, prompt) 的內容雜湊作為快取鍵"""
+    digest = hashlib.sha256()
+    digest.update(model.encode('utf-8'))
+    digest.update(b"\0")
+    digest.update(prompt.encode('utf-8', errors='replace'))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """以內容雜湊定址的磁碟快取
+
+    每個項目是一個 JSON 檔，讀取命中時更新檔案的 mtime，
+    總大小超過上限時依 mtime 由舊到新淘汰（LRU），超過 TTL 的項目視為未命中並刪除。
+    建立時掃描一次資料夾，之後以記憶體中的索引（依最近使用排序）與總大小計算淘汰，
+    寫入時不必重新掃描；其他行程寫入的項目在下次啟動掃描時才計入。
+    """
+
+    def __init__(self, directory=RESPONSE_CACHE_DIR, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                 ttl=RESPONSE_CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # path -> 檔案大小，由最久未使用到最近使用
+        self._total = 0
+        self._scan()
+
+    def _scan(self):
+        """掃描快取資料夾，依 mtime 建立索引與總大小"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        with self._lock:
+            self._index = OrderedDict((path, size) for _, size, path in entries)
+            self._total = sum(size for _, size, _ in entries)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """取得快取項目，未命中或已過期時回傳 None"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if time.time() - entry.get('created', 0) > self.ttl:
+            self._remove(path)
+            with self._lock:
+                self._forget(path)
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(path, None)  # 更新 mtime 作為最近使用時間
+        except OSError:
+            pass
+        with self._lock:
+            if path in self._index:
+                self._index.move_to_end(path)
+            self.hits += 1
+        return entry
+
+    def set(self, key, value):
+        """寫入快取項目；先寫入暫存檔再 rename，避免其他讀取者看到寫一半的檔案"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = dict(value, created=time.time())
+        data = json.dumps(entry, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"寫入回應快取失敗: {e}")
+            self._remove(tmp_path)
+            return
+        with self._lock:
+            self._forget(path)
+            self._index[path] = len(data)
+            self._total += len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _forget(self, path):
+        """從索引移除項目（呼叫端需持有 _lock）"""
+        size = self._index.pop(path, None)
+        if size is not None:
+            self._total -= size
+
+    def _evict(self):
+        """總大小超過上限時，從最久未使用的項目開始刪除（呼叫端需持有 _lock）"""
+        while self._total > self.max_bytes and self._index:
+            path, size = self._index.popitem(last=False)
+            self._total -= size
+            self._remove(path)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._index), 'bytes': self._total}
+
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """取得行程內共用的回應快取"""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
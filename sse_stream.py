@@ -0,0 +1,186 @@
+# sse_stream.py
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+from collections import deque
+
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", 15))   # 沒有事件時送出註解行的間隔（秒）
+SSE_BUFFER_SIZE = int(os.getenv("SSE_BUFFER_SIZE", 1000))                 # 每個串流保留供續傳的事件數
+SSE_RESUME_GRACE = float(os.getenv("SSE_RESUME_GRACE", 30))              # 用戶端斷線後等待重新連線的時間（秒）
+SSE_STREAM_TTL = float(os.getenv("SSE_STREAM_TTL", 600))                 # 串流結束後保留供續傳的時間（秒）
+
+
+def format_event(event_id, data):
+    """event_id 為 None 時不帶 id 行，瀏覽器保留原本的 Last-Event-ID"""
+    if event_id is None:
+        return f"data: {json.dumps(data)}\n\n"
+    return f"id: {event_id}\ndata: {json.dumps(data)}\n\n"
+
+
+class EventStream:
+    """單一請求的事件緩衝區
+
+    背景工作以 publish() 發布事件，每個事件依序編號；SSE 回應在 Condition 上等待新事件，
+    不需要輪詢。最近 SSE_BUFFER_SIZE 個事件會保留，用戶端可以用 Last-Event-ID 從中斷處續傳。
+    Last-Event-ID 之後的事件已被淘汰時，先送出 type=reset 再從緩衝區最早的事件開始重送。
+    所有連線都斷開超過 SSE_RESUME_GRACE 秒仍未重新連線時，取消 cancel_token。
+    """
+
+    def __init__(self, cancel_token=None, buffer_size=SSE_BUFFER_SIZE):
+        self.id = uuid.uuid4().hex
+        self.cancel_token = cancel_token
+        self.closed_at = None
+        self._events = deque(maxlen=buffer_size)
+        self._next_id = 1
+        self._subscribers = 0
+        self._cancel_timer = None
+        self._cond = threading.Condition()
+
+    @property
+    def closed(self):
+        return self.closed_at is not None
+
+    def publish(self, data):
+        with self._cond:
+            self._events.append((self._next_id, data))
+            self._next_id += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            if self.closed_at is None:
+                self.closed_at = time.time()
+            if self._cancel_timer is not None:
+                self._cancel_timer.cancel()
+                self._cancel_timer = None
+            self._cond.notify_all()
+
+    def wait(self, after_id, timeout):
+        """等待編號大於 after_id 的事件，回傳 (events, closed)；逾時時 events 為空串列"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.closed or (self._events and self._events[-1][0] > after_id), timeout)
+            return [event for event in self._events if event[0] > after_id], self.closed
+
+    def resume_gap(self, last_event_id):
+        """last_event_id 之後的事件無法完整續傳時回傳 reset 事件內容，否則回傳 None"""
+        if not last_event_id:
+            return None
+        with self._cond:
+            oldest = self._events[0][0] if self._events else self._next_id
+            if last_event_id >= self._next_id:
+                reason = 'Last-Event-ID 不屬於此串流'
+            elif last_event_id < oldest - 1:
+                reason = '中斷期間的部分事件已不在緩衝區'
+            else:
+                return None
+        return {'type': 'reset', 'reason': reason, 'last_event_id': last_event_id, 'oldest_event_id': oldest}
+
+    def attach(self):
+        with self._cond:
+            self._subscribers += 1
+            if self._cancel_timer is not None:
+                self._cancel_timer.cancel()
+                self._cancel_timer = None
+
+    def detach(self):
+        with self._cond:
+            self._subscribers -= 1
+            if self._subscribers or self.closed or self.cancel_token is None:
+                return
+            # 最後一個連線斷開：保留一段時間讓用戶端以 Last-Event-ID 重新連線，逾時才取消工作
+            self._cancel_timer = threading.Timer(SSE_RESUME_GRACE, self._cancel_if_abandoned)
+            self._cancel_timer.daemon = True
+            self._cancel_timer.start()
+
+    def _cancel_if_abandoned(self):
+        with self._cond:
+            if self._subscribers or self.closed:
+                return
+        self.cancel_token.cancel('用戶端已斷線')
+
+    def iter_sse(self, last_event_id=0, heartbeat=SSE_HEARTBEAT_INTERVAL):
+        """產生 SSE 文字：從 last_event_id 之後開始，沒有事件時每 heartbeat 秒送出註解行保持連線"""
+        self.attach()
+        try:
+            yield f": stream {self.id}\n\n"
+            last = last_event_id
+            reset = self.resume_gap(last_event_id)
+            if reset is not None:
+                # 用戶端需捨棄已收到的狀態，之後從緩衝區最早的事件重新接收
+                yield format_event(None, reset)
+                last = 0
+            while True:
+                events, closed = self.wait(last, heartbeat)
+                for event_id, data in events:
+                    yield format_event(event_id, data)
+                    last = event_id
+                if events:
+                    continue
+                if closed:
+                    return
+                yield ": heartbeat\n\n"
+        finally:
+            self.detach()
+
+
+class StreamRegistry:
+    """依 stream id 保存進行中與最近結束的串流，供續傳端點查詢"""
+
+    def __init__(self, ttl=SSE_STREAM_TTL):
+        self.ttl = ttl
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def _purge(self, now):
+        expired = [sid for sid, s in self._streams.items() if s.closed and now - s.closed_at > self.ttl]
+        for sid in expired:
+            del self._streams[sid]
+
+    def start(self, work, cancel_token=None, label="串流"):
+        """建立串流並在背景執行緒執行 work(publish)
+
+        work 發布的事件依序送給用戶端；work 拋出例外時發布 type=error，結束後關閉串流。
+        """
+        stream = EventStream(cancel_token)
+        with self._lock:
+            self._purge(time.time())
+            self._streams[stream.id] = stream
+
+        def run():
+            try:
+                work(stream.publish)
+            except Exception as e:
+                print(f"{label} 處理錯誤: {str(e)}")
+                traceback.print_exc()
+                stream.publish({'type': 'error', 'error': str(e)})
+            finally:
+                stream.close()
+
+        threading.Thread(target=run, daemon=True, name=f"sse-{stream.id[:8]}").start()
+        return stream
+
+    def get(self, stream_id):
+        with self._lock:
+            self._purge(time.time())
+            return self._streams.get(stream_id)
+
+    def stats(self):
+        with self._lock:
+            active = sum(1 for s in self._streams.values() if not s.closed)
+            return {'active': active, 'retained': len(self._streams) - active}
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_stream_registry():
+    """取得行程內共用的串流登記表"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = StreamRegistry()
+        return _registry
@@ -299,6 +299,119 @@ function showToast(message, type = 'info') {
     }, 3500);
 }
 
+// ====== 以 SSE 送出 persona 生成請求 ======
+// 逐批顯示進度與初步產生的 persona，完成時以最終回應 resolve（格式與非串流回應相同）
+const STREAM_MAX_RESUMES = 3;
+
+function streamPersonaRequest(url, formData, progressId) {
+    return new Promise((resolve, reject) => {
+        let buffer = '';
+        let finished = false;
+        let streamId = null;
+        let lastEventId = 0;
+        let resumes = 0;
+        const previewPersonas = [];
+        $(`#${progressId} > p`).text('正在處理中，請稍候...');
+
+        function handleEvent(data) {
+            if (data.type === 'progress') {
+                if (data.message) {
+                    $(`#${progressId} > p`).text(data.message);
+                }
+            } else if (data.type === 'personas') {
+                // 批次結果尚未去重，先顯示預覽，完成後再重新載入正式列表
+                previewPersonas.push(...data.personas);
+                displayPersonas(previewPersonas);
+            } else if (data.type === 'complete') {
+                finished = true;
+                resolve(data);
+            } else if (data.type === 'error') {
+                finished = true;
+                reject(new Error(data.error));
+            }
+        }
+
+        function consume(text) {
+            buffer += text;
+            // 只處理完整的事件，最後一段可能還沒收完；以 ":" 開頭的心跳註解行會被略過
+            const parts = buffer.split('\n\n');
+            buffer = parts.pop();
+            parts.forEach(part => {
+                const lines = part.split('\n');
+                const idLine = lines.find(line => line.startsWith('id: '));
+                const dataStr = lines
+                    .filter(line => line.startsWith('data: '))
+                    .map(line => line.substring(6))
+                    .join('\n');
+                if (!dataStr.trim()) {
+                    return;
+                }
+                if (idLine) {
+                    lastEventId = parseInt(idLine.substring(4), 10) || lastEventId;
+                }
+                try {
+                    handleEvent(JSON.parse(dataStr));
+                } catch (error) {
+                    console.error('解析串流數據錯誤:', error, dataStr);
+                }
+            });
+        }
+
+        // 連線中斷時，以 Last-Event-ID 從中斷處續傳，伺服器端的處理不會重新開始
+        function connectionLost(message) {
+            if (finished) {
+                return;
+            }
+            if (streamId && resumes < STREAM_MAX_RESUMES) {
+                resumes += 1;
+                buffer = '';
+                console.warn(`串流中斷，第 ${resumes} 次續傳（最後事件 ${lastEventId}）`);
+                open('GET', `/streams/${streamId}`, null);
+            } else {
+                reject(new Error(message));
+            }
+        }
+
+        function open(method, target, body) {
+            const xhr = new XMLHttpRequest();
+            let lastProcessedPosition = 0;
+            xhr.open(method, target, true);
+            xhr.setRequestHeader('Accept', 'text/event-stream');
+            if (lastEventId) {
+                xhr.setRequestHeader('Last-Event-ID', String(lastEventId));
+            }
+
+            xhr.onprogress = function() {
+                streamId = streamId || xhr.getResponseHeader('X-Stream-Id');
+                const currentResponse = xhr.responseText;
+                consume(currentResponse.substring(lastProcessedPosition));
+                lastProcessedPosition = currentResponse.length;
+            };
+
+            xhr.onload = function() {
+                if (xhr.status >= 400) {
+                    let message = '未知錯誤';
+                    try {
+                        message = JSON.parse(xhr.responseText).error || message;
+                    } catch (e) {}
+                    reject(new Error(message));
+                    return;
+                }
+                consume(xhr.responseText.substring(lastProcessedPosition) + '\n\n');
+                connectionLost('串流連線提前結束');
+            };
+
+            xhr.onerror = function() {
+                connectionLost('網路連線錯誤');
+            };
+
+            xhr.send(body);
+        }
+
+        open('POST', url, formData);
+    });
+}
+
 // ====== 上傳 CSV 處理 ======
 function processCSVForm() {
     return new Promise((resolve, reject) => {
@@ -326,15 +439,11 @@ function processCSVForm() {
         const formData = new FormData();
         formData.append('csv_file', fileInput.files[0]);
         formData.append('api_key', apiKey);  // 添加API Key
+        formData.append('synthesis_mode', $('#csv-synthesis-mode').val() || 'flat');  // 大型檔案合成模式
         
-        // 發送AJAX請求
-        $.ajax({
-            url: '/process-csv',
-            type: 'POST',
-            data: formData,
-            processData: false,
-            contentType: false,
-            success: function(response) {
+        // 以串流方式發送請求，逐批接收進度與 persona
+        streamPersonaRequest('/process-csv', formData, 'csv-progress')
+        .then(function(response) {
                 // 隱藏進度條，恢復按鈕
                 $('#csv-progress').addClass('d-none');
                 $('#csv-submit').prop('disabled', false);
@@ -354,7 +463,7 @@ function processCSVForm() {
                     
                     // 顯示批次資訊（如果有的話）
                     if (response.personas.length > 0 && response.personas[0].batch_info) {
-                        const batches = [...new Set(response.personas.map(p => p.batch_info))];
+                        const batches = [...new Set(response.personas.flatMap(p => [].concat(p.batch_info || [])))];
                         const batchInfoHtml = `
                             <div class="alert alert-info mt-2">
                               <small>已使用 ${batches.length} 個批次處理 (${batches.join(', ')})</small>
@@ -372,14 +481,13 @@ function processCSVForm() {
                 }
                 
                 resolve(response);
-            },
-            error: function(error) {
+        })
+        .catch(function(error) {
                 $('#csv-progress').addClass('d-none');
                 $('#csv-submit').prop('disabled', false);
-                showToast('處理CSV檔案時出錯: ' + (error.responseJSON ? error.responseJSON.error : '未知錯誤'), 'danger');
+                showToast('處理CSV檔案時出錯: ' + (error.message || '未知錯誤'), 'danger');
                 console.error('Error:', error);
                 reject(error);
-            }
         });
     });
 }
@@ -413,15 +521,11 @@ function processCSV2Form() {
             formData.append('csv_file', files[i]);
         }
         formData.append('api_key', apiKey);  // 添加API Key
+        formData.append('synthesis_mode', $('#csv2-synthesis-mode').val() || 'flat');  // 大型檔案合成模式
         
-        // 發送AJAX請求
-        $.ajax({
-            url: '/process-csv2',
-            type: 'POST',
-            data: formData,
-            processData: false,
-            contentType: false,
-            success: function(response) {
+        // 以串流方式發送請求，逐批接收進度與 persona
+        streamPersonaRequest('/process-csv2', formData, 'csv2-progress')
+        .then(function(response) {
                 $('#csv2-progress').addClass('d-none');
                 $('#csv2-submit').prop('disabled', false);
                 
@@ -452,14 +556,13 @@ function processCSV2Form() {
                 }
                 
                 resolve(response);
-            },
-            error: function(error) {
+        })
+        .catch(function(error) {
                 $('#csv2-progress').addClass('d-none');
                 $('#csv2-submit').prop('disabled', false);
-                showToast('處理CSV檔案時出錯: ' + (error.responseJSON ? error.responseJSON.error : '未知錯誤'), 'danger');
+                showToast('處理CSV檔案時出錯: ' + (error.message || '未知錯誤'), 'danger');
                 console.error('Error:', error);
                 reject(error);
-            }
         });
     });
 }
@@ -493,15 +596,11 @@ function processMDForm() {
             formData.append('md_files[]', files[i]);
         }
         formData.append('api_key', apiKey);  // 添加API Key
+        formData.append('synthesis_mode', $('#md-synthesis-mode').val() || 'flat');  // 大量訪談合成模式
         
-        // 發送AJAX請求
-        $.ajax({
-            url: '/process-md',
-            type: 'POST',
-            data: formData,
-            processData: false,
-            contentType: false,
-            success: function(response) {
+        // 以串流方式發送請求，逐批接收進度與 persona
+        streamPersonaRequest('/process-md', formData, 'md-progress')
+        .then(function(response) {
                 $('#md-progress').addClass('d-none');
                 $('#md-submit').prop('disabled', false);
                 
@@ -532,14 +631,13 @@ function processMDForm() {
                 }
                 
                 resolve(response);
-            },
-            error: function(error) {
+        })
+        .catch(function(error) {
                 $('#md-progress').addClass('d-none');
                 $('#md-submit').prop('disabled', false);
-                showToast('處理MD檔案時出錯: ' + (error.responseJSON ? error.responseJSON.error : '未知錯誤'), 'danger');
+                showToast('處理MD檔案時出錯: ' + (error.message || '未知錯誤'), 'danger');
                 console.error('Error:', error);
                 reject(error);
-            }
         });
     });
 }
@@ -646,11 +744,7 @@ xhr.onprogress = function(e) {
                             $('#feedback-result').removeClass('d-none');
                             
                             // 設置圖表
-                            if (data.chart) {
-                                $('#score-chart').attr('src', 'data:image/png;base64,' + data.chart);
-                            } else {
-                                $('#score-chart').html('<div class="alert alert-warning">無法生成圖表</div>');
-                            }
+                            drawScoreChart(data.chart_spec);
                             
                             // 處理其他結果數據
                             processBuyReasons(data.feedback);
@@ -705,21 +799,13 @@ xhr.onprogress = function(e) {
                                     generateFeedbackCards(feedback);
                                     window.feedbackData = feedback;
                                     window.marketingCopy = marketingCopy;
-                                }
-                            } catch (extractError) {
-                                console.error('無法提取 feedback 數據:', extractError);
-                            }
-                            
-                            // 嘗試提取圖表數據
-                            try {
-                                const chartMatch = safeDataStr.match(/"chart":\s*"([^"]+)"/);
-                                if (chartMatch) {
-                                    $('#score-chart').attr('src', 'data:image/png;base64,' + chartMatch[1]);
+                                    // 由 feedback 自行組出圖表資料
+                                    drawScoreChart(buildChartSpec(feedback));
                                 } else {
                                     $('#score-chart').html('<div class="alert alert-info">圖表數據暫時無法顯示</div>');
                                 }
-                            } catch (chartError) {
-                                console.error('無法提取圖表數據:', chartError);
+                            } catch (extractError) {
+                                console.error('無法提取 feedback 數據:', extractError);
                                 $('#score-chart').html('<div class="alert alert-info">圖表數據暫時無法顯示</div>');
                             }
                             
@@ -1100,55 +1186,77 @@ function updateSelectAllCheckbox() {
 }
 
 // ====== 畫出購買意願分數長條圖 ======
-function drawScoreChart(feedback, avgScore) {
-    if (!feedback || feedback.length === 0) {
-        $('#score-chart').html('<div class="alert alert-info">目前沒有可顯示的評估資料。</div>');
+function scoreColor(score) {
+    if (score >= 8) return '#E36E6C';  // 高分使用紅色系
+    if (score >= 6) return '#4E374C';  // 中高分使用深色系
+    if (score >= 4) return '#F7C375';  // 中低分使用橙色系
+    return '#E9DCCB';                  // 低分使用淺色系
+}
+
+// 與後端 chart_render.chart_spec 相同格式的圖表資料
+function buildChartSpec(feedback) {
+    if (!feedback || feedback.length === 0) return null;
+    const sorted = feedback.slice().sort((a, b) => String(a.persona_id).localeCompare(String(b.persona_id)));
+    const scores = sorted.map(item => item.score);
+    const valid = scores.filter(s => s > 0);
+    return {
+        title: '各 Persona 購買意願評分',
+        y_title: '評分 (1-10)',
+        y_range: [0, 10],
+        labels: sorted.map(item => `Persona ${item.persona_id}`),
+        scores: scores,
+        colors: scores.map(scoreColor),
+        avg_score: valid.length ? valid.reduce((a, b) => a + b, 0) / valid.length : 0
+    };
+}
+
+function drawScoreChart(spec) {
+    const chart = $('#score-chart');
+    if (!spec || !spec.labels || spec.labels.length === 0) {
+        chart.html('<div class="alert alert-info">目前沒有可顯示的評估資料。</div>');
         return;
     }
-
-    const labels = feedback.map(item => `Persona-${item.persona_id}`);
-    const scores = feedback.map(item => item.score);
+    if (typeof Plotly === 'undefined') {
+        chart.html('<div class="alert alert-warning">無法載入圖表元件</div>');
+        return;
+    }
+    chart.empty();
 
     const trace = {
-        x: scores,
-        y: labels,
+        x: spec.labels,
+        y: spec.scores,
         type: 'bar',
-        orientation: 'h',
-        text: scores.map(String),
-        textposition: 'outside',
-        hoverinfo: 'x+y',
-        marker: {
-            color: scores.map(s =>
-                s >= 8 ? 'green' :
-                s >= 6 ? 'blue' :
-                s >= 4 ? 'orange' : 'red'
-            )
-        }
+        text: spec.scores.map(String),
+        textposition: 'auto',
+        marker: { color: spec.colors }
     };
 
     const layout = {
-        title: '各 Persona 購買意願分數',
+        title: spec.title,
         shapes: [{
             type: 'line',
-            x0: avgScore, x1: avgScore,
-            y0: -0.5, y1: labels.length - 0.5,
-            line: { color: 'red', width: 2, dash: 'dash' }
+            x0: -0.5, x1: spec.labels.length - 0.5,
+            y0: spec.avg_score, y1: spec.avg_score,
+            line: { color: '#4E374C', width: 2, dash: 'dash' }
         }],
         annotations: [{
-            x: avgScore,
-            y: labels.length - 0.5,
-            text: `平均購買意願 ${avgScore.toFixed(1)}`,
+            x: spec.labels.length - 1,
+            y: spec.avg_score,
+            text: `平均: ${spec.avg_score.toFixed(1)}`,
             showarrow: true,
-            arrowhead: 2,
-            ax: 40,
-            ay: -40
+            arrowhead: 1,
+            bgcolor: '#E9DCCB',
+            bordercolor: '#4E374C',
+            borderwidth: 1
         }],
-        margin: { l: 100 },
-        xaxis: { title: '得分', range: [0, 10] },
-        yaxis: { title: 'Persona' }
+        yaxis: { title: spec.y_title, range: spec.y_range },
+        xaxis: { tickangle: 45 },
+        template: 'plotly_white',
+        height: 500,
+        margin: { l: 50, r: 50, t: 50, b: 150 }
     };
 
-    Plotly.newPlot('score-chart', [trace], layout);
+    Plotly.newPlot('score-chart', [trace], layout, { responsive: true });
 }
 
 // ====== 通用進度更新函數 ======
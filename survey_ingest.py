@@ -0,0 +1,55 @@
+# survey_ingest.py
+import chardet
+import pandas as pd
+from survey_serializer import format_row, iter_frame_lines, chunk_lines
+
+ROWS_PER_READ = 1000  # 每次從檔案讀入的列數
+
+
+def detect_encoding(csv_path, sample_size=10000):
+    """只讀取檔案開頭的樣本來偵測編碼，偵測失敗時使用 utf-8"""
+    try:
+        with open(csv_path, 'rb') as f:
+            encoding_result = chardet.detect(f.read(sample_size))
+        encoding = encoding_result['encoding'] or 'utf-8'
+        print(f"檢測到文件編碼：{encoding}，置信度：{encoding_result['confidence']}")
+        return encoding
+    except Exception as e:
+        print(f"檢測編碼時出錯：{e}，將使用 utf-8")
+        return 'utf-8'
+
+
+def iter_csv_lines(csv_path, encoding=None, encoding_errors='strict', rows_per_read=ROWS_PER_READ):
+    """逐段讀取 CSV，回傳 (標題列, 資料行產生器)
+
+    檔案以 pandas 的 chunksize 分段讀入，每段轉成文字行後即釋放，
+    記憶體用量只與 rows_per_read 有關，與檔案大小無關。
+    """
+    encoding = encoding or detect_encoding(csv_path)
+    reader = pd.read_csv(csv_path, encoding=encoding, encoding_errors=encoding_errors,
+                         chunksize=rows_per_read)
+    first = next(reader, None)
+    if first is None:
+        reader.close()
+        return "", iter(())
+
+    def lines():
+        try:
+            yield from iter_frame_lines(first)
+            for frame in reader:
+                yield from iter_frame_lines(frame)
+        finally:
+            reader.close()
+
+    return format_row(first.columns), lines()
+
+
+def iter_csv_chunks(csv_path, max_size, encoding=None, encoding_errors='strict',
+                    rows_per_read=ROWS_PER_READ, measure=len):
+    """串流產生 prompt 大小的 CSV 批次，每批都帶有標題列，可直接交給批次派送
+
+    max_size 的單位由 measure 決定：預設為字元數，傳入 token 計數函式則為 tokens。
+    """
+    header, lines = iter_csv_lines(csv_path, encoding=encoding, encoding_errors=encoding_errors,
+                                   rows_per_read=rows_per_read)
+    return chunk_lines(header, lines, max_size, measure=measure)
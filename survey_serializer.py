@@ -0,0 +1,60 @@
+# survey_serializer.py
+import io
+import csv
+import math
+
+
+def _clean_value(value):
+    """將單一欄位值轉成精簡字串：缺值轉為空字串，欄位內換行改為空白"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ""
+        if value.is_integer():
+            return str(int(value))
+    text = str(value)
+    if "\n" in text or "\r" in text:
+        text = " ".join(text.split())
+    return text
+
+
+def format_row(values):
+    """將一列資料格式化為一行 CSV（不含結尾換行，不做欄寬對齊）"""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="").writerow([_clean_value(v) for v in values])
+    return buffer.getvalue()
+
+
+def iter_frame_lines(df):
+    """逐列產生 DataFrame 的 CSV 文字行（不含標題列）"""
+    for row in df.itertuples(index=False, name=None):
+        yield format_row(row)
+
+
+def serialize_frame(df):
+    """將整個 DataFrame 轉為精簡的 CSV 文字，取代 df.to_string() 的對齊輸出"""
+    header = format_row(df.columns)
+    return "\n".join([header, *iter_frame_lines(df)])
+
+
+def chunk_lines(header, lines, max_size, measure=len):
+    """依列邊界將資料行切成多個批次，每個批次都重複標題列
+
+    measure 決定大小的計算方式（預設為字元數，也可傳入 token 計數函式）；
+    單一列超過 max_size 時仍會獨立成一個批次，不會被切斷。
+    """
+    header_size = measure(header)
+    chunk = [header]
+    size = header_size
+    for line in lines:
+        line_size = measure(line)
+        if len(chunk) > 1 and size + 1 + line_size > max_size:
+            yield "\n".join(chunk)
+            chunk = [header]
+            size = header_size
+        chunk.append(line)
+        size += 1 + line_size
+    if len(chunk) > 1:
+        yield "\n".join(chunk)
+
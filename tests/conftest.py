@@ -0,0 +1,25 @@
+# tests/conftest.py
+import os
+import sys
+
+# 測試直接匯入專案根目錄的模組
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """匯入 app 模組
+
+    app 載入時會在目前目錄建立 uploads/outputs 並啟動清理執行緒，
+    因此先切換到暫存資料夾，測試期間不會動到專案內的 outputs。
+    """
+    workdir = tmp_path_factory.mktemp("app")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    import app
+    app.app.config['UPLOAD_FOLDER'] = str(workdir / "uploads")
+    app.app.config['OUTPUT_FOLDER'] = str(workdir / "outputs")
+    yield app
+    os.chdir(cwd)
@@ -0,0 +1,134 @@
+# tests/test_cancellation.py
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import llm_executor
+import mcp_feedback
+from cancellation import CancelToken, OperationCancelled, run_cancellable
+from llm_executor import LLMExecutor
+from rate_limiter import TokenBucketLimiter
+from response_cache import ResponseCache
+
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class BlockingPool:
+    """第一個呼叫立即回應，之後的呼叫停住直到 release 被設定，記錄實際送出的 prompt"""
+
+    def __init__(self):
+        self.prompts = []
+        self.release = threading.Event()
+
+    def generate_content(self, api_key, model_name, prompt, timeout=None, **kwargs):
+        self.prompts.append(prompt)
+        if len(self.prompts) > 1:
+            self.release.wait(5)
+        return Response(json.dumps({'score': 7, 'reasons_to_buy': [], 'reasons_not_to_buy': []}))
+
+
+@pytest.fixture
+def single_worker(tmp_path, monkeypatch):
+    """只有一個 LLM 執行緒，其餘呼叫在佇列中等待"""
+    pool = BlockingPool()
+    executor = LLMExecutor(max_workers=1)
+    monkeypatch.setattr(llm_executor, 'get_client_pool', lambda: pool)
+    monkeypatch.setattr(mcp_feedback, 'get_llm_executor', lambda: executor)
+    limiter = TokenBucketLimiter(rpm=10000, tpm=10 ** 9)
+    monkeypatch.setattr(mcp_feedback, 'get_limiter', lambda api_key: limiter)
+    cache = ResponseCache(str(tmp_path / "feedback"))
+    monkeypatch.setattr(mcp_feedback, 'get_feedback_cache', lambda: cache)
+    yield pool, executor
+    pool.release.set()
+
+
+def personas(count):
+    return [{'persona_id': str(i + 1), 'description': f"學員 {i + 1}"} for i in range(count)]
+
+
+def wait_for_queue(executor, queued):
+    deadline = time.monotonic() + 5
+    while executor.stats()['queued'] < queued and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_run_cancellable_raises_with_partial():
+    token = CancelToken()
+
+    async def work():
+        token.partial = ['已完成']
+        await asyncio.sleep(10)
+
+    threading.Timer(0.05, token.cancel, args=('測試',)).start()
+    with pytest.raises(OperationCancelled) as info:
+        run_cancellable(work(), token)
+    assert info.value.partial == ['已完成']
+    assert str(info.value) == '測試'
+
+
+def test_cancel_feedback_keeps_completed_and_drops_queued_calls(single_worker):
+    pool, executor = single_worker
+    token = CancelToken()
+
+    def cancel_when_queued(current, total, batch_current, batch_total):
+        # 第一個評估完成時，其餘呼叫一個執行中、兩個在佇列中
+        threading.Thread(target=lambda: (wait_for_queue(executor, 2), token.cancel('用戶端已斷線'))).start()
+
+    with pytest.raises(OperationCancelled) as info:
+        mcp_feedback.run_mcp_feedback(personas(4), "新課程", progress_callback=cancel_when_queued, api_key='k',
+                                      batched=False, use_cache=False, cancel_token=token)
+
+    assert [f['score'] for f in info.value.partial] == [7]
+    pool.release.set()
+    time.sleep(0.1)
+    assert len(pool.prompts) == 2
+    assert executor.stats()['cancelled'] == 2
+
+
+def test_cancel_ab_feedback_keeps_completed_cells(single_worker):
+    pool, executor = single_worker
+    token = CancelToken()
+
+    def cancel_when_queued(cell, completed, total):
+        threading.Thread(target=lambda: (wait_for_queue(executor, 1), token.cancel('用戶端已斷線'))).start()
+
+    with pytest.raises(OperationCancelled) as info:
+        mcp_feedback.run_ab_feedback(personas(3), ["文案 A"], cell_callback=cancel_when_queued, api_key='k',
+                                     use_cache=False, cancel_token=token)
+
+    assert [(c['copy_index'], c['score']) for c in info.value.partial] == [(0, 7)]
+    pool.release.set()
+    time.sleep(0.1)
+    assert len(pool.prompts) == 2
+
+
+def test_cancelled_persona_stream_saves_completed_chunks(app_module):
+    started = threading.Event()
+
+    async def generate(progress_callback):
+        progress_callback({'stage': 'generating', 'completed': 1, 'chunk': 1,
+                           'personas': [{'persona_id': '1', 'description': '想轉職的工程師'}]})
+        started.set()
+        await asyncio.sleep(10)
+
+    with app_module.app.test_request_context('/process-csv', method='POST', data={'save_partial': '1'}):
+        response = app_module.stream_persona_request(lambda progress_callback: generate(progress_callback), 'CSV')
+    stream = app_module.get_stream_registry().get(response.headers['X-Stream-Id'])
+    assert started.wait(5)
+    stream.cancel_token.cancel('用戶端已斷線')
+
+    deadline = time.monotonic() + 5
+    while not stream.closed and time.monotonic() < deadline:
+        time.sleep(0.01)
+    output_folder = app_module.app.config['OUTPUT_FOLDER']
+    saved = [name for name in os.listdir(output_folder) if name.startswith('partial_csv_')]
+    assert len(saved) == 1
+    with open(os.path.join(output_folder, saved[0]), encoding='utf-8') as f:
+        assert [p['description'] for p in json.load(f)] == ['想轉職的工程師']
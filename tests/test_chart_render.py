@@ -0,0 +1,37 @@
+# tests/test_chart_render.py
+import warnings
+
+import chart_render
+from chart_render import ChartRenderer, chart_spec
+
+FEEDBACK = [{'persona_id': 'csv_2', 'score': 5}, {'persona_id': 'csv_1', 'score': 8}]
+
+
+def render_without_glyph_warnings(spec):
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        image = chart_render._render(spec, 'svg')
+    assert not [w for w in caught if 'missing from font' in str(w.message)]
+    return image.decode('utf-8')
+
+
+def test_chart_text_renders_with_bundled_font():
+    svg = render_without_glyph_warnings(chart_spec(FEEDBACK, 6.5))
+    assert svg.startswith('<?xml')
+
+
+def test_falls_back_to_ascii_labels_without_cjk_font(monkeypatch, tmp_path):
+    monkeypatch.setattr(chart_render, '_cjk_fonts', None)
+    monkeypatch.setattr(chart_render, 'CJK_FONTS', [])
+    monkeypatch.setattr(chart_render, 'CHART_FONT_PATH', str(tmp_path / "missing.otf"))
+    render_without_glyph_warnings(chart_spec(FEEDBACK, 6.5))
+    assert chart_render._cjk_fonts == []
+
+
+def test_renderer_caches_by_scores():
+    renderer = ChartRenderer(max_entries=2)
+    spec = chart_spec(FEEDBACK, 6.5)
+    key = renderer.submit(spec, 'png')
+    assert renderer.submit(chart_spec(list(reversed(FEEDBACK)), 6.5), 'png') == key
+    assert renderer.result(key).startswith(b'\x89PNG')
+    assert renderer.stats()['cached'] == 1
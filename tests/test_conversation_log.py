@@ -0,0 +1,71 @@
+# tests/test_conversation_log.py
+import csv
+import io
+import os
+import threading
+
+from conversation_log import ConversationLog, find_log_for_export, iter_csv_export, iter_records
+
+
+def prompt_for(body):
+    return f"這是問卷資料：\n{body}\n\n請生成 persona"
+
+
+def export_rows(path):
+    text = "".join(iter_csv_export(path)).lstrip('﻿')
+    return list(csv.reader(io.StringIO(text)))[1:]
+
+
+def test_runs_with_same_prefix_keep_separate_logs(tmp_path):
+    first = ConversationLog.start(str(tmp_path), "csv")
+    first.append([{'role': 'assistant', 'content': 'a'}])
+    second = ConversationLog.start(str(tmp_path), "csv")
+    second.append([{'role': 'assistant', 'content': 'b'}])
+
+    assert first.path != second.path
+    assert [r['content'] for r in iter_records(first.path)] == ['a']
+    assert [r['content'] for r in iter_records(second.path)] == ['b']
+    assert find_log_for_export(str(tmp_path), second.export_name) == second.path
+
+
+def test_body_and_template_are_stored_once(tmp_path):
+    log = ConversationLog.start(str(tmp_path), "csv")
+    bodies = ["a,b\n1,2", "a,b\n3,4"]
+    for body in bodies:
+        # 同一批次重試兩次，輸入與範本都不應重複保存
+        for _ in range(2):
+            log.append([{'role': 'user', 'content': prompt_for(body)},
+                        {'role': 'assistant', 'content': '[]'}], body=body)
+
+    records = list(iter_records(log.path))
+    assert sum(r['type'] == 'body' for r in records) == 2
+    assert sum(r['type'] == 'prompt' for r in records) == 1
+    template = next(r['text'] for r in records if r['type'] == 'prompt')
+    assert not any(body in template for body in bodies)
+
+    rows = export_rows(log.path)
+    assert [row[0] for row in rows if row[1] == 'user'] == [prompt_for(b) for b in bodies for _ in range(2)]
+
+
+def test_prompt_without_body_is_logged_whole(tmp_path):
+    log = ConversationLog.start(str(tmp_path), "md")
+    log.append([{'role': 'user', 'content': 'hello'}, {'role': 'assistant', 'content': 'hi'}])
+    assert export_rows(log.path) == [['hello', 'user'], ['hi', 'assistant']]
+
+
+def test_concurrent_appends_keep_the_log_readable(tmp_path):
+    log = ConversationLog.start(str(tmp_path), "csv")
+
+    def write(n):
+        for i in range(20):
+            log.append([{'role': 'assistant', 'content': f"{n}-{i}"}], chunk=n)
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    contents = [r['content'] for r in iter_records(log.path)]
+    assert sorted(contents) == sorted(f"{n}-{i}" for n in range(8) for i in range(20))
+    assert os.path.basename(log.path).startswith("all_csv_")
@@ -0,0 +1,52 @@
+# tests/test_json_extract.py
+from json_extract import extract_json_values, extract_objects
+
+
+def test_plain_json_response():
+    assert extract_json_values('[{"persona_id": "1"}]') == [[{'persona_id': '1'}]]
+
+
+def test_fenced_block_with_surrounding_prose():
+    text = '以下是結果：\n```json\n[{"persona_id": "1"}, {"persona_id": "2"}]\n```\n以上。'
+    assert extract_objects(text) == [{'persona_id': '1'}, {'persona_id': '2'}]
+
+
+def test_unmatched_bracket_in_prose_before_json():
+    text = 'Note [see below:\n```json\n{"persona_id":"1"}\n```'
+    assert extract_json_values(text) == [{'persona_id': '1'}]
+
+
+def test_unmatched_brace_in_prose_before_json():
+    text = 'Use {placeholder here.\n[{"persona_id": "1"}]'
+    assert extract_objects(text) == [{'persona_id': '1'}]
+
+
+def test_mismatched_closer_in_prose():
+    text = '(see [a} first) {"persona_id": "1"}'
+    assert extract_json_values(text) == [{'persona_id': '1'}]
+
+
+def test_multiple_values_and_trailing_commas():
+    text = 'A: {"persona_id": "1",} B: [{"persona_id": "2"},]'
+    assert extract_objects(text) == [{'persona_id': '1'}, {'persona_id': '2'}]
+
+
+def test_brackets_inside_strings_are_ignored():
+    text = 'x {"description": "喜歡 [實作] 與 {範例}"} y'
+    assert extract_json_values(text) == [{'description': '喜歡 [實作] 與 {範例}'}]
+
+
+def test_truncated_array_keeps_complete_members():
+    text = '```json\n[{"persona_id": "1"}, {"persona_id": "2", "description": "完整"}, {"persona_id": "3", "desc'
+    assert extract_objects(text) == [
+        {'persona_id': '1'}, {'persona_id': '2', 'description': '完整'}, {'persona_id': '3'}
+    ]
+
+
+def test_wrapped_list_is_unwrapped():
+    assert extract_objects('{"personas": [{"persona_id": "1"}]}') == [{'persona_id': '1'}]
+
+
+def test_no_json():
+    assert extract_json_values('沒有任何 JSON') == []
+    assert extract_json_values('') == []
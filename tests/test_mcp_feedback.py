@@ -0,0 +1,125 @@
+# tests/test_mcp_feedback.py
+import json
+import re
+
+import pytest
+
+import mcp_feedback
+from rate_limiter import TokenBucketLimiter
+from response_cache import ResponseCache
+
+SCORES = {'喜歡實作': 9, '時間不夠': 3, '想轉職': 6}
+
+
+class StubModel:
+    """合併評估的替身：依 prompt 中每位 persona 的描述回傳固定分數，回應順序與 prompt 相反"""
+
+    def __init__(self):
+        self.prompts = []
+
+    async def generate_async(self, api_key, model, prompt, timeout=None, **kwargs):
+        self.prompts.append(prompt)
+        blocks = re.findall(r"=== Persona (\S+) ===\n描述：(\S+)", prompt)
+        return json.dumps([
+            {'persona_ref': ref, 'score': SCORES[description], 'reasons_to_buy': [], 'reasons_not_to_buy': []}
+            for ref, description in reversed(blocks)
+        ])
+
+
+class FailingModel:
+    async def generate_async(self, api_key, model, prompt, timeout=None, **kwargs):
+        raise AssertionError("不應呼叫模型")
+
+
+@pytest.fixture
+def stub_env(tmp_path, monkeypatch):
+    limiter = TokenBucketLimiter(rpm=10000, tpm=10 ** 9)
+    monkeypatch.setattr(mcp_feedback, 'get_limiter', lambda api_key: limiter)
+    cache = ResponseCache(str(tmp_path / "feedback"))
+    monkeypatch.setattr(mcp_feedback, 'get_feedback_cache', lambda: cache)
+    model = StubModel()
+    monkeypatch.setattr(mcp_feedback, 'get_llm_executor', lambda: model)
+    return model
+
+
+def personas_with_duplicate_ids():
+    return [
+        {'persona_id': 'csv_1', 'description': '喜歡實作'},
+        {'persona_id': 'csv_1', 'description': '時間不夠'},
+        {'persona_id': 'csv_2', 'description': '想轉職'},
+    ]
+
+
+def test_batch_maps_results_by_alias_even_with_duplicate_ids(stub_env):
+    feedback, avg_score, spec = mcp_feedback.run_mcp_feedback(
+        personas_with_duplicate_ids(), "新課程上線", api_key='k', batched=True, use_cache=False
+    )
+    assert len(stub_env.prompts) == 1
+    assert 'Persona P1' in stub_env.prompts[0] and 'Persona P3' in stub_env.prompts[0]
+    assert [f['score'] for f in feedback] == [9, 3, 6]
+    assert [f['persona_id'] for f in feedback] == ['csv_1', 'csv_1', 'csv_2']
+    assert avg_score == 6
+
+
+def test_batch_results_are_cached_per_persona_content(stub_env, monkeypatch):
+    mcp_feedback.run_mcp_feedback(personas_with_duplicate_ids(), "新課程上線", api_key='k', batched=True,
+                                  use_cache=False)
+    monkeypatch.setattr(mcp_feedback, 'get_llm_executor', lambda: FailingModel())
+    feedback, _, _ = mcp_feedback.run_mcp_feedback(
+        list(reversed(personas_with_duplicate_ids())), "新課程上線", api_key='k', batched=True
+    )
+    assert [f['score'] for f in feedback] == [6, 3, 9]
+
+
+def test_parse_batch_accepts_loose_aliases():
+    text = json.dumps([{'persona_ref': 'p2', 'score': 4}, {'persona_ref': '1', 'score': 7},
+                       {'persona_ref': 'P9', 'score': 1}])
+    results = mcp_feedback.parse_batch_feedback_response(text, ['a', 'a'])
+    assert {index: r['score'] for index, r in results.items()} == {0: 7, 1: 4}
+    assert results[1]['persona_id'] == 'a'
+
+
+class GarbledModel:
+    def __init__(self):
+        self.calls = 0
+
+    async def generate_async(self, api_key, model, prompt, timeout=None, **kwargs):
+        self.calls += 1
+        return "抱歉，我無法評分"
+
+
+class SingleModel:
+    def __init__(self):
+        self.calls = 0
+
+    async def generate_async(self, api_key, model, prompt, timeout=None, **kwargs):
+        self.calls += 1
+        return json.dumps({'score': 8, 'reasons_to_buy': ['實用'], 'reasons_not_to_buy': []})
+
+
+def test_unparsed_response_is_not_cached(stub_env, monkeypatch):
+    personas = [{'persona_id': '1', 'description': '喜歡實作'}]
+    garbled = GarbledModel()
+    monkeypatch.setattr(mcp_feedback, 'get_llm_executor', lambda: garbled)
+    feedback, _, _ = mcp_feedback.run_mcp_feedback(personas, "新課程上線", api_key='k', batched=False)
+    assert feedback[0]['score'] == 5 and feedback[0]['unparsed']
+    assert mcp_feedback.get_feedback_cache().stats()['entries'] == 0
+
+    model = SingleModel()
+    monkeypatch.setattr(mcp_feedback, 'get_llm_executor', lambda: model)
+    feedback, _, _ = mcp_feedback.run_mcp_feedback(personas, "新課程上線", api_key='k', batched=False)
+    assert model.calls == 1
+    assert feedback[0]['score'] == 8
+    assert mcp_feedback.get_feedback_cache().stats()['entries'] == 1
+
+
+def test_unparsed_ab_cell_is_not_cached(stub_env, monkeypatch):
+    personas = [{'persona_id': '1', 'description': '喜歡實作'}]
+    garbled = GarbledModel()
+    monkeypatch.setattr(mcp_feedback, 'get_llm_executor', lambda: garbled)
+    cells, _ = mcp_feedback.run_ab_feedback(personas, ["文案 A"], api_key='k')
+    assert garbled.calls == 1 and cells[0]['score'] == 5
+    assert mcp_feedback.get_feedback_cache().stats()['entries'] == 0
+
+    mcp_feedback.run_ab_feedback(personas, ["文案 A"], api_key='k')
+    assert garbled.calls == 2
@@ -0,0 +1,100 @@
+# tests/test_mcp_persona.py
+import asyncio
+import threading
+
+import pytest
+
+import mcp_persona
+
+
+class StubStore:
+    def save_run(self, personas, prefix):
+        pass
+
+
+@pytest.fixture
+def stub_generate(monkeypatch):
+    """以替身取代 _generate_personas，每個批次產生一個 persona，記錄收到的 prompt"""
+    prompts = []
+
+    async def generate(prompt, api_key=None, use_cache=True):
+        prompts.append(prompt)
+        await asyncio.sleep(0)
+        persona = {'persona_id': '1', 'description': f"批次 {len(prompts)}"}
+        return [persona], [{'content': prompt, 'role': 'user'}, {'content': '[]', 'role': 'assistant'}]
+
+    monkeypatch.setattr(mcp_persona, '_generate_personas', generate)
+    monkeypatch.setattr(mcp_persona, 'get_persona_store', lambda: StubStore())
+    return prompts
+
+
+def test_run_chunks_keeps_completed_chunks_when_ingest_fails(stub_generate):
+    def chunks():
+        yield "a"
+        yield "b"
+        raise UnicodeDecodeError('ascii', b'\xff', 0, 1, 'ordinal not in range(128)')
+
+    results = asyncio.run(mcp_persona._run_chunks(chunks(), lambda chunk: chunk))
+    assert len(results) == 2
+    assert stub_generate == ["a", "b"]
+
+
+def test_run_chunks_raises_ingest_error_when_nothing_completed(stub_generate):
+    def chunks():
+        raise UnicodeDecodeError('ascii', b'\xff', 0, 1, 'ordinal not in range(128)')
+        yield
+
+    with pytest.raises(UnicodeDecodeError):
+        asyncio.run(mcp_persona._run_chunks(chunks(), lambda chunk: chunk))
+
+
+def test_large_csv_with_bad_byte_near_the_end_still_saves(stub_generate, tmp_path):
+    # 開頭全是 ASCII，編碼偵測為 ascii；無法解碼的位元組在檔尾
+    rows = [f"{i},learner {i} wants practical data skills" for i in range(3000)]
+    csv_path = tmp_path / "survey.csv"
+    csv_path.write_bytes(("id,answer\n" + "\n".join(rows)).encode('ascii') + b"\n3000,caf\xe9\n")
+
+    _, _, _, personas = asyncio.run(mcp_persona.process_large_csv(
+        str(csv_path), str(tmp_path / "out"), batch_size=2000
+    ))
+    assert personas
+    assert len(stub_generate) > 1
+    assert any("3000,caf" in prompt for prompt in stub_generate)
+
+
+@pytest.mark.parametrize('process', [mcp_persona.process_large_csv, mcp_persona.process_large_csv2])
+def test_csv_chunk_iterator_is_built_off_the_event_loop(stub_generate, tmp_path, monkeypatch, process):
+    threads = []
+
+    def iter_chunks(csv_path, max_size, **kwargs):
+        threads.append(threading.current_thread())
+        return iter(["id,answer\n1,hi"])
+
+    monkeypatch.setattr(mcp_persona, 'iter_csv_chunks', iter_chunks)
+    asyncio.run(process("survey.csv", str(tmp_path / "out")))
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_dispatch_keeps_chunk_order_and_caps_concurrency(monkeypatch):
+    monkeypatch.setattr(mcp_persona, 'MAX_CONCURRENT_CHUNKS', 3)
+    state = {'active': 0, 'peak': 0}
+    finished = []
+
+    async def generate(prompt, api_key=None, use_cache=True):
+        chunk = int(prompt.split("CHUNK-")[1].split()[0])
+        state['active'] += 1
+        state['peak'] = max(state['peak'], state['active'])
+        # 前面的批次較慢，完成順序與批次順序相反
+        await asyncio.sleep(0.01 * (10 - chunk))
+        state['active'] -= 1
+        finished.append(chunk)
+        return [{'persona_id': '1', 'description': f"來自批次 {chunk}"}], []
+
+    monkeypatch.setattr(mcp_persona, '_generate_personas', generate)
+    chunks = (f"CHUNK-{i}" for i in range(10))
+    personas, _ = asyncio.run(mcp_persona._dispatch_chunks(chunks))
+
+    assert finished != sorted(finished)
+    assert state['peak'] == 3
+    assert [p['description'] for p in personas] == [f"來自批次 {i}" for i in range(10)]
+    assert [p['batch_info'] for p in personas] == [f"Batch {i + 1}/10" for i in range(10)]
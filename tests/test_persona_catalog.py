@@ -0,0 +1,78 @@
+# tests/test_persona_catalog.py
+import json
+import os
+
+import pytest
+
+from persona_catalog import PersonaCatalog
+
+
+def write_personas(base_dir, source, ids, mtime=None):
+    path = base_dir / f"{source}_personas.json"
+    path.write_text(json.dumps([{'persona_id': pid, 'description': f"描述 {pid}"} for pid in ids]),
+                    encoding='utf-8')
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_cursor_pages_follow_lexical_id_order(tmp_path):
+    write_personas(tmp_path, "csv", ["csv_2", "csv_10", "csv_1"])
+    write_personas(tmp_path, "md", ["md_1"])
+    catalog = PersonaCatalog(str(tmp_path))
+
+    seen = []
+    cursor = None
+    while True:
+        _, personas, cursor, total = catalog.page(cursor=cursor, limit=2)
+        seen.append([p['persona_id'] for p in personas])
+        if cursor is None:
+            break
+    assert seen == [["csv_1", "csv_10"], ["csv_2", "md_1"]]
+    assert total == 4
+
+    # 游標指向已不存在的 ID 時從下一個 ID 繼續
+    _, personas, _, _ = catalog.page(cursor="csv_11", limit=10)
+    assert [p['persona_id'] for p in personas] == ["csv_2", "md_1"]
+    _, personas, _, total = catalog.page(limit=10, source="md")
+    assert [p['persona_id'] for p in personas] == ["md_1"] and total == 1
+
+
+def test_reloads_only_when_file_changes(tmp_path):
+    write_personas(tmp_path, "csv", ["csv_1"], mtime=1000)
+    catalog = PersonaCatalog(str(tmp_path))
+    version, entries, _ = catalog.snapshot()
+    assert catalog.snapshot()[1] is entries
+
+    # 大小相同、只有 mtime 改變
+    write_personas(tmp_path, "csv", ["csv_2"], mtime=2000)
+    new_version, entries, ids = catalog.snapshot()
+    assert new_version != version and ids == ["csv_2"]
+
+    # mtime 相同、大小改變
+    write_personas(tmp_path, "csv", ["csv_2", "csv_3"], mtime=2000)
+    assert catalog.snapshot()[2] == ["csv_2", "csv_3"]
+
+
+@pytest.fixture
+def client(app_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'persona_catalog', PersonaCatalog(str(tmp_path)))
+    return app_module.app.test_client()
+
+
+def test_load_personas_returns_304_for_matching_etag(client, tmp_path):
+    write_personas(tmp_path, "csv", ["csv_1", "csv_2"], mtime=1000)
+    first = client.get('/load-personas?limit=1')
+    assert first.status_code == 200
+    assert first.get_json()['next_cursor'] == "csv_1"
+    etag = first.headers['ETag']
+
+    cached = client.get('/load-personas?limit=1', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    # 查詢條件不同時 ETag 也不同
+    assert client.get('/load-personas?limit=2', headers={'If-None-Match': etag}).status_code == 200
+
+    write_personas(tmp_path, "csv", ["csv_1", "csv_3"], mtime=2000)
+    changed = client.get('/load-personas?limit=1', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
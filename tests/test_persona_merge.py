@@ -0,0 +1,52 @@
+# tests/test_persona_merge.py
+from persona_merge import _terms, merge_personas
+
+
+def persona(description, motivation, batch, resources=()):
+    return {
+        'persona_id': 'x',
+        'description': description,
+        'motivation': motivation,
+        'batch_info': batch,
+        'suggested_learning_resources': [{'feature_name': name} for name in resources],
+    }
+
+
+def test_terms_use_cjk_bigrams_and_lowercase_words():
+    assert _terms("學習Python") == ['學習', 'python']
+    assert _terms("好") == ['好']
+
+
+def test_similar_personas_are_merged():
+    personas = [
+        persona("大學生想學習資料分析與程式設計", "希望找到資料分析的工作", "批次 1", ["Pandas 教學"]),
+        persona("社會新鮮人熱愛烹飪與旅行", "想開一間咖啡店", "批次 1"),
+        persona("大學生想學習資料分析與程式設計技巧", "希望找到資料分析相關工作", "批次 2", ["Pandas 教學", "SQL 入門"]),
+    ]
+    merged = merge_personas(personas)
+
+    assert len(merged) == 2
+    first, second = merged
+    assert [p['persona_id'] for p in merged] == ['1', '2']
+    assert first['merged_count'] == 2
+    assert first['batch_info'] == ['批次 1', '批次 2']
+    assert [r['feature_name'] for r in first['suggested_learning_resources']] == ['Pandas 教學', 'SQL 入門']
+    assert second['merged_count'] == 1
+    assert second['description'] == "社會新鮮人熱愛烹飪與旅行"
+
+
+def test_threshold_controls_merging():
+    personas = [
+        persona("工程師學習雲端架構", "升遷", "批次 1"),
+        persona("工程師學習雲端部署", "轉職", "批次 2"),
+    ]
+    assert len(merge_personas(personas, threshold=1.01)) == 2
+    assert len(merge_personas(personas, threshold=0.0)) == 1
+
+
+def test_single_persona_is_renumbered_without_mutation():
+    original = persona("教師", "進修", "批次 1")
+    merged = merge_personas([original])
+    assert merged == [dict(original, persona_id='1')]
+    assert original['persona_id'] == 'x'
+    assert merge_personas([]) == []
@@ -0,0 +1,104 @@
+# tests/test_rate_limiter.py
+import asyncio
+import os
+import sqlite3
+import threading
+
+from google.api_core.exceptions import ResourceExhausted
+
+from rate_limiter import SQLiteTokenBucketLimiter, TokenBucketLimiter, is_rate_limit_error
+
+
+def test_bucket_waits_when_requests_run_out():
+    limiter = TokenBucketLimiter(rpm=2, tpm=1000)
+    assert limiter.try_acquire(10) == 0
+    assert limiter.try_acquire(10) == 0
+    assert limiter.try_acquire(10) > 0
+
+
+def test_bucket_waits_for_tokens():
+    limiter = TokenBucketLimiter(rpm=100, tpm=1000)
+    assert limiter.try_acquire(900) == 0
+    assert limiter.try_acquire(500) > 0
+
+
+def test_rate_limited_halves_rate_and_success_restores_it():
+    limiter = TokenBucketLimiter(rpm=10, tpm=1000, min_rpm=1)
+    assert limiter.on_rate_limited(retry_delay=5) == 5
+    stats = limiter.stats()
+    assert stats['rate_rpm'] == 5
+    assert stats['paused_seconds'] > 0
+    assert limiter.try_acquire() > 0
+
+    for _ in range(20):
+        limiter.on_success()
+    assert limiter.stats()['rate_rpm'] == 10
+
+
+def test_sqlite_limiters_share_quota(tmp_path):
+    path = str(tmp_path / "limits.db")
+    first = SQLiteTokenBucketLimiter("k", path=path, rpm=2, tpm=1000)
+    second = SQLiteTokenBucketLimiter("k", path=path, rpm=2, tpm=1000)
+    other = SQLiteTokenBucketLimiter("other", path=path, rpm=2, tpm=1000)
+    assert first.try_acquire() == 0
+    assert second.try_acquire() == 0
+    assert first.try_acquire() > 0
+    assert other.try_acquire() == 0
+
+
+def test_sqlite_acquire_does_not_block_event_loop(tmp_path):
+    path = str(tmp_path / "limits.db")
+    limiter = SQLiteTokenBucketLimiter("k", path=path)
+
+    # 另一個連線持有寫入鎖 0.3 秒，acquire 等待期間事件迴圈仍要能執行其他協程
+    holder = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    holder.execute("BEGIN IMMEDIATE")
+    released = threading.Event()
+
+    def release():
+        holder.execute("COMMIT")
+        released.set()
+
+    threading.Timer(0.3, release).start()
+
+    async def main():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.ensure_future(ticker())
+        await limiter.acquire()
+        waited = released.is_set()
+        task.cancel()
+        return ticks, waited
+
+    ticks, waited = asyncio.run(main())
+    holder.close()
+    assert waited
+    assert ticks >= 10
+
+
+def test_is_rate_limit_error_uses_type_and_status_code():
+    class HttpError(Exception):
+        status_code = 429
+
+    assert is_rate_limit_error(ResourceExhausted("quota exceeded"))
+    assert is_rate_limit_error(HttpError("too many requests"))
+    assert not is_rate_limit_error(ValueError("prompt has 4290 tokens"))
+    assert not is_rate_limit_error(RuntimeError("quota field missing in response"))
+
+
+def test_sqlite_reopens_when_database_file_is_deleted(tmp_path):
+    path = str(tmp_path / "limits.db")
+    limiter = SQLiteTokenBucketLimiter("k", path=path, rpm=1)
+    assert limiter.try_acquire() == 0
+    os.remove(path)
+
+    # 重新開啟後與新建立的限流器（例如其他 worker）共用同一個檔案
+    assert limiter.try_acquire() == 0
+    other = SQLiteTokenBucketLimiter("k", path=path, rpm=1)
+    assert other.try_acquire() > 0
@@ -0,0 +1,67 @@
+# tests/test_response_cache.py
+import os
+import time
+
+from response_cache import ResponseCache, make_key
+
+
+def entry_size(cache, key):
+    return os.path.getsize(cache._path(key))
+
+
+def test_get_returns_what_set_stored(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    key = make_key("model", "prompt")
+    cache.set(key, {'response_text': '[]', 'personas': []})
+    assert cache.get(key)['response_text'] == '[]'
+    assert cache.get(make_key("model", "other")) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_evicts_least_recently_used_when_over_limit(tmp_path):
+    probe = ResponseCache(str(tmp_path / "probe"))
+    probe.set("00probe", {'text': 'x' * 100})
+    size = entry_size(probe, "00probe")
+
+    cache = ResponseCache(str(tmp_path / "cache"), max_bytes=size * 2 + 20)
+    cache.set("aa1", {'text': 'x' * 100})
+    cache.set("bb2", {'text': 'x' * 100})
+    assert cache.get("aa1") is not None  # aa1 變成最近使用
+    cache.set("cc3", {'text': 'x' * 100})
+
+    assert cache.get("bb2") is None
+    assert cache.get("aa1") is not None
+    assert cache.get("cc3") is not None
+    assert cache.stats()['evictions'] == 1
+    assert not os.path.exists(cache._path("bb2"))
+
+
+def test_overwrite_does_not_double_count(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    cache.set("aa1", {'text': 'x' * 100})
+    cache.set("aa1", {'text': 'x' * 100})
+    assert cache.stats()['bytes'] == entry_size(cache, "aa1")
+    assert cache.stats()['entries'] == 1
+
+
+def test_startup_scan_orders_existing_entries_by_mtime(tmp_path):
+    first = ResponseCache(str(tmp_path))
+    first.set("aa1", {'text': 'x' * 100})
+    first.set("bb2", {'text': 'x' * 100})
+    old = time.time() - 100
+    os.utime(first._path("bb2"), (old, old))
+
+    cache = ResponseCache(str(tmp_path), max_bytes=first.stats()['bytes'] + 20)
+    assert cache.stats()['entries'] == 2
+    cache.set("cc3", {'text': 'x' * 100})
+    assert cache.get("bb2") is None
+    assert cache.get("aa1") is not None
+
+
+def test_expired_entry_is_removed(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=-1)
+    cache.set("aa1", {'text': 'x'})
+    assert cache.get("aa1") is None
+    assert cache.stats()['entries'] == 0
+    assert not os.path.exists(cache._path("aa1"))
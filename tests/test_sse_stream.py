@@ -0,0 +1,111 @@
+# tests/test_sse_stream.py
+import json
+import threading
+import time
+
+import sse_stream
+from cancellation import CancelToken
+from sse_stream import EventStream, StreamRegistry
+
+
+def parse(frame):
+    """回傳 (id, data)；註解行回傳 None"""
+    if frame.startswith(':'):
+        return None
+    event_id = None
+    data = None
+    for line in frame.strip().split('\n'):
+        if line.startswith('id: '):
+            event_id = int(line[4:])
+        elif line.startswith('data: '):
+            data = json.loads(line[6:])
+    return event_id, data
+
+
+def collect(stream, last_event_id=0, heartbeat=0.05):
+    return [e for e in (parse(f) for f in stream.iter_sse(last_event_id, heartbeat=heartbeat)) if e]
+
+
+def closed_stream(count, buffer_size=100):
+    stream = EventStream(buffer_size=buffer_size)
+    for n in range(1, count + 1):
+        stream.publish({'type': 'progress', 'n': n})
+    stream.close()
+    return stream
+
+
+def test_resume_sends_only_events_after_last_id():
+    events = collect(closed_stream(5), last_event_id=3)
+    assert [event_id for event_id, _ in events] == [4, 5]
+    assert [data['n'] for _, data in events] == [4, 5]
+
+
+def test_resume_from_evicted_id_sends_reset_then_buffer():
+    events = collect(closed_stream(10, buffer_size=3), last_event_id=2)
+    (reset_id, reset), rest = events[0], events[1:]
+    assert reset_id is None
+    assert reset['type'] == 'reset'
+    assert reset['oldest_event_id'] == 8
+    assert [event_id for event_id, _ in rest] == [8, 9, 10]
+
+
+def test_resume_at_edge_of_buffer_does_not_reset():
+    events = collect(closed_stream(10, buffer_size=3), last_event_id=7)
+    assert [event_id for event_id, _ in events] == [8, 9, 10]
+
+
+def test_unknown_last_id_sends_reset():
+    events = collect(closed_stream(3), last_event_id=50)
+    assert events[0][1]['type'] == 'reset'
+    assert [event_id for event_id, _ in events[1:]] == [1, 2, 3]
+
+
+def test_live_events_and_heartbeats():
+    stream = EventStream()
+
+    def work():
+        time.sleep(0.15)
+        stream.publish({'type': 'progress'})
+        stream.close()
+
+    threading.Thread(target=work).start()
+    frames = list(stream.iter_sse(heartbeat=0.05))
+    assert ': heartbeat\n\n' in frames
+    assert parse(frames[-1]) == (1, {'type': 'progress'})
+
+
+def test_cancels_after_grace_when_abandoned(monkeypatch):
+    monkeypatch.setattr(sse_stream, 'SSE_RESUME_GRACE', 0.05)
+    token = CancelToken()
+    stream = EventStream(cancel_token=token)
+    stream.attach()
+    stream.detach()
+    time.sleep(0.2)
+    assert token.cancelled
+
+
+def test_reconnect_within_grace_keeps_work_running(monkeypatch):
+    monkeypatch.setattr(sse_stream, 'SSE_RESUME_GRACE', 0.1)
+    token = CancelToken()
+    stream = EventStream(cancel_token=token)
+    stream.attach()
+    stream.detach()
+    stream.attach()
+    time.sleep(0.2)
+    assert not token.cancelled
+    stream.detach()
+    stream.close()
+
+
+def test_registry_runs_work_and_keeps_stream_for_resume():
+    registry = StreamRegistry(ttl=60)
+
+    def work(publish):
+        publish({'type': 'progress'})
+        raise RuntimeError("boom")
+
+    stream = registry.start(work)
+    events = collect(stream)
+    assert [data['type'] for _, data in events] == ['progress', 'error']
+    assert registry.get(stream.id) is stream
+    assert registry.stats() == {'active': 0, 'retained': 1}
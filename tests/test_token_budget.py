@@ -0,0 +1,28 @@
+# tests/test_token_budget.py
+from token_budget import count_tokens, load_encoder, plan_csv
+
+
+def write_csv(tmp_path, rows):
+    path = tmp_path / "survey.csv"
+    path.write_text("q1,q2\n" + "".join(f"答案{i},回覆內容 {i}\n" for i in range(rows)), encoding='utf-8')
+    return str(path)
+
+
+def test_bundled_encoder_loads_without_network():
+    assert load_encoder() is not None
+    assert count_tokens("hello world") == 2
+
+
+def test_plan_subtracts_prompt_overhead_from_chunk_budget(tmp_path):
+    path = write_csv(tmp_path, 2000)
+    plan = plan_csv(path, token_budget=5000, single_shot_limit=1000, prompt_overhead=300)
+    assert plan['mode'] == 'batched'
+    assert plan['chunk_tokens'] == 4700
+    assert plan['estimated_chunks'] == -(-plan['estimated_tokens'] // 4700)
+
+
+def test_prompt_overhead_can_push_a_file_into_batched_mode(tmp_path):
+    path = write_csv(tmp_path, 20)
+    tokens = plan_csv(path)['estimated_tokens']
+    assert plan_csv(path, single_shot_limit=tokens)['mode'] == 'single'
+    assert plan_csv(path, single_shot_limit=tokens, prompt_overhead=10)['mode'] == 'batched'
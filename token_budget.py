@@ -0,0 +1,138 @@
+# token_budget.py
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 每次請求的 token 預算與模式切換門檻，可用環境變數覆寫
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", 8000))            # 批次模式下每批資料的 token 上限
+SINGLE_SHOT_TOKEN_LIMIT = int(os.getenv("SINGLE_SHOT_TOKEN_LIMIT", 40000))  # 超過即改用批次處理
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", 100000))             # 單次請求可接受的上限
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+MIN_CHUNK_TOKENS = int(os.getenv("MIN_CHUNK_TOKENS", 1000))               # 扣除 prompt 範本後每批至少保留的 token 數
+
+# tiktoken 從 TIKTOKEN_CACHE_DIR 讀取 BPE 檔，預設指向專案內附的 tokenizer/，載入時不需要連網
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tokenizer"))
+
+SAMPLE_BYTES = 64 * 1024   # 估算檔案 token 數時讀取的樣本大小
+CACHE_SIZE = 2048          # 記憶化快取保留的項目數
+
+# 中日韓文字、全形標點：大約一個字一個 token；其他字元大約四個字一個 token
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+_encoder = None
+_encoder_loaded = False
+_encoder_lock = threading.Lock()
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _bpe_path(encoding_name):
+    """tiktoken 快取中 BPE 檔的位置（檔名是官方下載網址的 sha1）"""
+    url = f"https://openaipublic.blob.core.windows.net/encodings/{encoding_name}.tiktoken"
+    return os.path.join(os.environ["TIKTOKEN_CACHE_DIR"], hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def load_encoder():
+    """載入本地 tokenizer，應在啟動時呼叫一次；無法載入時回傳 None
+
+    只讀取 TIKTOKEN_CACHE_DIR 中的 BPE 檔，檔案不存在時不嘗試下載（下載沒有逾時，會卡住所有計算），
+    直接改用字元類別估算並印出警告。
+    """
+    global _encoder, _encoder_loaded
+    with _encoder_lock:
+        if _encoder_loaded:
+            return _encoder
+        path = _bpe_path(TOKENIZER_ENCODING)
+        if not os.path.exists(path):
+            print(f"警告: 找不到 tokenizer {TOKENIZER_ENCODING} 的 BPE 檔 {path}，"
+                  "token 數改用字元類別估算，分批大小可能不準確")
+        else:
+            try:
+                import tiktoken
+                _encoder = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                print(f"已載入 tokenizer {TOKENIZER_ENCODING}")
+            except Exception as e:
+                print(f"警告: 無法載入 tokenizer {TOKENIZER_ENCODING}: {e}，"
+                      "token 數改用字元類別估算，分批大小可能不準確")
+                _encoder = None
+        _encoder_loaded = True
+    return _encoder
+
+
+def _get_encoder():
+    if _encoder_loaded:
+        return _encoder
+    return load_encoder()
+
+
+def _heuristic_count(text):
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_tokens_uncached(text):
+    """計算文字的 token 數，不經過快取（適合大量只出現一次的短字串）"""
+    if not text:
+        return 0
+    encoder = _get_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text, disallowed_special=()))
+    return _heuristic_count(text)
+
+
+def count_tokens(text):
+    """計算文字的 token 數，結果以內容雜湊做記憶化快取"""
+    if not text:
+        return 0
+    key = hashlib.sha1(text.encode('utf-8', errors='replace')).hexdigest()
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    tokens = count_tokens_uncached(text)
+    with _cache_lock:
+        _cache[key] = tokens
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return tokens
+
+
+def estimate_file_tokens(path, encoding='utf-8'):
+    """以檔案開頭的樣本計算 token/位元組比例，推估整個檔案的 token 數"""
+    file_size = os.path.getsize(path)
+    if file_size == 0:
+        return 0
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_BYTES)
+    # 樣本結尾可能切在多位元組字元中間，略過無法解碼的位元組
+    text = sample.decode(encoding or 'utf-8', errors='ignore')
+    tokens_per_byte = count_tokens_uncached(text) / max(len(sample), 1)
+    return int(file_size * tokens_per_byte)
+
+
+def plan_csv(path, encoding='utf-8', token_budget=None, single_shot_limit=None, prompt_overhead=0):
+    """決定 CSV 要一次送出或分批處理，並回傳每批的 token 預算
+
+    prompt_overhead 是 prompt 中資料以外（範本與輸出格式說明）的 token 數，
+    會從單次上限與每批預算中扣除，讓整個 prompt 而不只是資料落在預算內。
+    回傳 dict：mode（'single' 或 'batched'）、estimated_tokens、chunk_tokens、estimated_chunks。
+    """
+    token_budget = max(MIN_CHUNK_TOKENS, (token_budget or CHUNK_TOKEN_BUDGET) - prompt_overhead)
+    single_shot_limit = (single_shot_limit or SINGLE_SHOT_TOKEN_LIMIT) - prompt_overhead
+    estimated_tokens = estimate_file_tokens(path, encoding=encoding)
+    if estimated_tokens <= single_shot_limit:
+        return {
+            'mode': 'single',
+            'estimated_tokens': estimated_tokens,
+            'chunk_tokens': estimated_tokens,
+            'estimated_chunks': 1,
+        }
+    return {
+        'mode': 'batched',
+        'estimated_tokens': estimated_tokens,
+        'chunk_tokens': token_budget,
+        'estimated_chunks': -(-estimated_tokens // token_budget),
+    }
@@ -0,0 +1,76 @@
+# transcript_ingest.py
+import os
+import re
+import asyncio
+import chardet
+
+_HEADING_RE = re.compile(r"^#{1,6}\s", re.MULTILINE)
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+TRANSCRIPT_SEPARATOR = "\n\n=== 分隔線 ===\n\n"
+
+
+def read_transcript(path):
+    """讀取單一訪談 MD 檔，無法以 UTF-8 解碼時以 chardet 偵測編碼，回傳 (檔名, 內容)"""
+    with open(path, 'rb') as f:
+        raw = f.read()
+    try:
+        text = raw.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        encoding = chardet.detect(raw)['encoding'] or 'utf-8'
+        print(f"{os.path.basename(path)} 非 UTF-8 編碼，偵測為 {encoding}")
+        text = raw.decode(encoding, errors='replace')
+    return os.path.basename(path), text
+
+
+async def read_transcripts(paths):
+    """在執行緒池中並行讀取與偵測各檔案的編碼，結果依傳入順序排列"""
+    return await asyncio.gather(*(asyncio.to_thread(read_transcript, path) for path in paths))
+
+
+def _split(text, pattern):
+    """依 pattern 的位置切開文字，切點保留在下一段的開頭"""
+    starts = [m.start() for m in pattern.finditer(text) if m.start() > 0]
+    bounds = [0] + starts + [len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:]) if text[a:b].strip()]
+
+
+def _pieces(text, max_tokens, measure):
+    """把超過預算的文字依標題、段落、行逐層切小，最後才依字數硬切"""
+    if measure(text) <= max_tokens:
+        return [text]
+    for splitter in (lambda t: _split(t, _HEADING_RE), _PARAGRAPH_RE.split, str.splitlines):
+        parts = [p for p in splitter(text) if p.strip()]
+        if len(parts) > 1:
+            return [piece for part in parts for piece in _pieces(part, max_tokens, measure)]
+    # 單行仍超過預算：依比例估算字數硬切
+    size = max(1, int(len(text) * max_tokens / measure(text)))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def iter_transcript_chunks(transcripts, max_tokens, measure=len):
+    """將訪談紀錄依 token 預算分批
+
+    可以完整放進一批的訪談不會被拆開，多份短訪談會合併在同一批；
+    過長的訪談依 Markdown 標題（段落、行）切成小節，每段前面標上訪談名稱與第幾部分。
+    """
+    current = []
+    size = 0
+    for name, text in transcripts:
+        if measure(text) <= max_tokens:
+            blocks = [f"=== 訪談：{name} ===\n{text.strip()}"]
+        else:
+            sections = _pieces(text, max_tokens, measure)
+            blocks = [
+                f"=== 訪談：{name}（第 {i + 1}/{len(sections)} 部分）===\n{section.strip()}"
+                for i, section in enumerate(sections)
+            ]
+        for block in blocks:
+            block_size = measure(block)
+            if current and size + block_size > max_tokens:
+                yield TRANSCRIPT_SEPARATOR.join(current)
+                current = []
+                size = 0
+            current.append(block)
+            size += block_size
+    if current:
+        yield TRANSCRIPT_SEPARATOR.join(current)